@@ -25,6 +25,13 @@ RETRIES = "retries"
 OVERWRITE = "overwrite"
 DRY_RUN = "dryrun"
 BYPASS_ARCHIVE_VALIDATION = "bypass_archive_validation"
+UPLOAD_THREADS = "upload_threads"
+MAX_INFLIGHT_MB = "max_inflight_mb"
+PART_THREADS = "part_threads"
+SERVER_SIDE_COPY = "server_side_copy"
+VALIDATION_THREADS = "validation_threads"
+STAGING_BUDGET_MB = "staging_budget_mb"
+PREFETCH_FILES = "prefetch_files"
 
 #file validation 
 FILE_INVALID_REASON = "invalid_reason"
@@ -56,14 +63,13 @@ TEMP_DOWNLOAD_DIR = "tmp/download"
 
 CLI_VERSION = "4.3"
 MD5_CACHE_DIR = "tmp/md5"
-MD5_CACHE_FILE = "md5_cache.csv"
-MODIFIED_AT = "modifiedAt"
+MD5_CACHE_FILE = "md5_cache.db"
 HEARTBEAT_INTERVAL_CONFIG = "heartbeat_interval"
 CURRENT_UPLOADER_VERSION_CONFIG = "current_uploader_version"
 SUBFOLDER_FILE_NAME = "internal_file_name"
 SEPARATOR_CHAR = '\t'
 
-TEMP_UNZIP_DIR = "tmp/unzip"
+MULTIPART_JOURNAL_DIR = "tmp/multipart"
 ARCHIVE_MANIFEST = "archive_manifest"
 ARCHIVE_NAME = "archive_name"
 MAX_CREATE_BATCH_PAYLOAD_SIZE = 1024 * 1024 * 5  # 5MB. The create batch payload size is half to 75% of updated batch size.
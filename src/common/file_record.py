@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+from collections.abc import MutableMapping
+from common.constants import FILE_ID_DEFAULT, FILE_NAME_DEFAULT, FILE_PATH, FILE_SIZE_DEFAULT, MD5_DEFAULT, SUCCEEDED, \
+    ERRORS, SUBFOLDER_FILE_NAME, SKIPPED
+
+# keys of file record, in the order of columns in uploading report
+FILE_RECORD_KEYS = (FILE_ID_DEFAULT, FILE_NAME_DEFAULT, FILE_PATH, FILE_SIZE_DEFAULT, MD5_DEFAULT, SUCCEEDED, ERRORS,
+                    SUBFOLDER_FILE_NAME, SKIPPED)
+_KEY_SET = frozenset(FILE_RECORD_KEYS)
+
+"""
+class: FileRecord is the record of a file shared by validator, uploader, copier and uploading report.
+Values are kept in slots named by the keys instead of a dict, it can be used as a dict of the keys,
+a key is only in the record after it is set.
+ttl is the retry times left when uploading the file, it is not a key of the record.
+"""
+class FileRecord(MutableMapping):
+    __slots__ = FILE_RECORD_KEYS + ('ttl',)
+
+    def __init__(self, **values):
+        self.ttl = 0
+        for key, value in values.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in _KEY_SET:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in _KEY_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in _KEY_SET:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return (key for key in FILE_RECORD_KEYS if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        return key in _KEY_SET and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in _KEY_SET else default
+
+    def __repr__(self):
+        return f"FileRecord({dict(self)})"
@@ -3,8 +3,12 @@
 import requests
 import json
 from bento.common.utils import get_logger
-from common.constants import UPLOAD_TYPE, API_URL, SUBMISSION_ID, TOKEN, MAX_UPDATE_BATCH_PAYLOAD_SIZE
+from common.constants import UPLOAD_TYPE, API_URL, SUBMISSION_ID, TOKEN, MAX_UPDATE_BATCH_PAYLOAD_SIZE, MAX_CREATE_BATCH_PAYLOAD_SIZE
 from common.utils import get_exception_msg
+
+# bytes reserved for errors of a file in updateBatch body when splitting batches
+UPDATE_BATCH_ERRORS_RESERVE = 512
+
 class APIInvoker:
     def __init__(self, configs):
         self.token = configs.get(TOKEN)
@@ -54,30 +58,7 @@ class APIInvoker:
 
     #2) create upload batch
     def create_batch(self, file_array):
-        #adjust file list to match the graphql param.
-        file_array = json.dumps(file_array)
-        body = f"""
-        mutation {{
-            createBatch (
-                submissionID: \"{self.submissionId}\", 
-                type: \"{self.type}\", 
-                files: {file_array}
-            ){{
-                _id,
-                submissionID,
-                bucketName,
-                filePrefix,
-                type,
-                fileCount,
-                files {{
-                    fileID, 
-                    fileName,
-                }}
-                status,
-                createdAt
-            }}
-        }}
-        """
+        body = create_batch_body(self.submissionId, self.type, file_array)
         try:
             response = requests.post(url=self.url, headers=self.headers, json={"query": body})
             status = response.status_code
@@ -105,28 +86,8 @@ class APIInvoker:
     #3) update upload batch
     def update_batch(self, batchID, uploaded_files, uploading="false"):
         self.batch = None
-        #adjust file list to match the graphql param.
-        file_array = []
-        if uploaded_files:
-            file_array = json.dumps(uploaded_files).replace("\"fileName\"", "fileName").replace("\"succeeded\"", "succeeded").replace("\"errors\"", "errors").replace("\"skipped\"", "skipped") \
-                if uploaded_files and len(uploaded_files) > 0 else json.dumps(uploaded_files)
-        body = f"""
-        mutation {{
-            updateBatch (
-                batchID: \"{batchID}\", 
-                files: {file_array}, 
-                uploading: {uploading}
-                )
-            {{
-                _id,
-                submissionID,
-                type,
-                fileCount,
-                status,
-                updatedAt
-            }}
-        }}
-        """
+        file_array = uploaded_files if uploaded_files else []
+        body = update_batch_body(batchID, uploaded_files, uploading)
          # check the body size, if the size is too large (10MB as defined by MAX_UPDATE_BATCH_PAYLOAD_SIZE), it will cause the request to fail.
         body_size = len(body.encode("utf-8"))
         self.log.info(f"update batch body size: {body_size}")
@@ -232,3 +193,85 @@ class APIInvoker:
 
     
 
+"""
+compose body of createBatch mutation
+:param file_array: list of file names
+"""
+def create_batch_body(submission_id, upload_type, file_array):
+    #adjust file list to match the graphql param.
+    file_array = json.dumps(file_array)
+    return f"""
+        mutation {{
+            createBatch (
+                submissionID: \"{submission_id}\", 
+                type: \"{upload_type}\", 
+                files: {file_array}
+            ){{
+                _id,
+                submissionID,
+                bucketName,
+                filePrefix,
+                type,
+                fileCount,
+                files {{
+                    fileID, 
+                    fileName,
+                }}
+                status,
+                createdAt
+            }}
+        }}
+        """
+
+"""
+compose body of updateBatch mutation
+:param uploaded_files: list of dict of fileName, succeeded, errors and skipped
+"""
+def update_batch_body(batch_id, uploaded_files, uploading="false"):
+    #adjust file list to match the graphql param.
+    file_array = []
+    if uploaded_files:
+        file_array = json.dumps(uploaded_files).replace("\"fileName\"", "fileName").replace("\"succeeded\"", "succeeded").replace("\"errors\"", "errors").replace("\"skipped\"", "skipped")
+    return f"""
+        mutation {{
+            updateBatch (
+                batchID: \"{batch_id}\", 
+                files: {file_array}, 
+                uploading: {uploading}
+                )
+            {{
+                _id,
+                submissionID,
+                type,
+                fileCount,
+                status,
+                updatedAt
+            }}
+        }}
+        """
+
+"""
+split files into batches, createBatch and updateBatch bodies of each batch are within the payload size limits.
+Errors of files are not known before uploading, each file reserves UPDATE_BATCH_ERRORS_RESERVE bytes for its errors.
+:param file_array: list of file names
+:return: list of (start, end) index ranges of file_array
+"""
+def split_batches(file_array, submission_id, upload_type):
+    create_size = create_base = len(create_batch_body(submission_id, upload_type, []).encode("utf-8"))
+    # batch id is an uuid
+    update_size = update_base = len(update_batch_body("0" * 36, None).encode("utf-8"))
+    batches = []
+    start = 0
+    for i, file_name in enumerate(file_array):
+        # file name and separator ", " in the list
+        file_create_size = len(json.dumps(file_name).encode("utf-8")) + 2
+        file_update_size = len(json.dumps({"fileName": file_name, "succeeded": False, "errors": [], "skipped": False}).encode("utf-8")) + 2 + UPDATE_BATCH_ERRORS_RESERVE
+        if i > start and (create_size + file_create_size > MAX_CREATE_BATCH_PAYLOAD_SIZE or update_size + file_update_size > MAX_UPDATE_BATCH_PAYLOAD_SIZE):
+            batches.append((start, i))
+            start = i
+            create_size, update_size = create_base, update_base
+        create_size += file_create_size
+        update_size += file_update_size
+    if start < len(file_array):
+        batches.append((start, len(file_array)))
+    return batches
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import csv
+from collections.abc import Mapping
+
+"""
+class: ManifestHeader cleans up the header of a manifest once, the same way as clean_up_key_value does for each row,
+column names are stripped, empty column names are removed and the last one of duplicated column names wins.
+"""
+class ManifestHeader:
+    __slots__ = ('raw_columns', 'columns', 'index', 'positions')
+
+    def __init__(self, raw_columns):
+        self.raw_columns = raw_columns
+        positions = {}
+        for position, column in enumerate(raw_columns):
+            if not column or not column.strip():
+                continue
+            positions[column.strip()] = position
+        self.columns = tuple(positions)
+        self.index = {column: i for i, column in enumerate(self.columns)}
+        self.positions = tuple(positions.values())
+
+    def clean_values(self, raw_values):
+        values = []
+        for position in self.positions:
+            # missing values of a short row are None, same as csv.DictReader
+            value = raw_values[position] if position < len(raw_values) else None
+            values.append(value.strip() if value else value)
+        return values
+
+"""
+class: ManifestRow is a read only row of manifest, it shares the header with other rows and only keeps the values,
+it can be used as a dict of cleaned column name and value.
+"""
+class ManifestRow(Mapping):
+    __slots__ = ('header', 'values_')
+
+    def __init__(self, header, values):
+        self.header = header
+        self.values_ = values
+
+    def __getitem__(self, column):
+        return self.values_[self.header.index[column]]
+
+    def __iter__(self):
+        return iter(self.header.columns)
+
+    def __len__(self):
+        return len(self.header.columns)
+
+    def __contains__(self, column):
+        return column in self.header.index
+
+    def __repr__(self):
+        return f"ManifestRow({dict(self)})"
+
+"""
+class: ManifestReader reads a tab separated manifest file row by row, rows are streamed to the caller.
+The header is available after iterating is started.
+"""
+class ManifestReader:
+    def __init__(self, manifest_path, lowercase_columns=()):
+        """
+        :param manifest_path: manifest file path
+        :param lowercase_columns: columns whose values are converted to lowercase, like md5
+        """
+        self.manifest_path = manifest_path
+        self.lowercase_columns = lowercase_columns
+        self.header = None
+
+    def __iter__(self):
+        with open(self.manifest_path, mode='r', encoding='utf-8') as f:
+            reader = csv.reader(f, delimiter='\t')
+            self.header = ManifestHeader(next(reader, []))
+            lowercase_index = [self.header.index[column] for column in self.lowercase_columns if column in self.header.index]
+            for raw_values in reader:
+                # skip blank lines, same as csv.DictReader
+                if not raw_values:
+                    continue
+                values = self.header.clean_values(raw_values)
+                for i in lowercase_index:
+                    if values[i]:
+                        values[i] = values[i].lower()
+                yield ManifestRow(self.header, tuple(values))
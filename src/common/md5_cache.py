@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import os
+import time
+import sqlite3
+import threading
+from common.constants import MD5_CACHE_DIR, MD5_CACHE_FILE
+
+MAX_CACHE_ENTRIES = 1_000_000
+
+"""
+class: Md5Cache stores md5 of local files in a SQLite database, so files are not hashed again by later runs.
+An entry is keyed by file path and is valid only if size, modified time (ns) and inode of the file are not changed,
+a stale entry is removed when it is found. Entries of deleted files and least recently used entries are evicted
+when the number of entries exceeds the cap.
+The database also records zip files whose contents passed validation, keyed by md5 of the zip file and digest of
+its files in archive manifest, so a changed zip file or archive manifest is validated again.
+"""
+class Md5Cache:
+    def __init__(self, cache_dir=MD5_CACHE_DIR, cache_file=MD5_CACHE_FILE, max_entries=MAX_CACHE_ENTRIES):
+        self.path = os.path.join(cache_dir, cache_file)
+        self.max_entries = max_entries
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # connect at first use, the cache is shared by validator and uploader threads
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            # write-ahead log, a committed md5 survives the run being killed
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS md5_cache (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                md5 TEXT NOT NULL,
+                used_at REAL NOT NULL)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_md5_cache_used_at ON md5_cache (used_at)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS validated_zip (
+                zip_md5 TEXT NOT NULL,
+                manifest_digest TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (zip_md5, manifest_digest))""")
+        return self.conn
+
+    """
+    get cached md5 of a file
+    :param file_path: file path
+    :param file_stat: os.stat_result of the file, optional
+    :return: md5 hex string or None if not cached or the file is changed
+    """
+    def get(self, file_path, file_stat=None):
+        file_stat = file_stat or os.stat(file_path)
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute("SELECT size, mtime_ns, inode, md5 FROM md5_cache WHERE path = ?", (file_path,)).fetchone()
+            if not row:
+                return None
+            if row[:3] != (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+                conn.execute("DELETE FROM md5_cache WHERE path = ?", (file_path,))
+                return None
+            conn.execute("UPDATE md5_cache SET used_at = ? WHERE path = ?", (time.time(), file_path))
+            return row[3]
+
+    """
+    save md5 of a file to the cache, committed at once so an interrupted run can resume from it
+    :param file_path: file path
+    :param md5: md5 hex string
+    :param file_stat: os.stat_result of the file taken before hashing, optional
+    """
+    def put(self, file_path, md5, file_stat=None):
+        file_stat = file_stat or os.stat(file_path)
+        with self.lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO md5_cache (path, size, mtime_ns, inode, md5, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (file_path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, md5, time.time()))
+            conn.commit()
+
+    """
+    check if contents of a zip file have been validated against the same archive manifest
+    :param zip_md5: md5 of the zip file
+    :param manifest_digest: digest of the files of the zip file in archive manifest
+    :return: True if validated
+    """
+    def is_zip_validated(self, zip_md5, manifest_digest):
+        with self.lock:
+            conn = self._connect()
+            cursor = conn.execute("UPDATE validated_zip SET used_at = ? WHERE zip_md5 = ? AND manifest_digest = ?",
+                                  (time.time(), zip_md5, manifest_digest))
+            return cursor.rowcount > 0
+
+    """
+    record a zip file whose contents passed validation
+    :param zip_md5: md5 of the zip file
+    :param manifest_digest: digest of the files of the zip file in archive manifest
+    """
+    def add_validated_zip(self, zip_md5, manifest_digest):
+        with self.lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO validated_zip (zip_md5, manifest_digest, used_at) VALUES (?, ?, ?)",
+                         (zip_md5, manifest_digest, time.time()))
+            conn.commit()
+
+    """
+    commit changes and evict entries over the cap
+    """
+    def save(self):
+        with self.lock:
+            if self.conn is None:
+                return
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM validated_zip").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM validated_zip WHERE rowid IN (SELECT rowid FROM validated_zip ORDER BY used_at, rowid LIMIT ?)",
+                              (count - self.max_entries,))
+        count = self.conn.execute("SELECT COUNT(*) FROM md5_cache").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # entries of deleted files go first
+        deleted = [(path,) for (path,) in self.conn.execute("SELECT path FROM md5_cache") if not os.path.isfile(path)]
+        self.conn.executemany("DELETE FROM md5_cache WHERE path = ?", deleted)
+        count -= len(deleted)
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM md5_cache WHERE path IN (SELECT path FROM md5_cache ORDER BY used_at, rowid LIMIT ?)",
+                              (count - self.max_entries,))
+
+    def close(self):
+        self.save()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -1,16 +1,19 @@
 import hashlib
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from common.progress_bar import create_progress_bar
 
 # Constants
 DEFAULT_CHUNK_SIZE = 1024*10  # Default chunk size for small files
 LARGE_FILE_CHUNK_SIZE = 1024*1024  # 64 KB chunk size for large files
 
-def calculate_file_md5(file_path, file_size, log):
+def calculate_file_md5(file_path, file_size, log, progress=None, task=None):
     """
     Calculate the MD5 checksum of a file.
     Dynamically adjusts chunk size based on file size.
-    Displays progress in a bar format.
-    Returns md5_hash.
+    Displays progress in a bar format, or advances the given task of a shared progress bar.
+    Returns md5_hash, None if the file can't be read, the md5 of a partially read file is never returned.
     """
     md5_hash = hashlib.md5()
 
@@ -19,6 +22,21 @@ def calculate_file_md5(file_path, file_size, log):
         chunk_size = LARGE_FILE_CHUNK_SIZE
     else:
         chunk_size = DEFAULT_CHUNK_SIZE if file_size > DEFAULT_CHUNK_SIZE else file_size
+    if progress is not None:
+        # hashed with other files concurrently, progress is shown by the shared bar
+        try:
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    md5_hash.update(chunk)
+                    progress.update(task, advance=len(chunk))
+        except Exception as e:
+            log.error(f'Failed to calculate md5 of the data file, {file_path}: {e}')
+            return None
+        return md5_hash.hexdigest()
+
     log.info(f'Start to calculate md5 of the data file, {file_path}...')
     try:
         with open(file_path, 'rb') as f, create_progress_bar() as progress:
@@ -32,5 +50,41 @@ def calculate_file_md5(file_path, file_size, log):
             progress.update(task, completed=file_size)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        log.error(f'Failed to calculate md5 of the data file, {file_path}: {e}')
+        return None
     return md5_hash.hexdigest()
+
+def calculate_zip_members_md5(zip_path, members, threads=1):
+    """
+    Calculate the MD5 checksums of files in a zip file by streaming them, files are not extracted to disk.
+    Files are hashed concurrently by the threads, each thread reads the zip file with its own handle.
+    Displays progress of all files in a bar format.
+    Returns list of md5_hash in the order of members.
+    """
+    local = threading.local()
+    zip_files = []
+    lock = threading.Lock()
+
+    def calculate_member_md5(member):
+        zip_file = getattr(local, 'zip_file', None)
+        if zip_file is None:
+            zip_file = local.zip_file = zipfile.ZipFile(zip_path, 'r', metadata_encoding='utf-8')
+            with lock:
+                zip_files.append(zip_file)
+        md5_hash = hashlib.md5()
+        with zip_file.open(member) as f:
+            while True:
+                chunk = f.read(LARGE_FILE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                md5_hash.update(chunk)
+                progress.update(task, advance=len(chunk))
+        return md5_hash.hexdigest()
+
+    try:
+        with create_progress_bar() as progress, ThreadPoolExecutor(max_workers=threads) as executor:
+            task = progress.add_task("Calculating MD5", total=sum(member.file_size for member in members))
+            return list(executor.map(calculate_member_md5, members))
+    finally:
+        for zip_file in zip_files:
+            zip_file.close()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+import threading
+
+"""
+class: MemoryBudget caps the bytes of file contents held in memory by all uploading workers,
+files put in one request and parts of large files read ahead for uploading.
+Bytes are acquired before they are read and released after they are uploaded or dropped,
+a reader waits until enough bytes are released by others.
+"""
+class MemoryBudget:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self.condition = threading.Condition()
+
+    """
+    wait until the bytes fit in the budget, then hold them
+    :param size: bytes to read into memory
+    """
+    def acquire(self, size):
+        with self.condition:
+            # always let one go when nothing is held, even if it is bigger than the budget
+            self.condition.wait_for(lambda: self.used_bytes == 0 or self.used_bytes + size <= self.budget_bytes)
+            self.used_bytes += size
+
+    """
+    release the bytes held by acquire
+    :param size: bytes not in memory any more
+    """
+    def release(self, size):
+        with self.condition:
+            self.used_bytes -= size
+            self.condition.notify_all()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import os
+import json
+import hashlib
+from common.constants import MULTIPART_JOURNAL_DIR
+
+"""
+class: MultipartJournal records a multipart upload on disk, so an interrupted upload can be resumed by a later run.
+The journal is keyed by destination bucket and key, file size and file modified time, any change of the source file starts a new upload.
+The first line of the journal file is the upload information, each following line is an uploaded part, appended as soon as the part is uploaded.
+"""
+class MultipartJournal:
+    def __init__(self, bucket_name, key, file_size, modified_at):
+        journal_id = hashlib.md5(f"{bucket_name}/{key}|{file_size}|{modified_at}".encode("utf-8")).hexdigest()
+        self.path = os.path.join(MULTIPART_JOURNAL_DIR, f"{journal_id}.journal")
+        self.key = key
+        self.upload_id = None
+        self.part_size = None
+        self.parts = {}  # part number -> ETag
+
+    """
+    load upload id, part size and uploaded parts from the journal file
+    :return: True if a journal of an unfinished upload exists
+    """
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                info = json.loads(f.readline())
+                if info.get("key") != self.key:
+                    return False
+                self.upload_id = info["upload_id"]
+                self.part_size = info["part_size"]
+                for line in f:
+                    # skip the last line if it was partially written
+                    if not line.endswith("\n"):
+                        break
+                    part_number, etag = line.rstrip("\n").split("\t")
+                    self.parts[int(part_number)] = etag
+            return True
+        except Exception:
+            return False
+
+    """
+    start a new journal for a new upload
+    """
+    def start(self, upload_id, part_size):
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.parts = {}
+        os.makedirs(MULTIPART_JOURNAL_DIR, exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"key": self.key, "upload_id": upload_id, "part_size": part_size}) + "\n")
+
+    """
+    append an uploaded part to the journal
+    """
+    def add_part(self, part_number, etag):
+        self.parts[part_number] = etag
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(f"{part_number}\t{etag}\n")
+
+    """
+    remove the journal after the upload is completed or can't be resumed any more
+    """
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
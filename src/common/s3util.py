@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 import os
+import json
 import math
+import base64
+import hashlib
 import boto3
 import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import BinaryIO, List
 import time
 
 from botocore.exceptions import ClientError
 
 from bento.common.utils import get_logger
-from common.constants import ACCESS_KEY_ID, SECRET_KEY, SESSION_TOKEN, TEMP_CREDENTIAL, TEMP_TOKEN_EXPIRATION
+from common.constants import ACCESS_KEY_ID, SECRET_KEY, SESSION_TOKEN, TEMP_CREDENTIAL, TEMP_TOKEN_EXPIRATION, PART_THREADS
 from common.progress_bar import create_progress_bar, ProgressCallback
 from common.graphql_client import APIInvoker
 from common.utils import convert_string_to_date_time
@@ -17,6 +23,15 @@ from common.utils import convert_string_to_date_time
 BUCKET_OWNER_ACL = 'bucket-owner-full-control'
 SINGLE_PUT_LIMIT = 5 * 1024 * 1024 * 1024  # 5GB
 MAX_PART_NUMBER = 9999
+DEFAULT_PART_THREADS = 4
+PART_RETRIES = 2
+PART_RETRY_DELAY = 5  # seconds, doubled for each retry
+LIST_THREADS = 8
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024  # 8MB
+DOWNLOAD_RETRIES = 3
+SNIFF_SIZE = 8 * 1024  # 8KB
+MAX_SNIFF_SIZE = 1024 * 1024  # 1MB
+PART_INFO_SUFFIX = '.part.json'
 
 class S3Bucket:
     def __init__(self):
@@ -24,6 +39,9 @@ class S3Bucket:
         self.parts: List[dict] = []
         self.configs = None
         self.expiration = None
+        self.upload_id = None
+        self.token_lock = threading.Lock()
+        self.memory_budget = None # MemoryBudget shared by uploading workers, parts read ahead are held in it
 
     def set_s3_client(self, bucket, configs):
         self.bucket_name = bucket
@@ -81,27 +99,40 @@ class S3Bucket:
                 self.log.exception(e)
                 return False, msg  
 
-    def put_file_obj(self, file_size, key, data, md5_base64):
+    def put_file_obj(self, file_size, key, data, md5_base64, file_name=None):
+        """
+        Put a file in one request with Content-MD5
+        :return: response of the put
+        """
         # Initialize the progress bar
         progress = create_progress_bar()
         task = progress.add_task("uploading task", total=file_size)
         if file_size > SINGLE_PUT_LIMIT:
             raise Exception(f"File size {file_size} exceeds single put limit of {SINGLE_PUT_LIMIT} bytes. Use upload_file_obj instead.")
-
+        extra_args = {'ContentDisposition': f'attachment; filename="{file_name}"'} if file_name else {}
+        if self.is_token_expired():
+            self.refreshToken()
         try:
             with progress:
-                self.bucket.put_object(
+                # S3 rejects the object if the content doesn't match the md5
+                response = self.client.put_object(
+                    Bucket=self.bucket_name,
                     Key=key,
                     Body=data,
                     ACL=BUCKET_OWNER_ACL,
+                    ContentMD5=md5_base64,
+                    **extra_args
                 )
                 progress.update(task, advance=file_size)
+            return response
         finally:
             progress.stop()
 
-    def upload_file_obj(self, stream, key, progress_callback, file_name, config=None, extra_args={'ACL': BUCKET_OWNER_ACL}):
+    def upload_file_obj(self, stream, key, progress_callback, file_name, config=None, extra_args=None):
         if self.is_token_expired():
             self.refreshToken()
+        # don't update a shared default dict, files are uploaded concurrently
+        extra_args = dict(extra_args) if extra_args else {'ACL': BUCKET_OWNER_ACL}
         extra_args.update({'ContentDisposition': f'attachment; filename="{file_name}"'})
         self.bucket.upload_fileobj(
             stream, key, ExtraArgs=extra_args, Config=config, Callback=progress_callback)
@@ -126,6 +157,59 @@ class S3Bucket:
                 self.log.exception(e)
                 return None, msg  
 
+    def get_object_info(self, key):
+        """
+        Get size and ETag of an object
+        :param key: object key
+        :return: size, ETag without quotes, error message
+        """
+        try:
+            res = self.client.head_object(Bucket=self.bucket_name, Key=key)
+            return res['ContentLength'], res['ETag'].strip('"'), None
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', '412']:
+                return None, None, f'File {key} does not exist in the specified S3 bucket path.'
+            if e.response['Error']['Code'] in ['403']:
+                return None, None, f'Access Denied: Unable to access files in the specified S3 bucket path: {key}'
+            self.log.exception(e)
+            return None, None, f'Unknown S3 client error!'
+
+    def get_object_index(self, prefix, threads=LIST_THREADS):
+        """
+        List all objects under the prefix once, sub-prefixes (folders) of the prefix are listed concurrently
+        :param prefix: key prefix
+        :param threads: number of sub-prefixes listed at the same time
+        :return: dict of object key -> (size, ETag), None if objects can't be listed
+        """
+        index = {}
+        try:
+            sub_prefixes = []
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter='/'):
+                add_objects_to_index(index, page)
+                sub_prefixes.extend(sub_prefix['Prefix'] for sub_prefix in page.get('CommonPrefixes', []))
+            if sub_prefixes:
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    for sub_index in executor.map(self.list_objects, sub_prefixes):
+                        index.update(sub_index)
+            return index
+        except Exception as e:
+            self.log.debug(e)
+            self.log.info(f"Failed to list objects in {self.bucket_name}/{prefix}.")
+            return None
+
+    def list_objects(self, prefix):
+        """
+        List all objects under the prefix with paginated list_objects_v2
+        :param prefix: key prefix
+        :return: dict of object key -> (size, ETag)
+        """
+        index = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            add_objects_to_index(index, page)
+        return index
+
     def same_size_file_exists(self, key, file_size):
         file_size1, msg = self.get_object_size(key)
         if msg:
@@ -141,11 +225,11 @@ class S3Bucket:
                 progress_callback = ProgressCallback(file_size, progress, task_id)
                 # Use download_fileobj instead of download_file to avoid Windows path issues
                 # with temporary file rename operations on files with special characters
-                s3_object = self.s3.Object(self.bucket_name, key)
                 # Create parent directories if they don't exist
                 os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
                 with open(local_file_path, 'wb') as f:
-                    s3_object.download_fileobj(f, Callback=progress_callback)
+                    # the client, not a resource, objects may be downloaded by several threads
+                    self.client.download_fileobj(self.bucket_name, key, f, Callback=progress_callback)
             return True, None
         except ClientError as ce:
             msg = None
@@ -164,6 +248,133 @@ class S3Bucket:
             self.log.error(e)
             return False, msg
         
+    def download_object_with_md5(self, key, local_file_path):
+        """
+        Download an object with ranged GETs in parallel, the ranges are written to the file in order
+        and hashed while they are written, so the downloaded file doesn't need to be read again for md5.
+        ETag of the object is saved in a sidecar file next to the partial file, a partially downloaded file is
+        resumed from its last byte only if it is of the same ETag, otherwise it is downloaded again from the first byte.
+        Every ranged GET is sent with IfMatch of the ETag, a failed range is retried from the last written byte.
+        :param key: object key
+        :param local_file_path: path of downloaded file
+        :return: md5 hex string of the file or None if failed, error message
+        """
+        file_size, etag, msg = self.get_object_info(key)
+        if msg:
+            return None, msg
+        if file_size == 0:
+            return None, f'File size is 0 for {key}'
+        part_info_path = local_file_path + PART_INFO_SUFFIX
+        try:
+            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+            md5 = hashlib.md5()
+            offset = os.path.getsize(local_file_path) if os.path.isfile(local_file_path) else 0
+            if offset and (offset > file_size or read_part_info(part_info_path) != etag):
+                # not a partial file of the same object
+                self.log.info(f"Partially downloaded {key} is not of the same object, download it again.")
+                os.remove(local_file_path)
+                offset = 0
+            if not offset:
+                write_part_info(part_info_path, etag)
+            else:
+                self.log.info(f"Resume downloading {key} from byte {offset}.")
+                with open(local_file_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_PART_SIZE), b''):
+                        md5.update(chunk)
+            with create_progress_bar() as progress, open(local_file_path, 'ab') as f:
+                task_id = progress.add_task("Downloading object...", total=file_size, completed=offset)
+                failed_count = 0
+                while True:
+                    try:
+                        self.download_ranges(key, f, md5, f.tell(), file_size, lambda length: progress.update(task_id, advance=length), etag)
+                        break
+                    except Exception as e:
+                        if isinstance(e, ClientError) and e.response['Error']['Code'] in ['403', '404', '412', 'PreconditionFailed']:
+                            raise
+                        failed_count += 1
+                        if failed_count > DOWNLOAD_RETRIES:
+                            raise
+                        f.flush()
+                        self.log.info(f"Failed to download {key}, {e}, retry from byte {f.tell()}.")
+            remove_file(part_info_path)
+            return md5.hexdigest(), None
+        except ClientError as ce:
+            if ce.response['Error']['Code'] in ['412', 'PreconditionFailed']:
+                # the object is overwritten while downloading, the partial file can't be resumed
+                remove_file(local_file_path)
+                remove_file(part_info_path)
+                return None, f'File {key} was changed in the specified S3 bucket path while downloading.'
+            if ce.response['Error']['Code'] in ['404']:
+                return None, f'File {key} does not exist in the specified S3 bucket path.'
+            if ce.response['Error']['Code'] in ['403']:
+                return None, f'Access Denied: Unable to access files in the specified S3 bucket path: {key}'
+            self.log.exception(ce)
+            return None, f'Unknown S3 client error!'
+        except Exception as e:
+            self.log.error(e)
+            return None, f'Unknown error!'
+
+    def download_ranges(self, key, f, md5, offset, file_size, progress_callback, etag=None):
+        """
+        Download the object from offset to the end with ranged GETs by a pool of workers,
+        at most two ranges per worker are held in memory waiting for the ranges before them.
+        If etag is given, a range of a changed object fails with PreconditionFailed.
+        """
+        threads = self.get_part_threads()
+        running = deque()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            try:
+                next_offset = offset
+                while next_offset < file_size or running:
+                    while next_offset < file_size and len(running) < threads * 2:
+                        end = min(next_offset + DOWNLOAD_PART_SIZE, file_size) - 1
+                        running.append((executor.submit(self.get_object_range, key, next_offset, end, etag), end - next_offset + 1))
+                        next_offset = end + 1
+                    future, length = running.popleft()
+                    data = future.result()
+                    if len(data) != length:
+                        raise Exception(f"Received {len(data)} bytes of {length} bytes, the object may be changed.")
+                    f.write(data)
+                    md5.update(data)
+                    progress_callback(length)
+            except BaseException:
+                # don't start ranges which are still waiting in the pool
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+
+    def get_object_range(self, key, first_byte, last_byte, etag=None):
+        extra_args = {'IfMatch': f'"{etag}"'} if etag else {}
+        response = self.client.get_object(Bucket=self.bucket_name, Key=key, Range=f'bytes={first_byte}-{last_byte}', **extra_args)
+        return response['Body'].read()
+
+    def get_object_first_line(self, key):
+        """
+        Get the first line of an object, like the header of a tsv file, without downloading the object.
+        The first SNIFF_SIZE bytes are read with a ranged GET, the range is doubled until a line break is found.
+        :param key: object key
+        :return: first line of the object, None if the object can't be read
+        """
+        size = SNIFF_SIZE
+        try:
+            while True:
+                data = self.get_object_range(key, 0, size - 1)
+                end = data.find(b'\n')
+                if end >= 0:
+                    data = data[:end + 1]
+                    break
+                # the whole object is read or the line is too long
+                if len(data) < size or size >= MAX_SNIFF_SIZE:
+                    break
+                size *= 2
+            return data.decode('utf-8', errors='replace')
+        except ClientError as e:
+            # range of an empty object is not satisfiable
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return ''
+            self.log.debug(e)
+            self.log.info(f"Failed to read {key} in {self.bucket_name}.")
+            return None
+
     # get contents info from s3 folder
     def get_contents(self, prefix):
         contents = []
@@ -211,70 +422,202 @@ class S3Bucket:
         return datetime.datetime.now(datetime.timezone.utc) > (expiration - datetime.timedelta(seconds=buffer_seconds))
 
     # start manual multipart upload section
-    # Upload a large file (size > 5 GB) in parts
-    def upload_large_file_partly(self, fileobj: BinaryIO, key, size, progress_callback):
+    # Upload a large file in parts, parts are uploaded concurrently by a pool of workers.
+    # At most two parts per worker are read ahead, and only if they fit in the memory budget shared by uploading workers.
+    # If a journal is given, uploaded parts are recorded in it and an unfinished upload in the journal is resumed,
+    # the multipart upload is kept instead of aborted on failure.
+    # Return the total size of the parts and the response of completing the upload.
+    def upload_large_file_partly(self, fileobj: BinaryIO, key, size, progress_callback, part_size=None, journal=None, extra_args=None):
         self.parts = []
-        part_size = self.calculate_part_size(size)
+        self.upload_id = None
+        if not part_size:
+            part_size = self.calculate_part_size(size)
+        threads = self.get_part_threads()
+        max_parts_in_memory = threads * 2
+        uploaded_size = 0
         try:
-            self.initiate_multipart_upload(key)
+            uploaded_parts = self.resume_multipart_upload(key, part_size, journal)
+            if uploaded_parts is None:
+                uploaded_parts = {}
+                self.initiate_multipart_upload(key, extra_args)
+                if journal:
+                    journal.start(self.upload_id, part_size)
             total_parts = math.ceil(size / part_size)
-            for part_number in range(1, total_parts + 1):
-                data = fileobj.read(part_size)
-                if not data:
-                    break
-                result = self.upload_part(part_number, data, key)  # must raise on error
-                self.parts.append(result)
-                progress_callback(len(data))
+            part_number = 1
+            running = {}
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                try:
+                    while part_number <= total_parts or running:
+                        while part_number <= total_parts and len(running) < max_parts_in_memory:
+                            offset = (part_number - 1) * part_size
+                            length = min(part_size, size - offset)
+                            uploaded = uploaded_parts.get(part_number)
+                            if uploaded and uploaded['Size'] == length:
+                                self.parts.append({'PartNumber': part_number, 'ETag': uploaded['ETag']})
+                                uploaded_size += length
+                                progress_callback(length)
+                                part_number += 1
+                                continue
+                            if fileobj.tell() != offset:
+                                fileobj.seek(offset)
+                            self.acquire_memory(length)
+                            try:
+                                data = fileobj.read(part_size)
+                            except BaseException:
+                                self.release_memory(length)
+                                raise
+                            if not data:
+                                self.release_memory(length)
+                                total_parts = part_number - 1
+                                break
+                            future = executor.submit(self.upload_part, part_number, data, key)
+                            # released when the part is uploaded, failed or cancelled
+                            future.add_done_callback(lambda _, length=length: self.release_memory(length))
+                            running[future] = len(data)
+                            part_number += 1
+                        if not running:
+                            break
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            length = running.pop(future)
+                            part = future.result()  # raise on error
+                            self.parts.append(part)
+                            if journal:
+                                journal.add_part(part['PartNumber'], part['ETag'])
+                            uploaded_size += length
+                            progress_callback(length)
+                except BaseException:
+                    # don't start parts which are still waiting in the pool
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
 
-            self.complete_upload(key)
+            response = self.complete_upload(key)
+            if journal:
+                journal.remove()
+            return uploaded_size, response
 
         except Exception as e:
             self.log.error(f"Failed to upload large file, {e}.")
-            self.abort_upload(key)
+            if journal and self.upload_id:
+                self.log.info(f"Uploaded parts are kept, uploading {key} will be resumed in next run.")
+            else:
+                self.abort_upload(key)
             raise
 
-    def initiate_multipart_upload(self, key):
-        response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key)
+    def resume_multipart_upload(self, key, part_size, journal):
+        """
+        Resume the unfinished multipart upload recorded in the journal.
+        Parts already uploaded are retrieved from S3, the journal only provides the upload id.
+        :return: dict of uploaded parts by part number, or None if there is nothing to resume
+        """
+        if not journal or not journal.load():
+            return None
+        if journal.part_size != part_size:
+            journal.remove()
+            return None
+        try:
+            uploaded_parts = {}
+            paginator = self.client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=key, UploadId=journal.upload_id):
+                for part in page.get('Parts', []):
+                    uploaded_parts[part['PartNumber']] = part
+        except ClientError as e:
+            # the upload is completed, aborted or expired.
+            self.log.info(f"Can't resume uploading {key}, {e.response['Error']['Code']}, start a new upload.")
+            journal.remove()
+            return None
+        self.upload_id = journal.upload_id
+        self.log.info(f"Resume uploading {key}, {len(uploaded_parts)} parts have been uploaded.")
+        return uploaded_parts
+
+    def copy_object_from(self, source_bucket, source_key, key, size, extra_args=None):
+        """
+        Copy an object from the source bucket to this bucket on the server side with one copy_object request.
+        Only objects put in one request, up to 5GB, are copied, their ETag is the md5 to verify against.
+        :param source_bucket: source bucket name
+        :param source_key: object key in the source bucket
+        :param key: destination object key
+        :param size: object size
+        :return: response of copy_object
+        """
+        if size > SINGLE_PUT_LIMIT:
+            raise Exception(f"File size {size} exceeds single copy limit of {SINGLE_PUT_LIMIT} bytes.")
+        if self.is_token_expired():
+            with self.token_lock:
+                if self.is_token_expired():
+                    self.refreshToken()
+        copy_source = {'Bucket': source_bucket, 'Key': source_key}
+        return self.client.copy_object(CopySource=copy_source, Bucket=self.bucket_name, Key=key,
+                                       MetadataDirective='REPLACE', **(extra_args or {}))
+
+    def acquire_memory(self, size):
+        if self.memory_budget:
+            self.memory_budget.acquire(size)
+
+    def release_memory(self, size):
+        if self.memory_budget:
+            self.memory_budget.release(size)
+
+    def get_part_threads(self):
+        threads = self.configs.get(PART_THREADS) if self.configs else None
+        return threads if threads else DEFAULT_PART_THREADS
+
+    def initiate_multipart_upload(self, key, extra_args=None):
+        response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **(extra_args or {}))
         if 'UploadId' not in response:
             raise Exception("Failed to initiate multipart upload.")
         
         self.upload_id = response['UploadId']
 
-    def upload_part(self, part_number, data, key, failed_count = 0):
-        if self.is_token_expired():
-            self.refreshToken()
-        try:
-            response = self.client.upload_part(
-                Bucket=self.bucket_name,
-                Key=key,
-                UploadId=self.upload_id,
-                PartNumber=part_number,
-                Body=data
-            )
-            return {
-                'PartNumber': part_number,
-                'ETag': response['ETag']
-            }
-        except Exception as e:
-            failed_count += 1
-            if failed_count > 2:
-                self.log.error(f"Failed to upload part {part_number}, {e}.")
-                self.abort_upload(key)
-                raise
-            else:
-                # wait 5minutes before retrying
-                time.sleep(300)  # wait for 5 minutes
-                self.set_s3_client(self.bucket_name, self.configs) #reset the client if client connection is lost
-                return self.upload_part(part_number, data, key, failed_count)
+    def upload_part(self, part_number, data, key):
+        """
+        Upload a part, a failed part is retried on its own with backoff on the same client,
+        the client is shared by the other parts being uploaded.
+        """
+        content_md5 = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+        failed_count = 0
+        while True:
+            if self.is_token_expired():
+                # parts are uploaded concurrently, only one of them refreshes the token
+                with self.token_lock:
+                    if self.is_token_expired():
+                        self.refreshToken()
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    UploadId=self.upload_id,
+                    PartNumber=part_number,
+                    Body=data,
+                    ContentMD5=content_md5
+                )
+                return {
+                    'PartNumber': part_number,
+                    'ETag': response['ETag']
+                }
+            except Exception as e:
+                failed_count += 1
+                if failed_count > PART_RETRIES:
+                    # the caller aborts the whole multipart upload
+                    self.log.error(f"Failed to upload part {part_number}, {e}.")
+                    raise
+                delay = PART_RETRY_DELAY * 2 ** (failed_count - 1)
+                self.log.info(f"Failed to upload part {part_number}, {e}, retry in {delay} seconds.")
+                time.sleep(delay)
 
     def complete_upload(self, key):
+        """
+        Complete the multipart upload with the uploaded parts
+        :return: response of completing the upload
+        """
         self.parts.sort(key=lambda x: x['PartNumber'])
-        self.client.complete_multipart_upload(
+        response = self.client.complete_multipart_upload(
             Bucket=self.bucket_name,
             Key=key,
             UploadId=self.upload_id,
             MultipartUpload={'Parts': self.parts}
         )
+        return response
 
     def abort_upload(self, key):
         if self.upload_id:
@@ -297,3 +640,43 @@ class S3Bucket:
 
         
 
+def add_objects_to_index(index, page):
+    for obj in page.get('Contents', []):
+        index[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+
+"""
+ETag of the object being downloaded is saved in a json file next to the partial file
+"""
+def read_part_info(part_info_path):
+    try:
+        with open(part_info_path, encoding='utf-8') as f:
+            return json.load(f).get('etag')
+    except Exception:
+        return None
+
+def write_part_info(part_info_path, etag):
+    with open(part_info_path, 'w', encoding='utf-8') as f:
+        json.dump({'etag': etag}, f)
+
+def remove_file(file_path):
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+
+"""
+get server-side encryption of an object in the response of a put, copy or completed upload,
+ETag of an object is md5 based only if it is not encrypted or encrypted by SSE-S3 (AES256)
+"""
+def get_encryption(response):
+    if response.get('SSECustomerAlgorithm'):
+        return 'SSE-C'
+    return response.get('ServerSideEncryption')
+
+def is_md5_etag(response):
+    return get_encryption(response) in (None, 'AES256')
+
+"""
+ETag S3 gives to an object uploaded in parts, md5 of the md5 of the parts followed by the number of parts
+"""
+def get_multipart_etag(parts):
+    digests = b''.join(bytes.fromhex(part['ETag'].strip('"')) for part in sorted(parts, key=lambda part: part['PartNumber']))
+    return f'{hashlib.md5(digests).hexdigest()}-{len(parts)}'
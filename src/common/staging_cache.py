@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import os
+import threading
+from collections import OrderedDict
+
+"""
+class: StagingCache keeps data files downloaded from s3 source and validated, until they are uploaded,
+so a retry of a failed upload reuses the local file instead of downloading it again.
+Disk budget is reserved for a file before it is downloaded, total size of staged files is kept within the budget.
+Files being downloaded, validated or uploaded are pinned, only unpinned files, the ones waiting for retry,
+are deleted to make room, the least recently staged first.
+"""
+class StagingCache:
+    def __init__(self, budget_bytes, log):
+        self.budget_bytes = budget_bytes
+        self.log = log
+        self.files = OrderedDict() # file path -> file size, in the order of staging
+        self.validated = set() # staged files passed validation
+        self.pinned = set() # staged files in use
+        self.staged_bytes = 0
+        self.lock = threading.Lock()
+
+    """
+    check if a validated file is staged and not changed, the file is pinned if it can be reused
+    :param file_path: path of downloaded file
+    :param file_size: file size in manifest
+    :return: True if the file can be uploaded without downloading and validating again
+    """
+    def reuse(self, file_path, file_size):
+        with self.lock:
+            if file_path not in self.validated or self.files.get(file_path) != file_size:
+                return False
+            if os.path.isfile(file_path) and os.path.getsize(file_path) == file_size:
+                self.files.move_to_end(file_path)
+                self.pinned.add(file_path)
+                return True
+            self._discard(file_path)
+            return False
+
+    """
+    reserve disk budget for a file to be downloaded, the file is pinned
+    :param file_path: path of downloaded file
+    :param file_size: file size in manifest
+    :param force: delete unpinned staged files to make room, and reserve even if the file doesn't fit in the budget
+    :return: True if reserved
+    """
+    def reserve(self, file_path, file_size, force=True):
+        with self.lock:
+            self._discard(file_path)
+            if force:
+                for staged_path in [path for path in self.files if path not in self.pinned]:
+                    if self.staged_bytes + file_size <= self.budget_bytes:
+                        break
+                    self.log.info(f"Staging disk budget is exceeded, delete downloaded file {staged_path}.")
+                    self._delete(staged_path)
+            elif self.staged_bytes + file_size > self.budget_bytes:
+                return False
+            self.files[file_path] = file_size
+            self.staged_bytes += file_size
+            self.pinned.add(file_path)
+            return True
+
+    """
+    mark a staged file validated, it can be reused by retries
+    :param file_path: path of downloaded file
+    """
+    def set_validated(self, file_path):
+        with self.lock:
+            if file_path in self.files:
+                self.validated.add(file_path)
+
+    """
+    unpin a staged file waiting for retry, it can be deleted to make room for other files
+    :param file_path: path of downloaded file
+    """
+    def release(self, file_path):
+        with self.lock:
+            self.pinned.discard(file_path)
+
+    """
+    delete a staged file, after it's uploaded, invalid or it failed finally
+    :param file_path: path of downloaded file
+    """
+    def remove(self, file_path):
+        with self.lock:
+            self._delete(file_path)
+
+    """
+    stop tracking a file, the file itself is kept or deleted by the caller
+    :param file_path: path of downloaded file
+    """
+    def discard(self, file_path):
+        with self.lock:
+            self._discard(file_path)
+
+    def _discard(self, file_path):
+        file_size = self.files.pop(file_path, None)
+        if file_size is not None:
+            self.staged_bytes -= file_size
+        self.validated.discard(file_path)
+        self.pinned.discard(file_path)
+
+    def _delete(self, file_path):
+        self._discard(file_path)
+        try:
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        except OSError as e:
+            self.log.error(f"Failed to delete temp file: {file_path} due to {str(e)}")
@@ -1,10 +1,15 @@
 
 import sys
 import csv
+import re
+import base64
 from uuid import UUID
 from datetime import datetime
 from common.constants import S3_START
 
+# lowercase canonical UUID of version 1 to 5, the same UUIDs as is_valid_uuid accepts
+VALID_UUID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[1-5][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}')
+
 
 def clean_up_key_value(dict):
     """
@@ -81,12 +86,20 @@ Dump list of dictionary to TSV file, caller needs handle exception.
 :param: file_path as str
 :return: boolean
 """
-def dump_dict_to_tsv(dict_list, file_path):
+def dump_dict_to_tsv(dict_list, file_path, exclude_keys=()):
+    """
+    dump list of dicts or file records to tsv file, columns are keys of all rows in order of appearance
+    :param exclude_keys: keys not written to the file, rows are not copied to remove them
+    """
     if not dict_list or len(dict_list) == 0:
         return False 
-    keys = dict_list[0].keys()
+    keys = {}
+    for row in dict_list:
+        for key in row:
+            if key not in keys and key not in exclude_keys:
+                keys[key] = None
     with open(file_path, 'w', encoding='utf-8') as output_file:
-        dict_writer = csv.DictWriter(output_file, fieldnames=keys, delimiter='\t')
+        dict_writer = csv.DictWriter(output_file, fieldnames=list(keys), delimiter='\t', extrasaction='ignore')
         dict_writer.writeheader()
         dict_writer.writerows(dict_list) 
     return True
@@ -213,6 +226,12 @@ def compare_version(available_version, self_version):
     else:
         return 1, msg
 
+def md5_hex_to_base64(md5_hex):
+    """
+    convert a hex md5 digest to base64 format used by Content-MD5 header
+    """
+    return base64.b64encode(bytes.fromhex(md5_hex)).decode("ascii")
+
 def convert_string_to_date_time(date_string, format = "%Y-%m-%dT%H:%M:%S.%fZ"):
     """
     convert date to format
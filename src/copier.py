@@ -1,15 +1,16 @@
 #!/bin/env python3
 import os
+import base64
 
-from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError, SSLError
 from bento.common.utils import get_logger, format_bytes, removeTrailingSlash, get_md5_hex_n_base64
 from common.progress_bar import create_progress_bar, ProgressCallback
 from common.graphql_client import APIInvoker
-from common.s3util import S3Bucket
+from common.s3util import S3Bucket, BUCKET_OWNER_ACL, get_multipart_etag, get_encryption, is_md5_etag
+from common.multipart_journal import MultipartJournal
 from common.constants import UPLOAD_TYPE, TYPE_FILE, TYPE_MATE_DATA, FILE_NAME_DEFAULT, FILE_SIZE_DEFAULT, TEMP_CREDENTIAL, FILE_PATH, \
-    ERRORS, SKIPPED, SUBFOLDER_FILE_NAME
-from common.utils import get_exception_msg, format_size
+    ERRORS, SKIPPED, SUBFOLDER_FILE_NAME, MD5_DEFAULT
+from common.utils import get_exception_msg, format_size, md5_hex_to_base64
 class Copier:
 
     TRANSFER_UNIT_MB = 1024 * 1024
@@ -26,11 +27,12 @@ class Copier:
     FIELDS = 'fields'
     ACL = 'acl'
 
-    def __init__(self, bucket_name, prefix, configs):
+    def __init__(self, bucket_name, prefix, configs, memory_budget=None):
 
         """"
         Copy file from URL or local file to S3 bucket
         :param bucket_name: string type
+        :param memory_budget: MemoryBudget of file contents held in memory, shared by uploading workers
         """
         self.configs = configs
         if not bucket_name:
@@ -39,6 +41,7 @@ class Copier:
         self.bucket = S3Bucket()
         #set s3 client based on credential and bucket.
         self.bucket.set_s3_client(self.bucket_name, configs)
+        self.bucket.memory_budget = memory_budget
          
         if prefix and isinstance(prefix, str):
             self.prefix = removeTrailingSlash(prefix)
@@ -50,6 +53,17 @@ class Copier:
         self.files_copied = 0
         self.files_not_found = set()
         self.type = configs.get(UPLOAD_TYPE)
+        self.s3_copy_denied = False
+        self.dest_index = None # object key -> (size, ETag) of existing files at destination
+
+    def load_dest_index(self):
+        """
+        List existing files under the prefix once, so skipping existing files doesn't need a HEAD request per file.
+        If the files can't be listed, existing files are checked one by one.
+        """
+        self.dest_index = self.bucket.get_object_index(f'{self.prefix}/')
+        if self.dest_index is not None:
+            self.log.info(f'Found {len(self.dest_index)} existing files in the cloud storage.')
 
     def set_prefix(self, raw_prefix):
         prefix = removeTrailingSlash(raw_prefix)
@@ -83,17 +97,12 @@ class Copier:
                 self.log.info(f'Uploading “{file_name}” skipped (dry run)')
                 return succeed
             
-            if not overwrite and self.bucket.same_size_file_exists(key, org_size):
-                self.log.info(f'Uploading “{file_name}” skipped - file with same name and size already exists in the cloud storage')
-                self.files_exist_at_dest += 1
-                file_info[SKIPPED] = True
+            if self._skip_existing_file(file_info, key, org_size, file_name, overwrite):
                 return succeed
-            else: 
-                file_info[SKIPPED] = False
             #self.log.info(f'Copying from {org_url} to s3://{self.bucket_name}/{key.strip("/")} ...')
             self.log.info(f'Uploading file, "{org_url}" to destination...')
             original_file_name = os.path.basename(file_info[FILE_NAME_DEFAULT])
-            dest_size = self._upload_obj(org_url, key, org_size, original_file_name)
+            dest_size = self._upload_obj(org_url, key, org_size, original_file_name, file_info.get(MD5_DEFAULT))
             if dest_size != org_size:
                 self.log.error(f'Uploading “{file_name}” failed - uploading was not complete. Please try again and contact the helpdesk if this error persists.')
                 return {self.STATUS: False}
@@ -122,28 +131,129 @@ class Copier:
             file_info[ERRORS] = [f"Uploading “{file_name}” failed - internal error."]
             return {self.STATUS: False}
 
-    def _upload_obj(self, org_url, key, org_size, file_name):
+    def copy_s3_object(self, file_info, source_bucket, source_key, overwrite, dryrun):
+        """
+        Copy a file from a source bucket to S3 bucket on the server side, without downloading it.
+        Errors are only logged, the caller is supposed to fall back to downloading and uploading the file.
+        :param file_info: dict that has file information
+        :param source_bucket: source bucket name
+        :param source_key: key of the file in the source bucket
+        :param overwrite: overwrite file in S3 bucket even existing file has same size
+        :param dryrun: only do preliminary check, don't copy file
+        :return: dict
+        """
+        file_name = file_info[FILE_NAME_DEFAULT] if not file_info.get(SUBFOLDER_FILE_NAME) else file_info[SUBFOLDER_FILE_NAME]
+        key = f'{self.prefix}/{file_name}'
+        org_size = file_info[FILE_SIZE_DEFAULT]
+        succeed = {self.STATUS: True,
+                   self.NAME: file_name,
+                   self.KEY: key,
+                   self.ACL: None,
+                   self.SIZE: org_size
+                   }
+        try:
+            if dryrun:
+                self.log.info(f'Copying “{file_name}” skipped (dry run)')
+                return succeed
+            if self._skip_existing_file(file_info, key, org_size, file_name, overwrite):
+                return succeed
+            self.log.info(f'Copying file, "s3://{source_bucket}/{source_key}" to destination...')
+            original_file_name = os.path.basename(file_info[FILE_NAME_DEFAULT])
+            extra_args = {'ACL': BUCKET_OWNER_ACL, 'ContentDisposition': f'attachment; filename="{original_file_name}"'}
+            response = self.bucket.copy_object_from(source_bucket, source_key, key, org_size, extra_args)
+            etag = response['CopyObjectResult']['ETag'].strip('"')
+            if not self._check_etag(file_name, etag, file_info[MD5_DEFAULT], response):
+                return {self.STATUS: False}
+            self.files_copied += 1
+            if self.dest_index is not None:
+                self.dest_index[key] = (org_size, etag)
+            return succeed
+        except ClientError as ce:
+            self.log.debug(ce)
+            if ce.response[u'Error'][u'Code'] in ['AccessDenied', '403']:
+                self.s3_copy_denied = True
+            elif ce.response[u'Error'][u'Code'] == 'ExpiredToken':
+                self.bucket.refreshToken()
+            self.log.error(f'Copying “{file_name}” failed - {ce.response[u"Error"][u"Code"]}.')
+            return {self.STATUS: False}
+        except Exception as e:
+            self.log.debug(e)
+            self.log.error(f'Copying “{file_name}” failed - internal error.')
+            return {self.STATUS: False}
+
+    def _skip_existing_file(self, file_info, key, org_size, file_name, overwrite):
+        """
+        Check if a file with same name and size already exists in the cloud storage
+        :return: True if uploading the file should be skipped
+        """
+        if overwrite:
+            exists = False
+        elif self.dest_index is not None:
+            exists = self.dest_index.get(key, (None,))[0] == org_size
+        else:
+            exists = self.bucket.same_size_file_exists(key, org_size)
+        if exists:
+            self.log.info(f'Uploading “{file_name}” skipped - file with same name and size already exists in the cloud storage')
+            self.files_exist_at_dest += 1
+            file_info[SKIPPED] = True
+            return True
+        file_info[SKIPPED] = False
+        return False
 
-        if self.type == TYPE_FILE or org_size > self.SINGLE_PUT_LIMIT: #study files upload (big files)    
+    def _upload_obj(self, org_url, key, org_size, file_name, md5=None):
+        """
+        Upload a local file, the content is checked by S3 with Content-MD5 of the file or of each part,
+        the ETag in the response of the put or completed multipart upload is also checked if it is md5 based
+        :return: uploaded size, None if the ETag doesn't match the uploaded content
+        """
+        # md5 validated by file validator is sent as Content-MD5, the file is not hashed again before uploading
+        md5_base64 = md5_hex_to_base64(md5) if md5 else None
+        if (self.type == TYPE_FILE or org_size > self.SINGLE_PUT_LIMIT) and org_size > self.MULTI_PART_THRESHOLD: #study files upload (big files)
             parts = int(org_size) // self.MULTI_PART_CHUNK_SIZE
             chunk_size = self.MULTI_PART_CHUNK_SIZE if parts < self.PARTS_LIMIT else int(org_size) // self.PARTS_LIMIT
-            t_config = TransferConfig(multipart_threshold=self.MULTI_PART_THRESHOLD,
-                                        multipart_chunksize=chunk_size)
             with open(org_url, 'rb') as stream, create_progress_bar() as progress:
                 task_id = progress.add_task("Uploading...", total=org_size)
                 progress_callback = ProgressCallback(org_size, progress, task_id)
-                if org_size <= self.MULTI_PART_CHUNK_SIZE * 50: # less than or equal to 5G, call auto multipart upload
-                    self.bucket.upload_file_obj(stream, key, progress_callback, file_name, t_config)
-                else:
-                    # call manual multipart upload if size > 5G
-                    self.bucket.upload_large_file_partly(stream, key, org_size, progress_callback)
-
-        else: #small file
-            md5_obj = get_md5_hex_n_base64(org_url)
-            md5_base64 = md5_obj['base64']
-            with open(org_url, 'rb') as data:
-                self.bucket.put_file_obj(org_size, key, data, md5_base64 )
-            
+                # call manual multipart upload, uploaded parts are recorded in a journal to resume an interrupted upload.
+                # less than or equal to 5G, keep the part size of auto multipart upload
+                part_size = chunk_size if org_size <= self.MULTI_PART_CHUNK_SIZE * 50 else None
+                journal = MultipartJournal(self.bucket_name, key, org_size, os.stat(org_url).st_mtime_ns)
+                extra_args = {'ACL': BUCKET_OWNER_ACL, 'ContentDisposition': f'attachment; filename="{file_name}"'}
+                size, response = self.bucket.upload_large_file_partly(stream, key, org_size, progress_callback, part_size, journal, extra_args)
+                # each part is checked by its Content-MD5, the object must be made of the same parts
+                expected_etag = get_multipart_etag(self.bucket.parts)
+
+        else: #small file, single put
+            if not md5_base64:
+                md5_obj = get_md5_hex_n_base64(org_url)
+                md5_base64 = md5_obj['base64']
+            self.bucket.acquire_memory(org_size)
+            try:
+                with open(org_url, 'rb') as data:
+                    response = self.bucket.put_file_obj(org_size, key, data, md5_base64, file_name if self.type == TYPE_FILE else None)
+            finally:
+                self.bucket.release_memory(org_size)
+            size = org_size
+            expected_etag = base64.b64decode(md5_base64).hex()
+
+        etag = response['ETag'].strip('"')
+        if not self._check_etag(file_name, etag, expected_etag, response):
+            return None
         self.files_copied += 1
-        size, msg =  self.bucket.get_object_size(key)
+        if self.dest_index is not None:
+            self.dest_index[key] = (size, etag)
         return size
+
+    def _check_etag(self, file_name, etag, expected_etag, response):
+        """
+        Check ETag of an uploaded or copied object, ETag of an object encrypted by SSE-KMS or SSE-C is not md5 based,
+        it is only logged, S3 has checked the content with Content-MD5 already.
+        :return: False if a md5 based ETag doesn't match
+        """
+        if not is_md5_etag(response):
+            self.log.info(f'ETag {etag} of “{file_name}” is not checked, the object is encrypted with {get_encryption(response)}.')
+            return True
+        if etag != expected_etag:
+            self.log.error(f'ETag {etag} of “{file_name}” does not match with the expected {expected_etag}.')
+            return False
+        return True
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 import os
 import time
+import threading
 from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from bento.common.utils import get_logger
 from common.constants import FILE_NAME_DEFAULT, SUCCEEDED, ERRORS,  OVERWRITE, DRY_RUN,\
     S3_BUCKET, TEMP_CREDENTIAL, FILE_PREFIX, RETRIES, FILE_DIR, FROM_S3, FILE_PATH,FILE_SIZE_DEFAULT, MD5_DEFAULT,\
-    SUBFOLDER_FILE_NAME, TEMP_DOWNLOAD_DIR, BYPASS_ARCHIVE_VALIDATION, MAX_DELETE_RETRY
+    SUBFOLDER_FILE_NAME, TEMP_DOWNLOAD_DIR, BYPASS_ARCHIVE_VALIDATION, MAX_DELETE_RETRY, UPLOAD_THREADS, MAX_INFLIGHT_MB, \
+    SERVER_SIDE_COPY, VALIDATION_THREADS, STAGING_BUDGET_MB, PREFETCH_FILES
 from common.utils import extract_s3_info_from_url, format_size, format_time
-from common.s3util import S3Bucket
+from common.s3util import S3Bucket, SINGLE_PUT_LIMIT
+from common.staging_cache import StagingCache
+from common.memory_budget import MemoryBudget
 from copier import Copier
 from file_validator import validate_data_file
 # Line removed as ClientError is not used in the provided code snippet.
@@ -17,11 +23,7 @@ from file_validator import validate_data_file
 # input: file info list
 class FileUploader:
 
-    # keys in job dict
-    TTL = 'ttl'
-    INFO = 'file_info'
-
-    def __init__(self, configs, file_list, md5_cache, md5_cache_file, archived_files_info):
+    def __init__(self, configs, file_list, md5_cache, archived_files_info):
         """"
         :param configs: all configurations for file uploading
         :param file_list: list of file path, size
@@ -47,7 +49,19 @@ class FileUploader:
         self.files_failed = 0
         self.total_file_volume = 0
         self.md5_cache = md5_cache
-        self.md5_cache_file = md5_cache_file
+        # concurrent uploading
+        self.upload_threads = configs.get(UPLOAD_THREADS, 1)
+        # file contents held in memory by all uploading workers
+        self.memory_budget = MemoryBudget(configs.get(MAX_INFLIGHT_MB, 2048) * 1024 * 1024)
+        self.copiers = []
+        self.copier_lock = threading.Lock()
+        self.worker_local = threading.local()
+        self.server_side_copy = configs.get(SERVER_SIDE_COPY, False)
+        # validated downloads are kept for retries within the budget
+        self.staging_cache = StagingCache(configs.get(STAGING_BUDGET_MB, 102400) * 1024 * 1024, self.log)
+        # files downloaded and validated ahead of uploading
+        self.prefetch_files = configs.get(PREFETCH_FILES, 2)
+        self.invalid_lock = threading.Lock()
 
     """
     Set s3 bucket, prefix and file dir for downloading if source file dir is s3 url.
@@ -64,7 +78,7 @@ class FileUploader:
             self.s3_bucket = S3Bucket()
             self.s3_bucket.set_s3_client(self.from_bucket_name, None)
     """
-    Prepare file information for uploading
+    Prepare file information for uploading, file records are queued as jobs with retry times left in ttl
     :return: list of file information
     """
     def _prepare_files(self):
@@ -72,10 +86,8 @@ class FileUploader:
         self.total_file_count = len(self.file_info_list)
         for info in self.file_info_list:
             self.total_file_volume += int(info[FILE_SIZE_DEFAULT])
-            files.append({
-                self.TTL: self.retry,
-                self.INFO: info,
-            })
+            info.ttl = self.retry
+            files.append(info)
             if self.files_processed >= self.count:
                 break
 
@@ -84,7 +96,8 @@ class FileUploader:
     # Use this method in solo mode
     def upload(self):
         """
-          Read file information from pre-manifest and copy them one by one to destination bucket
+          Read file information from pre-manifest and copy them one by one to destination bucket,
+          or with a pool of workers if upload_threads is greater than 1 and files are local.
           :return: bool
         """
         self._set_from_s3() #reset from s3 bucket, prefix
@@ -92,33 +105,49 @@ class FileUploader:
         if self.invalid_count > 0:
             self.log.info(f"{self.invalid_count} files are invalid and uploading skipped!")
             return False
-        self.copier = Copier(self.bucket_name, self.prefix, self.configs)
+        self.copier = Copier(self.bucket_name, self.prefix, self.configs, self.memory_budget)
+        if not self.overwrite and not self.dryrun:
+            self.copier.load_dest_index()
         file_queue = deque(upload_file_list)
         uploaded_file_volume = 0
         self.print_start_upload_message(self.count, self.total_file_volume)
         start_uploading_at = datetime.now()
         file_count = 0
+        self.copiers = [self.copier]
+        prefetched = {} # id of file record -> future of downloading and validating the file
+        prefetch_executor = ThreadPoolExecutor(max_workers=self.prefetch_files) if self.from_s3 else None
         try:
+            if self.upload_threads > 1 and not self.from_s3:
+                self.log.info(f'Uploading files with {self.upload_threads} concurrent workers.')
+                # the job queue is drained by the workers, the loop below is skipped
+                uploaded_file_volume = self._upload_concurrently(file_queue, start_uploading_at)
             while file_queue:
-                job = file_queue.popleft()
-                file_info = job[self.INFO]
+                file_info = file_queue.popleft()
                 file_path = file_info[FILE_PATH]
                 file_count += 1 
-                job[self.TTL] -= 1
-                if self.from_s3 == True: #download file from s3
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                    result = self.prepare_s3_download_file(file_info, file_count, self.total_file_count)
-                    if not result:
-                        continue
+                file_info.ttl -= 1
+                copied_in_s3 = False
+                if self.from_s3 == True:
+                    future = prefetched.pop(id(file_info), None)
+                    copied_in_s3 = not future and self.server_side_copy and self._copy_in_s3(file_info)
+                    if not copied_in_s3: #download file from s3, a partially downloaded file is resumed
+                        if future:
+                            result = future.result()
+                        else:
+                            result = self.prepare_s3_download_file(file_info, file_count, self.total_file_count)
+                        # next files are downloaded and validated while this one is uploaded
+                        self._prefetch(prefetch_executor, file_queue, prefetched, file_count)
+                        if not result:
+                            continue
                 self.files_processed += 1
-                result = self.copier.copy_file(file_info, self.overwrite, self.dryrun)
+                result = {Copier.STATUS: True} if copied_in_s3 else self.copier.copy_file(file_info, self.overwrite, self.dryrun)
                 if result.get(Copier.STATUS):
                     file_info[SUCCEEDED] = True
                     file_info[ERRORS] = None
-                    if self.from_s3 == True:
+                    if self.from_s3 == True and not copied_in_s3:
                         for retry_count in range(1, MAX_DELETE_RETRY+1):
                             try:
+                                self.staging_cache.discard(file_info[FILE_PATH])
                                 os.remove(file_info[FILE_PATH])
                                 break
                             except Exception as e:
@@ -131,65 +160,195 @@ class FileUploader:
                                 time.sleep(30)
 
                 else:
-                    self._deal_with_failed_file(job, file_queue)
-                    if job[self.TTL]  > 0:
+                    self._deal_with_failed_file(file_info, file_queue)
+                    if file_info.ttl  > 0:
                         file_count -= 1
 
                 uploaded_file_volume += file_info[FILE_SIZE_DEFAULT]
                 
                 # self.log.info(f'{self.copier.files_copied} out of {len(self.file_info_list)} files have been uploaded to destination.')
-                self.print_progress_message(self.count, self.copier.files_copied, self.total_file_volume, uploaded_file_volume, start_uploading_at)
+                self.print_progress_message(self.count, self._files_copied(), self.total_file_volume, uploaded_file_volume, start_uploading_at)
                    
+            files_copied = self._files_copied()
+            files_exist_at_dest = self._files_exist_at_dest()
             self.log.info(f'Files processed: {self.files_processed}')
-            self.log.info(f'Files not found: {len(self.copier.files_not_found)}')
-            self.log.info(f'Files copied: {self.copier.files_copied}')
-            self.log.info(f'Files exist at destination: {self.copier.files_exist_at_dest}')
+            self.log.info(f'Files not found: {self._files_not_found()}')
+            self.log.info(f'Files copied: {files_copied}')
+            self.log.info(f'Files exist at destination: {files_exist_at_dest}')
             self.log.info(f'Files failed: {self.files_failed}')
 
-            if self.copier.files_exist_at_dest == self.files_processed:
+            if files_exist_at_dest == self.files_processed:
                 self.log.info(f"All files already exist in the cloud storage")
 
-            return self.copier.files_copied > 0 or self.copier.files_exist_at_dest == self.files_processed
+            return files_copied > 0 or files_exist_at_dest == self.files_processed
         finally:
+            if prefetch_executor:
+                prefetch_executor.shutdown(wait=False, cancel_futures=True)
             self.s3_bucket = None
             self.copier = None
+            self.copiers = []
+
+    """
+    Start downloading and validating the next files in the job queue in the background,
+    at most prefetch_files files are prefetched and not uploaded yet, and only if they fit in the staging disk budget.
+    :param executor: pool of prefetching workers
+    :param file_queue: job queue
+    :param prefetched: dict of id of file record -> future of prefetching the file
+    :param file_count: number of files taken from the job queue
+    :return: None
+    """
+    def _prefetch(self, executor, file_queue, prefetched, file_count):
+        # a file copied in s3 doesn't need downloading
+        if not executor or self.server_side_copy:
+            return
+        for position, file_info in enumerate(islice(file_queue, self.prefetch_files), 1):
+            if len(prefetched) >= self.prefetch_files:
+                break
+            if id(file_info) in prefetched:
+                continue
+            file_path = self._get_download_path(file_info)
+            size = file_info.get(FILE_SIZE_DEFAULT)
+            if self.staging_cache.reuse(file_path, size):
+                continue
+            if not self.staging_cache.reserve(file_path, size, force=False):
+                break
+            prefetched[id(file_info)] = executor.submit(self.prepare_s3_download_file, file_info, file_count + position,
+                                                        self.total_file_count, True)
+
+    """
+    Upload files with a bounded pool of workers, each worker owns its Copier and S3 client.
+    Jobs are dispatched and their results handled in the calling thread only, so the statistics,
+    TTL based retries and progress messages follow the same rules as uploading one by one.
+    :param file_queue: job queue
+    :param start_uploading_at: datetime when uploading started
+    :return: uploaded file volume
+    """
+    def _upload_concurrently(self, file_queue, start_uploading_at):
+        uploaded_file_volume = 0
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.upload_threads) as executor:
+            while file_queue or running:
+                # memory used by workers is capped by the memory budget shared by their copiers
+                while file_queue and len(running) < self.upload_threads:
+                    file_info = file_queue.popleft()
+                    file_info.ttl -= 1
+                    self.files_processed += 1
+                    running[executor.submit(self._copy_file_in_worker, file_info)] = file_info
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_info = running.pop(future)
+                    result = future.result()
+                    if result.get(Copier.STATUS):
+                        file_info[SUCCEEDED] = True
+                        file_info[ERRORS] = None
+                    else:
+                        self._deal_with_failed_file(file_info, file_queue)
+                    uploaded_file_volume += file_info[FILE_SIZE_DEFAULT]
+                    self.print_progress_message(self.count, self._files_copied(), self.total_file_volume, uploaded_file_volume, start_uploading_at)
+        return uploaded_file_volume
+
+    """
+    Copy a file in a worker thread with the Copier owned by the thread
+    :param file_info: file information
+    :return: dict, copy result
+    """
+    def _copy_file_in_worker(self, file_info):
+        copier = getattr(self.worker_local, 'copier', None)
+        if copier is None:
+            copier = Copier(self.bucket_name, self.prefix, self.configs, self.memory_budget)
+            copier.dest_index = self.copier.dest_index # share listed files at destination
+            self.worker_local.copier = copier
+            with self.copier_lock:
+                self.copiers.append(copier)
+        return copier.copy_file(file_info, self.overwrite, self.dryrun)
+
+    def _files_copied(self):
+        with self.copier_lock:
+            return sum(copier.files_copied for copier in self.copiers)
+
+    def _files_exist_at_dest(self):
+        with self.copier_lock:
+            return sum(copier.files_exist_at_dest for copier in self.copiers)
+
+    def _files_not_found(self):
+        with self.copier_lock:
+            return len(set().union(*[copier.files_not_found for copier in self.copiers]))
 
     """
     Handle failed file uploading
-    :param job: current job
+    :param file_info: file record of current job
     :param queue: job queue
     :return: None
     """
-    def _deal_with_failed_file(self, job, queue):
-        if job[self.TTL]  > 0:
-            self.log.error(f'File: {job[self.INFO].get(FILE_NAME_DEFAULT) } - Uploading file FAILED! Retry left: {job[self.TTL]}')
-            queue.append(job)
+    def _deal_with_failed_file(self, file_info, queue):
+        if file_info.ttl  > 0:
+            self.log.error(f'File: {file_info.get(FILE_NAME_DEFAULT) } - Uploading file FAILED! Retry left: {file_info.ttl}')
+            queue.append(file_info)
+            if self.from_s3 == True:
+                # the downloaded file is kept for the retry, unless its room is needed by other files
+                self.staging_cache.release(file_info[FILE_PATH])
         else:
             self.log.critical(f'Uploading file failure exceeded maximum retry times, abort!')
             self.files_failed += 1
-            file_info = job[self.INFO]
             file_info[SUCCEEDED] = False
             if self.from_s3 == True:
-                os.remove(file_info[FILE_PATH])
+                self.staging_cache.remove(file_info[FILE_PATH])
   
-    def prepare_s3_download_file(self, file_info, file_count, total_file_count):
+    def _copy_in_s3(self, file_info):
+        """
+        Copy a file from the source bucket to destination on the server side.
+        The md5 in the manifest is verified against the ETag of the source object before copying.
+
+        :param file_info: Dictionary containing file information.
+        :return: True if the file is copied, False if the file needs to be downloaded and uploaded.
+        """
+        file_name = file_info[FILE_NAME_DEFAULT]
+        # contents of zip files can only be validated after downloading
+        if file_name.endswith('.zip') and not self.configs.get(BYPASS_ARCHIVE_VALIDATION, False):
+            return False
+        file_key = os.path.join(self.from_prefix, file_name)
+        size, etag, msg = self.s3_bucket.get_object_info(file_key)
+        if msg:
+            self.log.info(f"Can't copy {file_name} on the server side, {msg}")
+            return False
+        # ETag of an object uploaded in parts is not its md5, only objects put in one request, up to 5GB, are copied
+        if size != file_info[FILE_SIZE_DEFAULT] or etag != file_info[MD5_DEFAULT] or size > SINGLE_PUT_LIMIT:
+            self.log.info(f"The md5 of {file_name} can't be verified by its ETag, downloading it from {self.file_dir} ...")
+            return False
+        result = self.copier.copy_s3_object(file_info, self.from_bucket_name, file_key, self.overwrite, self.dryrun)
+        if result.get(Copier.STATUS):
+            self.log.info(f'{file_name} has been copied from {self.file_dir} successfully!')
+            return True
+        if self.copier.s3_copy_denied:
+            self.log.warning(f"Temporary credential can't read files in {self.file_dir}, files will be downloaded and uploaded.")
+            self.server_side_copy = False
+        return False
+
+    def prepare_s3_download_file(self, file_info, file_count, total_file_count, reserved=False):
         """
         Prepare file information for downloading from S3.
+        Files may be prepared by prefetching workers, only the file record of the file is updated.
 
         :param file_info: Dictionary containing file information.
+        :param reserved: staging disk budget has been reserved for the file by prefetching
         :return: None
         """
-        file_path = os.path.join(TEMP_DOWNLOAD_DIR, file_info[SUBFOLDER_FILE_NAME])
+        file_path = self._get_download_path(file_info)
         file_info[FILE_PATH] = file_path
         file_key = os.path.join(self.from_prefix, file_info[FILE_NAME_DEFAULT])
+        if not reserved:
+            if self.staging_cache.reuse(file_path, file_info.get(FILE_SIZE_DEFAULT)):
+                self.log.info(f"{file_info[FILE_NAME_DEFAULT]} has been downloaded and validated, reuse the downloaded file.")
+                return True
+            self.staging_cache.reserve(file_path, file_info.get(FILE_SIZE_DEFAULT))
         self.log.info(f"Downloading {file_info[FILE_NAME_DEFAULT]} from {self.file_dir} ...")
         try:
-            result, msg = self.s3_bucket.download_object(file_key, file_path)
-            if not result:
+            md5sum, msg = self.s3_bucket.download_object_with_md5(file_key, file_path)
+            if not md5sum:
                 invalid_reason = msg
                 file_info[SUCCEEDED] = False
                 file_info[ERRORS] = [invalid_reason]
-                self.invalid_count += 1
+                self._add_invalid(file_path)
                 return False
         except Exception:      
             msg = f"Failed to download file from S3: {file_key}."
@@ -197,22 +356,36 @@ class FileUploader:
             invalid_reason = msg
             file_info[SUCCEEDED] = False
             file_info[ERRORS] = [invalid_reason]
-            self.invalid_count += 1
+            self._add_invalid(file_path)
             return False
         
         self.log.info(f"{file_info[FILE_NAME_DEFAULT]} has been downloaded from {self.file_dir} successfully!")
+        # md5 is calculated while downloading, validating the file doesn't read it again
+        if self.md5_cache is not None:
+            self.md5_cache.put(file_path, md5sum)
         # validate size and md5 of downloaded data file
-        result = validate_data_file(file_info, file_info.get(FILE_SIZE_DEFAULT), file_path, self.md5_cache, self.log, self.archived_files_info, self.configs.get(BYPASS_ARCHIVE_VALIDATION, False))
+        result = validate_data_file(file_info, file_info.get(FILE_SIZE_DEFAULT), file_path, self.md5_cache, self.log, self.archived_files_info, self.configs.get(BYPASS_ARCHIVE_VALIDATION, False), self.configs.get(VALIDATION_THREADS, 1))
         if result:
             self.log.info(f'Validating file integrity succeeded on "{file_info[FILE_NAME_DEFAULT]}"')
         self.log.info(f'{file_count} out of {total_file_count} file(s) have been validated.')
         if not result:
             file_info[SUCCEEDED] = False
-            os.remove(file_path)
-            self.invalid_count += 1
+            self.staging_cache.remove(file_path)
+            self._add_invalid()
             return False
+        self.staging_cache.set_validated(file_path)
         return True
-        
+
+    def _get_download_path(self, file_info):
+        return os.path.join(TEMP_DOWNLOAD_DIR, file_info[SUBFOLDER_FILE_NAME])
+
+    def _add_invalid(self, file_path=None):
+        # a partially downloaded file is kept on disk for resuming, but it is not staged
+        if file_path:
+            self.staging_cache.discard(file_path)
+        with self.invalid_lock:
+            self.invalid_count += 1
+
     def print_start_upload_message(self, total_file_cnt, total_file_volume):
         """
         Print start message for file uploading.
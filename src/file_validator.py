@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
-import csv
 import os
 import glob
 import re
+import hashlib
 import zipfile
-import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from common.constants import UPLOAD_TYPE, TYPE_FILE, TYPE_MATE_DATA, FILE_NAME_DEFAULT, FILE_SIZE_DEFAULT, MD5_DEFAULT, \
     FILE_DIR, FILE_MD5_FIELD, PRE_MANIFEST, FILE_NAME_FIELD, FILE_SIZE_FIELD, FILE_PATH, SUCCEEDED, ERRORS, FILE_ID_DEFAULT,\
-    FILE_ID_FIELD, OMIT_DCF_PREFIX, FROM_S3, TEMP_DOWNLOAD_DIR, S3_START, MD5_CACHE_DIR, MD5_CACHE_FILE, MODIFIED_AT, SUBFOLDER_FILE_NAME,\
-    TEMP_UNZIP_DIR, ARCHIVE_MANIFEST, ARCHIVE_NAME, MAX_CREATE_BATCH_PAYLOAD_SIZE, SUBMISSION_ID, BYPASS_ARCHIVE_VALIDATION
-from common.utils import clean_up_key_value, clean_up_strs, is_valid_uuid
+    FILE_ID_FIELD, OMIT_DCF_PREFIX, FROM_S3, TEMP_DOWNLOAD_DIR, S3_START, SUBFOLDER_FILE_NAME,\
+    ARCHIVE_MANIFEST, ARCHIVE_NAME, BYPASS_ARCHIVE_VALIDATION, \
+    VALIDATION_THREADS
+from common.utils import clean_up_strs, is_valid_uuid
 from bento.common.utils import get_logger
-from common.utils import extract_s3_info_from_url, dump_data_to_csv
+from common.utils import extract_s3_info_from_url
 from common.s3util import S3Bucket
-from common.md5_calculator import calculate_file_md5
+from common.md5_calculator import calculate_file_md5, calculate_zip_members_md5
+from common.md5_cache import Md5Cache
+from common.manifest_reader import ManifestReader
+from common.file_record import FileRecord
+from common.progress_bar import create_progress_bar
+
+# reserved or illegal characters in file name
+INVALID_FILE_NAME_CHARS = re.compile(r'[*:|]')
 
 """ Requirement for the ticket crdcdh-343
 For files: read manifest file and validate local files’ sizes and md5s
@@ -29,20 +37,19 @@ class FileValidator:
         self.from_s3 = configs.get(FROM_S3)
         self.pre_manifest = configs.get(PRE_MANIFEST)
         self.archive_manifest= configs.get(ARCHIVE_MANIFEST)
-        self.fileList = [] #list of files object {file_name, file_path, file_size, invalid_reason}
+        self.fileList = [] #list of FileRecord {file_name, file_path, file_size, md5sum, succeeded, errors}
         self.log = get_logger('File_Validator')
         self.invalid_count = 0
         self.has_file_id = None
         self.manifest_rows = None
-        self.archive_manifest_rows = None
         self.field_names = None
         self.download_file_dir = None
         self.from_bucket_name = None
         self.from_prefix = None
         self.s3_bucket = None
-        self.md5_cache_file = os.path.join(MD5_CACHE_DIR, MD5_CACHE_FILE)
-        self.md5_cache = self.load_md5_cache() 
-        self.archive_files_info = []
+        self.source_index = None # object key -> (size, ETag) of files in source bucket
+        self.md5_cache = Md5Cache()
+        self.archive_files_info = {} # archive name -> {file path in archive -> (file size, md5)}
 
     def validate(self):
         # check file dir
@@ -61,8 +68,11 @@ class FileValidator:
             for filepath in file_list:
                 size = os.path.getsize(filepath)
                 filename = os.path.basename(filepath)
-                #metadata file dictionary: {FILE_NAME_DEFAULT: None, FILE_SIZE_DEFAULT: None}
-                self.fileList.append({FILE_NAME_DEFAULT:filename, FILE_PATH: filepath, FILE_SIZE_DEFAULT: size})
+                # md5 is carried in the file record and sent as Content-MD5 when uploading
+                md5sum = get_file_md5(filepath, self.md5_cache, size, self.log)
+                #metadata file dictionary: {FILE_NAME_DEFAULT: None, FILE_SIZE_DEFAULT: None, MD5_DEFAULT: None}
+                self.fileList.append(FileRecord(**{FILE_NAME_DEFAULT:filename, FILE_PATH: filepath, FILE_SIZE_DEFAULT: size, MD5_DEFAULT: md5sum}))
+            self.md5_cache.save()
 
         elif self.uploadType == TYPE_FILE: #file
             try: 
@@ -85,18 +95,16 @@ class FileValidator:
         if not self.files_info or not self.manifest_rows:
             return False
         if self.archive_manifest:
-            self.archive_files_info, self.archive_manifest_rows =  self.read_manifest(is_archive_manifest=True)
+            self.archive_files_info, _ =  self.read_manifest(is_archive_manifest=True)
         if self.from_s3 == True:
             self.download_file_dir = TEMP_DOWNLOAD_DIR
             os.makedirs(self.download_file_dir, exist_ok=True)
             self.from_bucket_name, self.from_prefix = extract_s3_info_from_url(self.file_dir)
             self.s3_bucket = S3Bucket()
             self.s3_bucket.set_s3_client(self.from_bucket_name, None)
+            self.load_source_index()
         line_num = 1
         total_file_cnt = len(self.files_info)
-        result = check_payload_size(self.files_info, self.configs, self.log)
-        if not result:
-            return False
         self.log.info(f'Start to validate data files...')
         # add warning if manifest include "internal_file_name" column
         if SUBFOLDER_FILE_NAME in self.field_names:
@@ -107,6 +115,8 @@ class FileValidator:
         if not self.validate_file_name():
             return False
         self.field_names.append(SUBFOLDER_FILE_NAME) # add subfolder file name to field names
+        if not self.from_s3 and self.configs.get(VALIDATION_THREADS, 1) > 1:
+            self.prehash_data_files()
         for info in self.files_info:
             line_num += 1
             invalid_reason = ""
@@ -126,10 +136,12 @@ class FileValidator:
             size_info = 0 if not size.isdigit() else int(size)
             info[FILE_SIZE_DEFAULT]  = size_info #convert to int
             file_id = info.get(FILE_ID_DEFAULT)
-            converted_file_info = {FILE_ID_DEFAULT: file_id, FILE_NAME_DEFAULT: info.get(FILE_NAME_DEFAULT), FILE_PATH: file_path, FILE_SIZE_DEFAULT: size_info, MD5_DEFAULT: info[MD5_DEFAULT], SUCCEEDED: None, ERRORS: None, SUBFOLDER_FILE_NAME: info.get(SUBFOLDER_FILE_NAME)}
+            # the file record read from manifest is completed and added to file list, not copied
+            converted_file_info = info
+            converted_file_info.update({FILE_PATH: file_path, SUCCEEDED: None, ERRORS: None})
             self.fileList.append(converted_file_info)
             if not self.from_s3: # only  validate local data file
-                result = validate_data_file(converted_file_info, size_info, file_path, self.md5_cache, self.log, self.archive_files_info, self.configs.get(BYPASS_ARCHIVE_VALIDATION, False))
+                result = validate_data_file(converted_file_info, size_info, file_path, self.md5_cache, self.log, self.archive_files_info, self.configs.get(BYPASS_ARCHIVE_VALIDATION, False), self.configs.get(VALIDATION_THREADS, 1))
                 if result:
                     self.log.info(f'Validating file integrity succeeded on "{info[FILE_NAME_DEFAULT]}"')
                 self.log.info(f'{line_num - 1} out of {total_file_cnt} file(s) have been validated.')
@@ -137,7 +149,7 @@ class FileValidator:
                     self.invalid_count += 1
                     continue
             else: # check file existing and validate file size in s3 bucket
-                s3_file_size, msg = self.s3_bucket.get_object_size(os.path.join(self.from_prefix, info[FILE_NAME_DEFAULT]))
+                s3_file_size, msg = self.get_source_file_size(os.path.join(self.from_prefix, info[FILE_NAME_DEFAULT]))
                 if not s3_file_size:
                     invalid_reason += msg
                     converted_file_info[SUCCEEDED] = False
@@ -164,9 +176,31 @@ class FileValidator:
 
         # save md5 cache to file
         if not self.from_s3:
-            dump_data_to_csv(self.md5_cache, self.md5_cache_file)
+            self.md5_cache.save()
         return True
     
+    def load_source_index(self):
+        """
+        List files under the source prefix once, so validating a file doesn't need a HEAD request.
+        If the files can't be listed, files are checked one by one.
+        """
+        self.source_index = self.s3_bucket.get_object_index(os.path.join(self.from_prefix, ''))
+        if self.source_index is not None:
+            self.log.info(f'Found {len(self.source_index)} files in {self.file_dir}.')
+
+    def get_source_file_size(self, key):
+        """
+        Get size of a file in source bucket from the source index, HEAD request is only sent for a key missed by the listing
+        :param key: object key
+        :return: file size, error message
+        """
+        if self.source_index is not None and key in self.source_index:
+            size = self.source_index[key][0]
+            if size == 0:
+                return None, f'File size is 0 for {key}'
+            return size, None
+        return self.s3_bucket.get_object_size(key)
+
     # validate file name listed manifest
     def validate_file_name(self):
         msg = None
@@ -175,16 +209,18 @@ class FileValidator:
         file_name_config = self.configs.get(FILE_NAME_FIELD)
         md5_config = self.configs.get(FILE_MD5_FIELD)
         self.log.info("Start validating file names listed in pre-manifest:")
+        # index md5s by file name, a file name listed with different md5s is not unique
+        name_md5s = {}
+        for row in self.manifest_rows:
+            name_md5s.setdefault(row[file_name_config], set()).add(row.get(md5_config, ""))
         for row in self.manifest_rows:
             file_name = row[file_name_config]
             if not file_name or not file_name.strip():
                 msg = f"Line {line_num}: File name is empty!"
                 is_valid = False
                 self.log.error(msg)
-            md5 = row[md5_config]
-            # check if file name is unique by count the file name
-            same_file_name_list  = [file for file in self.manifest_rows if file[file_name_config] == file_name and file[md5_config] != md5]
-            if len(same_file_name_list) > 0:
+            # check if file name is unique by the md5s listed with the file name
+            if len(name_md5s[file_name]) > 1:
                 msg = f"Line {line_num}: File name {file_name} is not unique in the manifest!"
                 is_valid = False
                 self.log.error(msg)
@@ -196,7 +232,7 @@ class FileValidator:
                 self.log.error(msg)
 
             # check if file name contains reserved or illegal characters *, :, and |
-            if re.search(r'[*:|]', file_name):
+            if INVALID_FILE_NAME_CHARS.search(file_name):
                 msg = f"Line {line_num}: File name {file_name} contains invalid characters!"
                 is_valid = False
                 self.log.error(msg)
@@ -220,9 +256,11 @@ class FileValidator:
         return is_valid
 
     #public function to read pre-manifest and return list of file records 
+    #for archive manifest, return index of files grouped by archive name instead, archive name -> {file path -> (file size, md5)}
     def read_manifest(self, is_archive_manifest=False):
         files_info = []
         files_dict = {}
+        archive_index = {}
         manifest_rows = []
         pre_manifest = self.pre_manifest if not is_archive_manifest else self.archive_manifest
         is_s3_manifest = pre_manifest.startswith(S3_START)
@@ -243,40 +281,31 @@ class FileValidator:
             if not os.path.isfile(pre_manifest):
                 self.log.critical(f'Manifest file {pre_manifest} does not exist!')
                 return [], []
-            with open(pre_manifest, mode='r', encoding='utf-8') as pre_m:
-                reader = csv.DictReader(pre_m, delimiter='\t')
-                if not self.field_names:
-                    self.field_names = clean_up_strs(reader.fieldnames)
-                for info in reader:
-                    file_info = clean_up_key_value(info)
-                    if not is_archive_manifest:
-                        # convert MD5 to lowercase
-                        file_info[self.configs.get(FILE_MD5_FIELD)] = file_info.get(self.configs.get(FILE_MD5_FIELD), "").lower()
-                        file_name = file_info.get(self.configs.get(FILE_NAME_FIELD))
-                        file_id = file_info.get(self.configs.get(FILE_ID_FIELD))
-                        if self.has_file_id is None:
-                            self.has_file_id = self.configs.get(FILE_ID_FIELD) in info.keys()
-                        files_dict.update({file_name: {
-                            FILE_ID_DEFAULT: file_id,
-                            FILE_NAME_DEFAULT: file_name,
-                            FILE_SIZE_DEFAULT: file_info.get(self.configs.get(FILE_SIZE_FIELD)),
-                            MD5_DEFAULT: file_info.get(self.configs.get(FILE_MD5_FIELD))
-                        }})
-                    else:
-                        # convert MD5 to lowercase
-                        file_info["md5"] = file_info.get("md5", "").lower()
-                        archive_file_name = file_info.get(ARCHIVE_NAME)
-                        file_path = file_info.get(FILE_PATH)
-                        key = f"{archive_file_name}-{file_path}"
-                        files_dict.update({key: {
-                            ARCHIVE_NAME: archive_file_name,
-                            FILE_PATH: file_path,
-                            FILE_SIZE_DEFAULT: file_info.get(FILE_SIZE_DEFAULT),
-                            MD5_DEFAULT: file_info.get("md5")
-                        }})
-                    # save clean data to manifest_rows
-                    manifest_rows.append(file_info)
-            files_info  =  list(files_dict.values())
+            # rows are cleaned up and md5 is converted to lowercase by the reader, rows share the header to save memory
+            reader = ManifestReader(pre_manifest, lowercase_columns=(self.configs.get(FILE_MD5_FIELD),) if not is_archive_manifest else ("md5",))
+            for file_info in reader:
+                if not is_archive_manifest:
+                    file_name = file_info.get(self.configs.get(FILE_NAME_FIELD))
+                    file_id = file_info.get(self.configs.get(FILE_ID_FIELD))
+                    if self.has_file_id is None:
+                        self.has_file_id = self.configs.get(FILE_ID_FIELD) in file_info.header.raw_columns
+                    files_dict[file_name] = FileRecord(**{
+                        FILE_ID_DEFAULT: file_id,
+                        FILE_NAME_DEFAULT: file_name,
+                        FILE_SIZE_DEFAULT: file_info.get(self.configs.get(FILE_SIZE_FIELD)),
+                        MD5_DEFAULT: file_info.get(self.configs.get(FILE_MD5_FIELD), "")
+                    })
+                else:
+                    # keep a tuple per file instead of the row, archive manifest may list millions of files
+                    size = file_info.get(FILE_SIZE_DEFAULT)
+                    size = int(size) if size and size.isdigit() else size
+                    archive_index.setdefault(file_info.get(ARCHIVE_NAME), {})[file_info.get(FILE_PATH)] = (size, file_info.get("md5", ""))
+                    continue
+                # save clean data to manifest_rows
+                manifest_rows.append(file_info)
+            if not self.field_names:
+                self.field_names = clean_up_strs(reader.header.raw_columns)
+            files_info  =  list(files_dict.values()) if not is_archive_manifest else archive_index
 
         except UnicodeDecodeError as ue:
             self.log.debug(ue)
@@ -338,17 +367,39 @@ class FileValidator:
                 
         return True, None
     
-    def load_md5_cache(self):
-        # retrieve cached md5 info
-        # check if md5 cache dir exists
-        os.makedirs(MD5_CACHE_DIR, exist_ok=True)
-        if os.path.isfile(self.md5_cache_file):
-            # read md5 cache file to dict
-            with open(self.md5_cache_file) as f:
-                reader = csv.DictReader(f)
-                return [row for row in reader]  
-        else: 
-            return []
+    """
+    Hash the local data files concurrently and save md5s to md5 cache before validating files one by one,
+    so validating files, including logs, is in the same order as the manifest and md5s are retrieved from the cache.
+    Files failed in size check or not existing are left to validate_data_file to report.
+    """
+    def prehash_data_files(self):
+        jobs = []
+        queued = set()
+        for info in self.files_info:
+            file_path = os.path.join(self.file_dir, info.get(FILE_NAME_DEFAULT))
+            size = str(info.get(FILE_SIZE_DEFAULT) or '').replace(',', '')
+            if not size.isdigit() or not info.get(MD5_DEFAULT) or not os.path.isfile(file_path) or file_path in queued:
+                continue
+            file_stat = os.stat(file_path)
+            if file_stat.st_size != int(size) or self.md5_cache.get(file_path, file_stat):
+                continue
+            queued.add(file_path) # same file listed more than once is hashed once
+            jobs.append((file_path, file_stat))
+        if not jobs:
+            return
+        threads = self.configs.get(VALIDATION_THREADS)
+        self.log.info(f'Start to calculate md5 of {len(jobs)} data file(s) with {threads} threads...')
+        with create_progress_bar() as progress, ThreadPoolExecutor(max_workers=threads) as executor:
+            task = progress.add_task("Calculating MD5", total=sum(job[1].st_size for job in jobs))
+            futures = {executor.submit(calculate_file_md5, file_path, file_stat.st_size, self.log, progress, task): (file_path, file_stat)
+                       for file_path, file_stat in jobs}
+            # save each md5 as soon as it is calculated, an interrupted validation doesn't lose finished files
+            for future in as_completed(futures):
+                file_path, file_stat = futures[future]
+                md5sum = future.result()
+                # a file failed to read is left to validate_data_file to report
+                if md5sum:
+                    self.md5_cache.put(file_path, md5sum, file_stat)
     
 """
 Validate file size and md5
@@ -361,7 +412,7 @@ Validate file size and md5
 :param log: log
 :return: True if valid, False otherwise
 """
-def validate_data_file(file_info, size_info, file_path, md5_cache, log, archived_files_info = None, bypass_archive_validation = False):
+def validate_data_file(file_info, size_info, file_path, md5_cache, log, archive_index = None, bypass_archive_validation = False, threads = 1):
     invalid_reason = ""
     if not os.path.isfile(file_path):
         invalid_reason += f"File {file_path} does not exist!"
@@ -384,6 +435,12 @@ def validate_data_file(file_info, size_info, file_path, md5_cache, log, archived
         log.error(invalid_reason)
         return False
     md5sum = get_file_md5(file_path, md5_cache, file_size, log)
+    if not md5sum:
+        invalid_reason += f"Failed to read file {file_info[FILE_NAME_DEFAULT]} to calculate md5!"
+        file_info[SUCCEEDED] = False
+        file_info[ERRORS] = [invalid_reason]
+        log.error(invalid_reason)
+        return False
     if md5_info != md5sum:
         invalid_reason += f"Real file md5 {md5sum} of file {file_info[FILE_NAME_DEFAULT]} does not match with that in manifest {md5_info}!"
         file_info[SUCCEEDED] = False
@@ -394,133 +451,100 @@ def validate_data_file(file_info, size_info, file_path, md5_cache, log, archived
     file_name = file_info.get(FILE_NAME_DEFAULT)
     if file_name.endswith('.zip') and bypass_archive_validation == False:
         log.info(f"Validating contents of zip file {file_name} ...")
-        if not archived_files_info:
+        if not archive_index:
             invalid_reason += f"No archive manifest found for {file_name}, content of the zip archive cannot be validated."
             file_info[SUCCEEDED] = False
             file_info[ERRORS] = [invalid_reason]
             log.error(invalid_reason)
             return False
-        archive_file_info_list = [row for row in archived_files_info if row.get(ARCHIVE_NAME) == file_name]
-        if not archive_file_info_list or len(archive_file_info_list) == 0:
+        archive_files = archive_index.get(file_name)
+        if not archive_files:
             invalid_reason += f"No archive manifest found for {file_name}, content of the zip archive cannot be validated."
             file_info[SUCCEEDED] = False
             file_info[ERRORS] = [invalid_reason]
             log.error(invalid_reason)
             return False
-        if not validate_zip_file(archive_file_info_list, file_path, md5_cache, log):
+        # skip the zip file validated by a previous run, unless the zip file or its files in archive manifest are changed
+        manifest_digest = get_archive_manifest_digest(archive_files)
+        if md5_cache is not None and md5_cache.is_zip_validated(md5sum, manifest_digest):
+            log.info(f"Contents of zip file {file_name} were validated by a previous run, skipped.")
+        elif not validate_zip_file(archive_files, file_path, log, threads):
             log.error(f"Failed validating contents of zip file {file_name}.")
             return False
         else:
+            if md5_cache is not None:
+                md5_cache.add_validated_zip(md5sum, manifest_digest)
             log.info(f"Validated contents of zip file {file_name} successfully.")
     return True
 
-def validate_zip_file(archived_files_info, file_path, md5_cache, log):
+def validate_zip_file(manifest_files, file_path, log, threads=1):
     """
-    validate zip file to unzip a file and validate size and md5 of each file in the zip against a separate archive manifest
+    validate size and md5 of each file in the zip file against a separate archive manifest,
+    files are streamed from the zip file instead of being extracted, and hashed by the threads concurrently.
+    :param manifest_files: files of the zip file in archive manifest, file path -> (file size, md5)
     """
     try:
-        # create temp dir for unzip and validate if not existing
-        os.makedirs(TEMP_UNZIP_DIR, exist_ok=True)
+        members = []
         with zipfile.ZipFile(file_path, 'r', metadata_encoding='utf-8') as zip_ref:
-            zip_ref.extractall(TEMP_UNZIP_DIR)
-        # list dir under TEMP_UNZIP_DIR and remove __MACOSX dir and contents
-        if os.path.isdir(os.path.join(TEMP_UNZIP_DIR, '__MACOSX')):
-            shutil.rmtree(os.path.join(TEMP_UNZIP_DIR, '__MACOSX'))  # remove __MACOSX dir and contents
-        # list all files under TEMP_UNZIP_DIR with relative path
-        files = []
-        # walk through the TEMP_UNZIP_DIR and get all files and skip .DataStore
-        for root, _, filenames in os.walk(TEMP_UNZIP_DIR):
-            for file_name in filenames:
-                if file_name.startswith('.DS_Store'):
+            for member in zip_ref.infolist():
+                # skip dirs, __MACOSX dir and .DS_Store
+                if member.is_dir() or member.filename.startswith('__MACOSX/') or os.path.basename(member.filename).startswith('.DS_Store'):
                     continue
-                extracted_file_path = os.path.relpath(os.path.join(root, file_name), TEMP_UNZIP_DIR)
-                in_archive_manifest = any(row.get(FILE_PATH) == extracted_file_path for row in archived_files_info)
-                if in_archive_manifest:
-                    files.append(extracted_file_path)
+                if member.filename in manifest_files:
+                    members.append(member)
                 else:
-                    log.error(f"File {extracted_file_path} found in zip file {file_path} is not included in archive manifest!")
-        if len(files) != len(archived_files_info):
-            # find files in archived_files_info but not in files
-            missing_files = [row.get(FILE_PATH) for row in archived_files_info if row.get(FILE_PATH) not in files]
+                    log.error(f"File {member.filename} found in zip file {file_path} is not included in archive manifest!")
+        member_names = {member.filename for member in members}
+        missing_files = [path for path in manifest_files if path not in member_names]
+        if missing_files:
             invalid_reason = f"The zip file  {file_path} is missing the following files: {', '.join(missing_files)}"
             log.error(invalid_reason)
             return False
+        # file size is in the zip directory, only files with valid size are hashed
+        valid_size_members = [member for member in members if member.file_size == manifest_files[member.filename][0]]
+        md5s = dict(zip((member.filename for member in valid_size_members), calculate_zip_members_md5(file_path, valid_size_members, threads)))
         rtnVal = True
-        for file_name in files:
-            file_info = next((row for row in archived_files_info if row.get(FILE_PATH) == file_name), None)
-            file_path = os.path.join(TEMP_UNZIP_DIR, file_name)
+        for member in members:
+            file_name = member.filename
+            size, md5 = manifest_files[file_name]
             # file size
-            file_size = os.path.getsize(file_path)
-            if file_size != int(file_info[FILE_SIZE_DEFAULT]):
-                invalid_reason = f"Real file size {file_size} of file {file_name} does not match with that in archive manifest {file_info[FILE_SIZE_DEFAULT]}!"
+            if file_name not in md5s:
+                invalid_reason = f"Real file size {member.file_size} of file {file_name} does not match with that in archive manifest {size}!"
                 log.error(invalid_reason)
                 rtnVal = False
                 continue
             # md5
-            md5sum = get_file_md5(file_path, md5_cache, file_size, log)
-            if md5sum != file_info[MD5_DEFAULT]:
-                invalid_reason = f"Real file md5 {md5sum} of file {file_name} does not match with that in archive manifest {file_info[MD5_DEFAULT]}!"
+            md5sum = md5s[file_name]
+            if md5sum != md5:
+                invalid_reason = f"Real file md5 {md5sum} of file {file_name} does not match with that in archive manifest {md5}!"
                 log.error(invalid_reason)
                 rtnVal = False
         return rtnVal
     except Exception as e:
         log.error(f"Failed to validate zip file contents: {e}")
         return False
-    finally:
-        # remove contents of the temporary directory
-        if os.path.isdir(TEMP_UNZIP_DIR):
-            shutil.rmtree(TEMP_UNZIP_DIR)
+
+def get_archive_manifest_digest(archive_files):
+    """
+    calculate digest of the files of a zip file in archive manifest, file path -> (file size, md5)
+    """
+    digest = hashlib.sha256()
+    for path in sorted(archive_files):
+        size, md5 = archive_files[path]
+        digest.update(f"{path}\t{size}\t{md5}\n".encode("utf-8"))
+    return digest.hexdigest()
 
 def get_file_md5(file_path, md5_cache, file_size, log):
     """
     retrieve md5 if existing cached value, otherwise calculate md5 for the file and save to md5 cache
     """
-    file_modified_at = os.path.getmtime(file_path)
-    # check if md5 is in cache by file name and file size
-    cached_md5 = [row[MD5_DEFAULT] for row in md5_cache if row[FILE_PATH] == file_path and row[FILE_SIZE_DEFAULT] == str(file_size) and 
-                    row[MODIFIED_AT] == str(file_modified_at)] if md5_cache else None
-    if not cached_md5 or len(cached_md5) == 0:
+    # stat before hashing, a file changed while hashing is not cached with the new stat
+    file_stat = os.stat(file_path)
+    md5sum = md5_cache.get(file_path, file_stat) if md5_cache is not None else None
+    if not md5sum:
          #calculate file md5
         md5sum = calculate_file_md5(file_path, file_size, log)
-        if isinstance(md5_cache, list): 
-            md5_cache.append({FILE_PATH: file_path, FILE_SIZE_DEFAULT: file_size, MD5_DEFAULT: md5sum, MODIFIED_AT: file_modified_at})
-    else:
-        md5sum = cached_md5[0]
+        if md5_cache is not None and md5sum:
+            md5_cache.put(file_path, md5sum, file_stat)
 
     return md5sum
-
-def check_payload_size(file_info_list, configs, log):
-    """
-    Check if the payload size of files_info is within the limit.
-    If not, raise an exception.
-    """
-    file_array = [item.get(FILE_NAME_DEFAULT) for item in file_info_list]
-    submissionId = configs.get(SUBMISSION_ID)
-    type = configs.get(UPLOAD_TYPE)
-    payload= f"""
-        mutation {{
-            createBatch (
-                submissionID: \"{submissionId}\", 
-                type: \"{type}\", 
-                files: {file_array}
-            ){{
-                _id,
-                submissionID,
-                bucketName,
-                filePrefix,
-                type,
-                fileCount,
-                files {{
-                    fileID, 
-                    fileName,
-                }}
-                status,
-                createdAt
-            }}
-        }}
-        """
-    body_size = len(payload.encode("utf-8"))
-    if body_size > MAX_CREATE_BATCH_PAYLOAD_SIZE:
-        log.error(f"create batch body size is too large: {body_size} with {len(file_array)} files, please reduce the number of files for one batch.")
-        return False
-    return True
@@ -1,16 +1,22 @@
 import csv, os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from common.constants import FILE_ID_DEFAULT, FILE_NAME_FIELD, BATCH_BUCKET, S3_BUCKET, FILE_PREFIX, BATCH_ID, DCF_PREFIX, BATCH_CREATED,\
     FILE_ID_FIELD, UPLOAD_TYPE, FILE_NAME_DEFAULT, FILE_PATH, FILE_SIZE_DEFAULT, BATCH_STATUS, PRE_MANIFEST, OMIT_DCF_PREFIX,\
-    TEMP_DOWNLOAD_DIR, FROM_S3, SUBFOLDER_FILE_NAME, SEPARATOR_CHAR
+    TEMP_DOWNLOAD_DIR, FROM_S3, SUBFOLDER_FILE_NAME, SEPARATOR_CHAR, FILE_MD5_FIELD, ERRORS
 from common.graphql_client import APIInvoker
 from copier import Copier
 from common.s3util import S3Bucket
-from common.utils import is_valid_uuid
+from common.utils import is_valid_uuid, VALID_UUID_PATTERN
+from common.manifest_reader import ManifestReader
 
 SEPARATOR_CHAR = '\t'
 UTF8_ENCODE ='utf8'
 NODE_TYPE_NAME = 'type'
+CHILD_CHUNK_ROWS = 100_000
+# child metadata files downloaded, processed and uploaded concurrently
+CHILD_FILE_THREADS = 8
 
 def _is_valid_file_id_value(id_value, configs):
     """True if id_value matches file id format (same rules as FileValidator.validate_file_id)."""
@@ -26,6 +32,14 @@ def _is_valid_file_id_value(id_value, configs):
         return is_valid_uuid(parts[1])
     return is_valid_uuid(id_value)
 
+def _valid_file_id_values(id_values, configs):
+    """Vectorized _is_valid_file_id_value over a Series of strings, returns a boolean Series."""
+    id_values = id_values.str.strip()
+    if configs.get(OMIT_DCF_PREFIX, False) is False:
+        has_prefix = id_values.str.startswith(DCF_PREFIX)
+        return has_prefix & id_values.str[len(DCF_PREFIX):].str.fullmatch(VALID_UUID_PATTERN)
+    return id_values.str.fullmatch(VALID_UUID_PATTERN)
+
 def process_manifest_file(log, configs, has_file_id, file_infos, manifest_rows, manifest_s3_url):
     """
     function: process_manifest_file
@@ -34,7 +48,7 @@ def process_manifest_file(log, configs, has_file_id, file_infos, manifest_rows,
      file_path: the path of the pre-manifest file
      has_file_id: whether the pre-manifest file has file id column or not
      file_infos: the file info array of the pre-manifest file
-     manifest_rows: the rows of the pre-manifest file
+     manifest_rows: the rows of the pre-manifest file, the pre-manifest is read again when adding file id
     return:
      True or False
 
@@ -61,7 +75,7 @@ def process_manifest_file(log, configs, has_file_id, file_infos, manifest_rows,
     file_array = []
     try:
         if needFinalManifest:
-            result = add_file_id(file_id_name, file_name_name, final_manifest_path , file_infos, manifest_rows, configs.get(OMIT_DCF_PREFIX))
+            result = add_file_id(file_id_name, file_name_name, final_manifest_path , file_infos, file_path, configs.get(OMIT_DCF_PREFIX), configs.get(FILE_MD5_FIELD))
             if not result:
                 log.info(f"Failed to add file id to the pre-manifest, {final_manifest_path }.")
                 return False
@@ -69,7 +83,7 @@ def process_manifest_file(log, configs, has_file_id, file_infos, manifest_rows,
         configs[UPLOAD_TYPE] = "metadata"
         final_file_path_list = [final_manifest_path]
         # insert file id into children tsv files.
-        insert_file_id_2_children(log, configs, manifest_rows, final_file_path_list, manifest_s3_url)
+        insert_file_id_2_children(log, configs, manifest_rows, file_infos, final_file_path_list, manifest_s3_url)
         file_array = [os.path.basename(file_path) for file_path in final_file_path_list]
         # create a batch for upload the final manifest file
         apiInvoker = APIInvoker(configs)
@@ -82,10 +96,8 @@ def process_manifest_file(log, configs, has_file_id, file_infos, manifest_rows,
             configs[FILE_PREFIX] = newBatch[FILE_PREFIX]
             configs[BATCH_ID] = newBatch.get(BATCH_ID)
             log.info(f"New batch is created: {newBatch.get(BATCH_ID)} at {newBatch[BATCH_CREATED]}")
-            uploader = Copier(configs[S3_BUCKET], configs[FILE_PREFIX] , configs)
-            for file_path in final_file_path_list:
-                result = uploader.copy_file({FILE_NAME_DEFAULT: os.path.basename(file_path), FILE_PATH: file_path, FILE_SIZE_DEFAULT: os.path.getsize(file_path)}, True, False)  
-            log.info(f'The manifest and final metadata files, {file_array}, have been uploaded to destination successfully.')
+            result = upload_final_files(configs, final_file_path_list)
+            log.info(f'The manifest and final metadata files, {file_array}, have been uploaded to destination.')
     except Exception as e:
         log.info(f"Failed to add file id to the pre-manifest, {file_path}. Error: {e}") 
     finally:
@@ -93,119 +105,97 @@ def process_manifest_file(log, configs, has_file_id, file_infos, manifest_rows,
             log.info(f"Failed process the manifest and final metadata files, {file_array}.")
             return False
         else:
-            # update batch
-            status = result.get(BATCH_STATUS, False)
-            errors = [f"Failed to upload manifest and final metadata files,{file_array}"] if not status else []
-            # manifest_file_info = {"fileName": final_manifest_name, "succeeded": status, "errors": errors, "skipped": False}
-            final_file_info_list  = [ {"fileName": os.path.basename(file_path), "succeeded": status, "errors": errors, "skipped": False} for file_path in final_file_path_list]
-            if not apiInvoker.update_batch(newBatch[BATCH_ID], final_file_info_list):
+            # update batch with the result of each file
+            if not apiInvoker.update_batch(newBatch[BATCH_ID], result):
                 log.info(f"Failed to update batch, {newBatch[BATCH_ID]}!")
                 return False
             log.info(f"Successfully process the manifest and added file id into children tsv files, {file_array}.")
         return True
 
+"""
+upload the final manifest and metadata files with a bounded pool of workers, each worker owns its Copier.
+:param final_file_path_list: paths of final files
+:return: list of results of the files for updating batch
+"""
+def upload_final_files(configs, final_file_path_list):
+    worker_local = threading.local()
+    def upload(file_path):
+        copier = getattr(worker_local, 'copier', None)
+        if copier is None:
+            copier = worker_local.copier = Copier(configs[S3_BUCKET], configs[FILE_PREFIX], configs)
+        file_name = os.path.basename(file_path)
+        file_info = {FILE_NAME_DEFAULT: file_name, FILE_PATH: file_path, FILE_SIZE_DEFAULT: os.path.getsize(file_path)}
+        status = copier.copy_file(file_info, True, False).get(BATCH_STATUS, False)
+        errors = [] if status else (file_info.get(ERRORS) or [f"Failed to upload manifest and final metadata files,{file_name}"])
+        return {"fileName": file_name, "succeeded": status, "errors": errors, "skipped": False}
+
+    with ThreadPoolExecutor(max_workers=CHILD_FILE_THREADS) as executor:
+        return list(executor.map(upload, final_file_path_list))
+
 # This method will create a new manifest file with the file id column added to the pre-manifest and internal_file_name.
-def add_file_id(file_id_name, file_name_name, final_manifest_path, file_infos, manifest_rows, omit_prefix):
-    output = []
-    for row in manifest_rows:
-        file = [file for file in file_infos if file[FILE_NAME_DEFAULT] == row[file_name_name]][0]
-        file[FILE_ID_DEFAULT] = file[FILE_ID_DEFAULT] if omit_prefix == False else file[FILE_ID_DEFAULT].replace(DCF_PREFIX, "")
-        row[file_name_name] = os.path.basename(file[FILE_NAME_DEFAULT])
-        row[SUBFOLDER_FILE_NAME] = file[SUBFOLDER_FILE_NAME] if SUBFOLDER_FILE_NAME in file else ""
-        row[file_id_name] = file[FILE_ID_DEFAULT]
-        output.append(row.values())
-    manifest_columns = manifest_rows[0].keys()
+# The pre-manifest is read again row by row and each row is written once it is processed, manifest rows are not kept in memory.
+# Files are looked up by an index of file name, the first file of a name is used for all rows of the name.
+def add_file_id(file_id_name, file_name_name, final_manifest_path, file_infos, manifest_path, omit_prefix, md5_name=None):
+    files_by_name = {}
+    for file in file_infos:
+        files_by_name.setdefault(file[FILE_NAME_DEFAULT], file)
+    reader = ManifestReader(manifest_path, lowercase_columns=(md5_name,) if md5_name else ())
+    manifest_columns = None
     with open(final_manifest_path, 'w', newline='', encoding="utf8") as f: 
         writer = csv.writer(f, delimiter='\t')
-        writer.writerow(manifest_columns)
-        writer.writerows(output)
+        for manifest_row in reader:
+            if manifest_columns is None:
+                # internal_file_name and file id columns are appended if not in pre-manifest
+                manifest_columns = list(manifest_row.header.columns) + [column for column in (SUBFOLDER_FILE_NAME, file_id_name) if column not in manifest_row]
+                writer.writerow(manifest_columns)
+                appended_values = [None] * (len(manifest_columns) - len(manifest_row.header.columns))
+                file_name_index = manifest_columns.index(file_name_name)
+                subfolder_file_name_index = manifest_columns.index(SUBFOLDER_FILE_NAME)
+                file_id_index = manifest_columns.index(file_id_name)
+            values = list(manifest_row.values_) + appended_values
+            file = files_by_name[values[file_name_index]]
+            file[FILE_ID_DEFAULT] = file[FILE_ID_DEFAULT] if omit_prefix == False else file[FILE_ID_DEFAULT].replace(DCF_PREFIX, "")
+            values[file_name_index] = os.path.basename(file[FILE_NAME_DEFAULT])
+            values[subfolder_file_name_index] = file[SUBFOLDER_FILE_NAME] if SUBFOLDER_FILE_NAME in file else ""
+            values[file_id_index] = file[FILE_ID_DEFAULT]
+            writer.writerow(values)
     return True
 
 # insert file node ID into relationship data fiels in children's metadata file.
-def insert_file_id_2_children(log, configs, manifest_rows, final_file_path_list, manifest_s3_url):
+def insert_file_id_2_children(log, configs, manifest_rows, file_infos, final_file_path_list, manifest_s3_url):
      # check if any tsv files in the dir of manifest file
     manifest_file = configs.get(PRE_MANIFEST)
     is_s3 = configs.get(FROM_S3, False)
     if manifest_s3_url is None:
         is_s3 = False
-    dir = os.path.dirname(manifest_file) if not is_s3 else TEMP_DOWNLOAD_DIR
+    dir = os.path.dirname(manifest_file)
     s3_bucket = None
     try:
+        file_type = manifest_rows[0].get(NODE_TYPE_NAME) 
+        if not file_type:
+            return
+        file_id_to_check = f"{file_type}.{configs.get(FILE_ID_FIELD)}"
         if is_s3:
             s3_bucket = S3Bucket()
-            # download tsv or txt files from s3 to TEMP_DOWNLOAD_DIR
-            download_metadata_in_s3(manifest_s3_url, s3_bucket)
-            
-        tsv_files = [os.path.join(dir, f) for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f)) 
-                    and (f.endswith('.tsv') or f.endswith('.txt')) and f not in manifest_file and not "-final." in f]
-        file_type = manifest_rows[0].get(NODE_TYPE_NAME) 
-        children_files = []
-        if file_type:
-            file_id_to_check = f"{file_type}.{configs.get(FILE_ID_FIELD)}"
-            if len(tsv_files) > 0:
-                for file in tsv_files:
-                    if not os.path.isfile(file):
-                        continue
-                    try:
-                        with open(file) as f:
-                            reader = csv.DictReader(f, delimiter='\t')
-                            header = next(reader)  # get the first row
-                            if file_id_to_check in header:
-                                children_files.append(file)
-                            else:
-                                # remove the file if in temp dir
-                                if is_s3:
-                                    os.remove(file)
-                    except Exception:
-                        # remove the file if in temp dir
-                        if is_s3:
-                            os.remove(file)
-
-            if len(children_files) > 0:
-                for file in children_files:
-                    inserted = False
-                    row_errors = []
-                    # read tsv file to dataframe
-                    df = pd.read_csv(file, sep=SEPARATOR_CHAR, header=0, dtype='str', encoding=UTF8_ENCODE,keep_default_na=False,na_values=[''])
-                    if file_id_to_check in df.columns:
-                        for index, row in df.iterrows():
-                            fileName = row[file_id_to_check]
-                            # check if fileName is not None and is a string, skip invalid rows
-                            if fileName and isinstance(fileName, str) and fileName.strip():
-                                modified_file_name = fileName.replace("/", "_")
-                                file_info = next((row for row in manifest_rows if row[SUBFOLDER_FILE_NAME] == modified_file_name), None)
-                                if file_info:
-                                    file_id = file_info[configs[FILE_ID_FIELD]]
-                                    df.at[index, file_id_to_check] = file_id
-                                    inserted = True
-                                else:
-                                    # Not matched by internal_file_name; allow if the cell is already a valid file id
-                                    # (check fileName too — dg.4DFC/... is altered by replace("/", "_") for lookup)
-                                    cell = fileName.strip() if fileName else ""
-                                    if _is_valid_file_id_value(modified_file_name, configs) or _is_valid_file_id_value(cell, configs):
-                                        inserted = True
-                                    else:
-                                        id_label = configs.get(FILE_ID_FIELD, "file_id")
-                                        row_errors.append(
-                                            f'Child template {os.path.basename(file)} row {int(index) + 2}: '
-                                            f'"{fileName}" is not a valid file in the manifest or '
-                                            f'a valid "{id_label}".'
-                                        )
-                        if row_errors:
-                            for msg in row_errors:
-                                log.error(msg)
-                            # remove the file if in temp dir
-                            if is_s3:
-                                os.remove(file)
-                        elif inserted:
-                            file_ext = '.tsv' if file.endswith('.tsv') else '.txt'
-                            final_file_path = file.replace(file_ext, f'-final{file_ext}')
-                            df.to_csv(final_file_path, sep ='\t', index=False)
-                            final_file_path_list.append(final_file_path)
-                        else:
-                            # remove the file if in temp dir
-                            if is_s3:
-                                os.remove(file)
+            # download child files of the file node from s3 to TEMP_DOWNLOAD_DIR
+            tsv_files = download_metadata_in_s3(manifest_s3_url, s3_bucket, file_id_to_check)
+        else:
+            tsv_files = [os.path.join(dir, f) for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f)) 
+                        and is_metadata_file_name(f) and f not in manifest_file]
+        if len(tsv_files) > 0:
+            # index of internal_file_name -> file id, the first file of a name is used
+            file_id_index = {}
+            for file_info in file_infos:
+                if file_info.get(SUBFOLDER_FILE_NAME):
+                    file_id_index.setdefault(file_info[SUBFOLDER_FILE_NAME], file_info[FILE_ID_DEFAULT])
+            # child files are processed concurrently, the results are handled in the order of the files
+            with ThreadPoolExecutor(max_workers=CHILD_FILE_THREADS) as executor:
+                results = list(executor.map(lambda file: process_child_file(file, file_id_to_check, file_id_index, configs, is_s3), tsv_files))
+            for final_file_path, row_errors in results:
+                for msg in row_errors:
+                    log.error(msg)
+                if final_file_path:
+                    final_file_path_list.append(final_file_path)
     except Exception as e:
         log.exception(f"Failed to insert file id into children tsv files. Error: {e}")
     finally:
@@ -213,18 +203,118 @@ def insert_file_id_2_children(log, configs, manifest_rows, final_file_path_list,
             s3_bucket = None
 
 """
-download tsv or txt files from s3 to TEMP_DOWNLOAD_DIR
+check if a metadata file is a child of the file node by its header, and insert file ids into it.
+:param is_s3: the file is downloaded to temp dir, it is removed if it's not a valid child file
+:return: (final file path or None, row errors)
+"""
+def process_child_file(file, file_id_to_check, file_id_index, configs, is_s3):
+    if not os.path.isfile(file):
+        return None, []
+    try:
+        # only the header line is read
+        with open(file) as f:
+            is_child = is_child_header(f.readline(), file_id_to_check)
+    except Exception:
+        is_child = False
+    if not is_child:
+        # remove the file if in temp dir
+        if is_s3:
+            os.remove(file)
+        return None, []
+    file_ext = '.tsv' if file.endswith('.tsv') else '.txt'
+    final_file_path = file.replace(file_ext, f'-final{file_ext}')
+    inserted, row_errors = insert_file_id_2_child_file(file, final_file_path, file_id_to_check, file_id_index, configs)
+    if not row_errors and inserted:
+        return final_file_path, row_errors
+    if os.path.isfile(final_file_path):
+        os.remove(final_file_path)
+    # remove the file if in temp dir
+    if is_s3:
+        os.remove(file)
+    return None, row_errors
+
+"""
+check if the header line of a metadata file has the file id column of the file node
+"""
+def is_child_header(header_line, file_id_to_check):
+    header = next(csv.reader([header_line], delimiter='\t'), [])
+    return file_id_to_check in header
+
+"""
+insert file ids into a child metadata file, the file is read, rewritten and written in chunks of CHILD_CHUNK_ROWS rows,
+so memory usage doesn't depend on the file size. The final file is removed if it fails.
+:param file_id_index: dict of internal_file_name -> file id
+:return: (inserted, row_errors), the final file is valid only if any file id is inserted and there is no row error
+"""
+def insert_file_id_2_child_file(file, final_file_path, file_id_to_check, file_id_index, configs):
+    inserted = False
+    row_errors = []
+    id_label = configs.get(FILE_ID_FIELD, "file_id")
+    try:
+        with open(final_file_path, 'w', newline='', encoding=UTF8_ENCODE) as f:
+            # rows of chunks are numbered continuously
+            chunks = pd.read_csv(file, sep=SEPARATOR_CHAR, header=0, dtype='str', encoding=UTF8_ENCODE, keep_default_na=False, na_values=[''],
+                                 chunksize=CHILD_CHUNK_ROWS)
+            for chunk_number, df in enumerate(chunks):
+                if file_id_to_check not in df.columns:
+                    break
+                file_names = df[file_id_to_check]
+                # skip empty cells
+                present = file_names.str.strip().str.len().fillna(0) > 0
+                file_names = file_names[present]
+                # file ids were set to file infos when adding file id to the pre-manifest
+                file_ids = file_names.str.replace("/", "_", regex=False).map(file_id_index)
+                matched = file_ids.notna()
+                df.loc[file_ids.index[matched], file_id_to_check] = file_ids[matched]
+                # Not matched by internal_file_name; allow if the cell is already a valid file id
+                unmatched = file_names[~matched]
+                valid = _valid_file_id_values(unmatched, configs)
+                inserted = inserted or bool(matched.any() or valid.any())
+                for index, fileName in unmatched[~valid].items():
+                    row_errors.append(
+                        f'Child template {os.path.basename(file)} row {int(index) + 2}: '
+                        f'"{fileName}" is not a valid file in the manifest or '
+                        f'a valid "{id_label}".'
+                    )
+                # the final file is useless once a row is invalid, the rest is only checked
+                if not row_errors:
+                    df.to_csv(f, sep='\t', index=False, header=chunk_number == 0)
+    except Exception:
+        if os.path.isfile(final_file_path):
+            os.remove(final_file_path)
+        raise
+    return inserted, row_errors
+
 """
-def download_metadata_in_s3(manifest_file_path, s3_bucket):
+check if a file may be a child file, tsv or txt files except final files written by previous runs
+"""
+def is_metadata_file_name(file_name):
+    return (file_name.endswith('.tsv') or file_name.endswith('.txt')) and not "-final." in file_name
+
+"""
+download child files of the file node, tsv or txt files in the folder of the manifest in s3, to TEMP_DOWNLOAD_DIR.
+Only the header of each file is read first, a file is downloaded only if its header has the file id column.
+:param file_id_to_check: file id column of the file node in child files
+:return: paths of downloaded files
+"""
+def download_metadata_in_s3(manifest_file_path, s3_bucket, file_id_to_check):
     #  s3://crdcdh-test-submission/9f42b5f1-5ea4-4923-a9bb-f496c63362ce/file/file.txt
     bucket, prefix, manifest_file = get_s3_bucket_and_prefix(manifest_file_path)
-    # download all files with ext "tsv" or "txt" in the folder of prefix from s3
     s3_bucket.set_s3_client(bucket, None)
-    metadata_files = s3_bucket.get_contents_in_current_folder(prefix)
-    for file in metadata_files:
-        if not manifest_file in file:
-            file_name = file.split("/")[-1]
-            s3_bucket.download_object(file, os.path.join(TEMP_DOWNLOAD_DIR,file_name))
+    metadata_files = [file for file in s3_bucket.get_contents_in_current_folder(prefix)
+                      if is_metadata_file_name(file.split("/")[-1]) and not manifest_file in file]
+    # files are sniffed and downloaded concurrently with the client of s3_bucket, boto3 clients are thread-safe
+    def download(file):
+        header_line = s3_bucket.get_object_first_line(file)
+        if header_line is None or not is_child_header(header_line, file_id_to_check):
+            return None
+        file_path = os.path.join(TEMP_DOWNLOAD_DIR, file.split("/")[-1])
+        result, _ = s3_bucket.download_object(file, file_path)
+        return file_path if result else None
+
+    with ThreadPoolExecutor(max_workers=CHILD_FILE_THREADS) as executor:
+        return [file_path for file_path in executor.map(download, metadata_files) if file_path]
+
 """
 upload metadata file into s3
 """
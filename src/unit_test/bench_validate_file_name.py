@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Benchmark of FileValidator.validate_file_name, time per row should stay flat when the manifest grows.
+Not collected by pytest, run it directly:
+    python src/unit_test/bench_validate_file_name.py [max rows]
+"""
+import os
+import sys
+import time
+from unittest.mock import Mock, patch
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from file_validator import FileValidator
+from common.constants import FILE_NAME_FIELD, FILE_MD5_FIELD, UPLOAD_TYPE, TYPE_FILE
+
+
+def bench(rows):
+    configs = {UPLOAD_TYPE: TYPE_FILE, FILE_NAME_FIELD: 'file_name', FILE_MD5_FIELD: 'md5sum'}
+    with patch('file_validator.get_logger'):
+        validator = FileValidator(configs)
+    validator.log = Mock()
+    # every 1000th file is listed twice with the same md5
+    validator.manifest_rows = [{'file_name': f'dir/sample_{i % (rows - rows // 1000)}.bam', 'md5sum': f'{i % (rows - rows // 1000):032x}'}
+                               for i in range(rows)]
+    start = time.perf_counter()
+    assert validator.validate_file_name()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    rows = 125_000
+    while rows <= max_rows:
+        elapsed = bench(rows)
+        print(f'{rows:>10,} rows: {elapsed:8.3f} s, {elapsed / rows * 1e6:6.3f} us/row')
+        rows *= 2
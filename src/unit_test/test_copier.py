@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Unit tests for Copier.copy_file uploading local files"""
+import os
+import sys
+import hashlib
+import pytest
+from unittest.mock import Mock, patch
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from copier import Copier
+from common.constants import UPLOAD_TYPE, TYPE_FILE, FILE_NAME_DEFAULT, FILE_PATH, FILE_SIZE_DEFAULT, MD5_DEFAULT
+
+
+@pytest.fixture
+def copier():
+    with patch('copier.S3Bucket'), patch('copier.get_logger'):
+        copier = Copier('bucket', 'submission/file', {UPLOAD_TYPE: TYPE_FILE})
+    copier.dest_index = {}
+    return copier
+
+
+def make_file_info(tmp_path, content):
+    file_path = tmp_path / 'a.bam'
+    file_path.write_bytes(content)
+    return {FILE_NAME_DEFAULT: 'a.bam', FILE_PATH: str(file_path), FILE_SIZE_DEFAULT: len(content),
+            MD5_DEFAULT: hashlib.md5(content).hexdigest()}
+
+
+class TestUploadObj:
+
+    def test_put_confirmed_by_etag(self, copier, tmp_path):
+        file_info = make_file_info(tmp_path, b'content')
+        copier.bucket.put_file_obj.return_value = {'ETag': f'"{file_info[MD5_DEFAULT]}"'}
+
+        result = copier.copy_file(file_info, False, False)
+
+        assert result[Copier.STATUS]
+        assert copier.dest_index['submission/file/a.bam'] == (len(b'content'), file_info[MD5_DEFAULT])
+        copier.bucket.get_object_size.assert_not_called()
+
+    def test_put_with_different_etag_fails(self, copier, tmp_path):
+        file_info = make_file_info(tmp_path, b'content')
+        copier.bucket.put_file_obj.return_value = {'ETag': f'"{hashlib.md5(b"other").hexdigest()}"'}
+
+        result = copier.copy_file(file_info, False, False)
+
+        assert not result[Copier.STATUS]
+        assert 'submission/file/a.bam' not in copier.dest_index
+
+    @pytest.mark.parametrize('response', [{'ServerSideEncryption': 'aws:kms'}, {'ServerSideEncryption': 'aws:kms:dsse'},
+                                          {'SSECustomerAlgorithm': 'AES256'}])
+    def test_etag_of_encrypted_object_is_not_checked(self, copier, tmp_path, response):
+        file_info = make_file_info(tmp_path, b'content')
+        copier.bucket.put_file_obj.return_value = dict(response, ETag='"not-md5"')
+
+        result = copier.copy_file(file_info, False, False)
+
+        assert result[Copier.STATUS]
+        assert copier.dest_index['submission/file/a.bam'] == (len(b'content'), 'not-md5')
+
+    @pytest.mark.parametrize('completed_etag, succeeded', [(None, True), ('0' * 32 + '-2', False)])
+    def test_multipart_upload_confirmed_by_etag(self, copier, tmp_path, completed_etag, succeeded):
+        file_info = make_file_info(tmp_path, b'content')
+        parts = [{'PartNumber': 1, 'ETag': f'"{hashlib.md5(b"cont").hexdigest()}"'},
+                 {'PartNumber': 2, 'ETag': f'"{hashlib.md5(b"ent").hexdigest()}"'}]
+        multipart_etag = hashlib.md5(hashlib.md5(b'cont').digest() + hashlib.md5(b'ent').digest()).hexdigest() + '-2'
+        copier.bucket.parts = parts
+        copier.bucket.upload_large_file_partly.return_value = (len(b'content'), {'ETag': f'"{completed_etag or multipart_etag}"'})
+
+        with patch.object(Copier, 'MULTI_PART_THRESHOLD', 4), patch('copier.create_progress_bar'):
+            result = copier.copy_file(file_info, False, False)
+
+        assert result[Copier.STATUS] == succeeded
+        copier.bucket.put_file_obj.assert_not_called()
+        if succeeded:
+            assert copier.dest_index['submission/file/a.bam'] == (len(b'content'), multipart_etag)
+
+
+class TestCopyS3Object:
+
+    @pytest.mark.parametrize('response, succeeded', [
+        ({'CopyObjectResult': {'ETag': '"md5"'}}, True),
+        ({'CopyObjectResult': {'ETag': '"other"'}, 'ServerSideEncryption': 'AES256'}, False),
+        ({'CopyObjectResult': {'ETag': '"other"'}, 'ServerSideEncryption': 'aws:kms'}, True),
+    ])
+    def test_copied_etag_is_checked_if_md5_based(self, copier, response, succeeded):
+        file_info = {FILE_NAME_DEFAULT: 'a.bam', FILE_SIZE_DEFAULT: 7, MD5_DEFAULT: 'md5'}
+        copier.bucket.copy_object_from.return_value = response
+
+        result = copier.copy_s3_object(file_info, 'source', 'source/a.bam', False, False)
+
+        assert result[Copier.STATUS] == succeeded
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Unit tests for common.file_record.FileRecord"""
+import os
+import sys
+import pytest
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.file_record import FileRecord
+from common.constants import FILE_NAME_DEFAULT, FILE_PATH, FILE_SIZE_DEFAULT, MD5_DEFAULT, SUCCEEDED, ERRORS, \
+    SKIPPED, FILE_ID_DEFAULT, SUBFOLDER_FILE_NAME
+from common.utils import dump_dict_to_tsv
+
+
+class TestFileRecord:
+    """Test suite for FileRecord"""
+
+    def test_record_as_dict(self):
+        """Test that a record is used as a dict of the keys which are set"""
+        record = FileRecord(**{FILE_NAME_DEFAULT: 'a.txt', FILE_SIZE_DEFAULT: 10})
+        record[SKIPPED] = False
+
+        assert record[FILE_NAME_DEFAULT] == 'a.txt'
+        assert record.get(MD5_DEFAULT) is None
+        assert record.get(MD5_DEFAULT, '') == ''
+        assert MD5_DEFAULT not in record and SKIPPED in record
+        assert dict(record) == {FILE_NAME_DEFAULT: 'a.txt', FILE_SIZE_DEFAULT: 10, SKIPPED: False}
+        with pytest.raises(KeyError):
+            record[MD5_DEFAULT]
+        del record[SKIPPED]
+        assert SKIPPED not in record
+
+    def test_unknown_key(self):
+        """Test that keys other than file record keys can't be set"""
+        record = FileRecord()
+        with pytest.raises(KeyError):
+            record['unknown'] = 1
+        assert record.get('ttl') is None, "ttl is not a key of the record"
+
+    def test_keys_in_report_order(self):
+        """Test that keys are in the order of report columns whatever order they are set"""
+        record = FileRecord(**{SKIPPED: True, ERRORS: None, SUCCEEDED: True, FILE_NAME_DEFAULT: 'a.txt', FILE_ID_DEFAULT: 'id'})
+
+        assert list(record) == [FILE_ID_DEFAULT, FILE_NAME_DEFAULT, SUCCEEDED, ERRORS, SKIPPED]
+
+    def test_dump_records_to_tsv(self, tmp_path):
+        """Test that records are dumped to report without file path"""
+        records = [
+            FileRecord(**{FILE_NAME_DEFAULT: 'a.txt', FILE_PATH: '/tmp/a.txt', SUCCEEDED: False, ERRORS: ['failed']}),
+            FileRecord(**{FILE_NAME_DEFAULT: 'b.txt', FILE_PATH: '/tmp/b.txt', SUCCEEDED: True, ERRORS: None,
+                          SUBFOLDER_FILE_NAME: 'b.txt', SKIPPED: False}),
+        ]
+        report = tmp_path / 'report.tsv'
+
+        assert dump_dict_to_tsv(records, str(report), exclude_keys=[FILE_PATH])
+
+        assert report.read_text(encoding='utf-8').splitlines() == [
+            f'{FILE_NAME_DEFAULT}\t{SUCCEEDED}\t{ERRORS}\t{SUBFOLDER_FILE_NAME}\t{SKIPPED}',
+            "a.txt\tFalse\t['failed']\t\t",
+            'b.txt\tTrue\t\tb.txt\tFalse',
+        ]
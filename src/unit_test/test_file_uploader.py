@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Unit tests for FileUploader.upload"""
+import os
+import sys
+import threading
+import pytest
+from collections import deque
+from unittest.mock import Mock, patch
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from file_uploader import FileUploader
+from copier import Copier
+from common.file_record import FileRecord
+from common.staging_cache import StagingCache
+from common.s3util import SINGLE_PUT_LIMIT
+from common.constants import (
+    FILE_NAME_DEFAULT, FILE_PATH, FILE_SIZE_DEFAULT, SUCCEEDED, ERRORS, RETRIES,
+    FILE_PREFIX, S3_BUCKET, FROM_S3, UPLOAD_THREADS, MAX_INFLIGHT_MB, MD5_DEFAULT,
+    SERVER_SIDE_COPY, SUBFOLDER_FILE_NAME, FILE_DIR, PREFETCH_FILES
+)
+
+
+class FakeCopier:
+    """Copier double, fails "flaky" files once and "broken" files always"""
+    STATUS = 'status'
+    lock = threading.Lock()
+    attempts = {}
+
+    def __init__(self, bucket_name, prefix, configs, memory_budget=None):
+        self.files_copied = 0
+        self.files_exist_at_dest = 0
+        self.files_not_found = set()
+        self.dest_index = None
+
+    def load_dest_index(self):
+        self.dest_index = {}
+
+    def copy_file(self, file_info, overwrite, dryrun):
+        name = file_info[FILE_NAME_DEFAULT]
+        with self.lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            attempt = self.attempts[name]
+        if name.startswith('broken') or (name.startswith('flaky') and attempt == 1):
+            file_info[ERRORS] = [f'Uploading “{name}” failed - network error.']
+            return {self.STATUS: False}
+        self.files_copied += 1
+        return {self.STATUS: True}
+
+
+def make_file_list():
+    names = ['file1.bam', 'flaky1.bam', 'file2.bam', 'broken1.bam', 'file3.bam', 'flaky2.bam']
+    return [FileRecord(**{FILE_NAME_DEFAULT: name, FILE_PATH: f'/tmp/{name}', FILE_SIZE_DEFAULT: 10}) for name in names]
+
+
+def run_upload(threads, file_list):
+    configs = {
+        RETRIES: 2,
+        FILE_PREFIX: 'submission/file',
+        S3_BUCKET: 'bucket',
+        FROM_S3: False,
+        UPLOAD_THREADS: threads,
+        MAX_INFLIGHT_MB: 1,
+    }
+    FakeCopier.attempts = {}
+    with patch('file_uploader.get_logger'), patch('file_uploader.Copier', FakeCopier):
+        uploader = FileUploader(configs, file_list, None, None)
+        uploader.log = Mock()
+        result = uploader.upload()
+    return uploader, result
+
+
+class TestConcurrentUpload:
+    """Concurrent upload must report the same per-file results as serial upload"""
+
+    @pytest.mark.parametrize('threads', [2, 4])
+    def test_concurrent_results_match_serial(self, threads):
+        serial_list = make_file_list()
+        serial, serial_result = run_upload(1, serial_list)
+        concurrent_list = make_file_list()
+        concurrent, concurrent_result = run_upload(threads, concurrent_list)
+
+        assert serial_result == concurrent_result
+        assert serial.files_processed == concurrent.files_processed
+        assert serial.files_failed == concurrent.files_failed == 1
+        for expected, actual in zip(serial_list, concurrent_list):
+            assert expected.get(SUCCEEDED) == actual.get(SUCCEEDED)
+            assert expected.get(ERRORS) == actual.get(ERRORS)
+
+    def test_concurrent_retries_failed_files(self):
+        file_list = make_file_list()
+        uploader, result = run_upload(3, file_list)
+
+        assert result
+        assert FakeCopier.attempts['flaky1.bam'] == 2
+        assert FakeCopier.attempts['broken1.bam'] == 2
+        assert [f[FILE_NAME_DEFAULT] for f in file_list if not f[SUCCEEDED]] == ['broken1.bam']
+
+
+class FakeSourceBucket:
+    """Source S3Bucket double, writes downloaded files and records downloads"""
+    lock = threading.Lock()
+    downloads = []
+
+    def set_s3_client(self, bucket, configs):
+        pass
+
+    def download_object_with_md5(self, key, local_file_path):
+        with self.lock:
+            self.downloads.append(key)
+        if 'missing' in key:
+            return None, f'File {key} does not exist in the specified S3 bucket path.'
+        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+        with open(local_file_path, 'wb') as f:
+            f.write(b'x' * 10)
+        return 'md5', None
+
+
+def fake_validate_data_file(file_info, *args):
+    if file_info[FILE_NAME_DEFAULT].startswith('invalid'):
+        file_info[ERRORS] = ['md5 of file is not matched.']
+        return False
+    return True
+
+
+def run_s3_upload(prefetch_files, file_list, download_dir):
+    configs = {
+        RETRIES: 2,
+        FILE_PREFIX: 'submission/file',
+        S3_BUCKET: 'bucket',
+        FROM_S3: True,
+        FILE_DIR: 's3://source-bucket/source',
+        PREFETCH_FILES: prefetch_files,
+    }
+    FakeCopier.attempts = {}
+    FakeSourceBucket.downloads = []
+    with patch('file_uploader.get_logger'), patch('file_uploader.Copier', FakeCopier), \
+            patch('file_uploader.S3Bucket', FakeSourceBucket), patch('file_uploader.TEMP_DOWNLOAD_DIR', download_dir), \
+            patch('file_uploader.validate_data_file', fake_validate_data_file):
+        uploader = FileUploader(configs, file_list, None, None)
+        uploader.log = Mock()
+        result = uploader.upload()
+    return uploader, result
+
+
+def make_s3_file_list():
+    names = ['file1.bam', 'flaky1.bam', 'missing1.bam', 'broken1.bam', 'invalid1.bam', 'file2.bam']
+    return [FileRecord(**{FILE_NAME_DEFAULT: name, SUBFOLDER_FILE_NAME: name, FILE_PATH: f'tmp/download/{name}', FILE_SIZE_DEFAULT: 10})
+            for name in names]
+
+
+class TestPrefetchS3Files:
+    """Prefetching s3 source files must report the same per-file results as preparing them one by one"""
+
+    @pytest.mark.parametrize('prefetch_files', [2, 4])
+    def test_prefetch_results_match_serial(self, prefetch_files, tmp_path):
+        serial_list = make_s3_file_list()
+        serial, serial_result = run_s3_upload(1, serial_list, str(tmp_path / 'serial'))
+        prefetch_list = make_s3_file_list()
+        prefetch, prefetch_result = run_s3_upload(prefetch_files, prefetch_list, str(tmp_path / 'prefetch'))
+
+        assert serial_result == prefetch_result
+        assert serial.files_processed == prefetch.files_processed
+        assert serial.files_failed == prefetch.files_failed == 1
+        assert serial.invalid_count == prefetch.invalid_count == 2
+        for expected, actual in zip(serial_list, prefetch_list):
+            assert expected.get(SUCCEEDED) == actual.get(SUCCEEDED)
+            assert expected.get(ERRORS) == actual.get(ERRORS)
+
+    def test_retry_reuses_downloaded_file(self, tmp_path):
+        file_list = make_s3_file_list()
+        run_s3_upload(2, file_list, str(tmp_path))
+
+        assert FakeCopier.attempts['flaky1.bam'] == 2
+        assert FakeCopier.attempts['broken1.bam'] == 2
+        assert FakeSourceBucket.downloads.count('source/flaky1.bam') == 1
+        assert FakeSourceBucket.downloads.count('source/broken1.bam') == 1
+        assert os.listdir(tmp_path) == [], "Downloaded files should be deleted after uploading"
+
+    def test_prefetch_within_staging_budget(self, s3_uploader):
+        s3_uploader.server_side_copy = False
+        s3_uploader.prefetch_files = 3
+        s3_uploader.total_file_count = 6
+        s3_uploader.staging_cache = StagingCache(25, Mock())
+        file_queue = deque(make_s3_file_list())
+        executor = Mock()
+        prefetched = {}
+
+        s3_uploader._prefetch(executor, file_queue, prefetched, 0)
+
+        assert len(prefetched) == 2, "Only files fitting in the staging budget should be prefetched"
+        assert [call.args[1][FILE_NAME_DEFAULT] for call in executor.submit.call_args_list] == ['file1.bam', 'flaky1.bam']
+
+
+@pytest.fixture
+def s3_uploader():
+    configs = {RETRIES: 3, FILE_PREFIX: 'submission/file', S3_BUCKET: 'bucket', FROM_S3: True, SERVER_SIDE_COPY: True}
+    with patch('file_uploader.get_logger'):
+        uploader = FileUploader(configs, [], None, None)
+    uploader.log = Mock()
+    uploader.from_prefix = 'source'
+    uploader.from_bucket_name = 'source-bucket'
+    uploader.file_dir = 's3://source-bucket/source'
+    uploader.s3_bucket = Mock()
+    uploader.copier = Mock()
+    return uploader
+
+
+class TestServerSideCopy:
+    """Unit tests for FileUploader._copy_in_s3"""
+    MD5 = '9e107d9d372bb6826bd81d3542a419d6'
+
+    def file_info(self, name='sample.bam'):
+        return FileRecord(**{FILE_NAME_DEFAULT: name, FILE_SIZE_DEFAULT: 100, MD5_DEFAULT: self.MD5})
+
+    def test_copy_when_etag_matches_md5(self, s3_uploader):
+        s3_uploader.s3_bucket.get_object_info.return_value = (100, self.MD5, None)
+        s3_uploader.copier.copy_s3_object.return_value = {Copier.STATUS: True}
+
+        assert s3_uploader._copy_in_s3(self.file_info())
+        s3_uploader.copier.copy_s3_object.assert_called_once()
+        assert s3_uploader.copier.copy_s3_object.call_args[0][2] == 'source/sample.bam'
+
+    def test_download_when_etag_is_not_md5(self, s3_uploader):
+        s3_uploader.s3_bucket.get_object_info.return_value = (100, 'a0b1c2d3e4f5a0b1c2d3e4f5a0b1c2d3-12', None)
+
+        assert not s3_uploader._copy_in_s3(self.file_info())
+        s3_uploader.copier.copy_s3_object.assert_not_called()
+
+    def test_download_file_over_single_copy_limit(self, s3_uploader):
+        size = SINGLE_PUT_LIMIT + 1
+        s3_uploader.s3_bucket.get_object_info.return_value = (size, self.MD5, None)
+        file_info = self.file_info()
+        file_info[FILE_SIZE_DEFAULT] = size
+
+        assert not s3_uploader._copy_in_s3(file_info)
+        s3_uploader.copier.copy_s3_object.assert_not_called()
+
+    def test_download_zip_file(self, s3_uploader):
+        assert not s3_uploader._copy_in_s3(self.file_info('archive.zip'))
+        s3_uploader.s3_bucket.get_object_info.assert_not_called()
+
+    def test_access_denied_disables_server_side_copy(self, s3_uploader):
+        s3_uploader.s3_bucket.get_object_info.return_value = (100, self.MD5, None)
+        s3_uploader.copier.copy_s3_object.return_value = {Copier.STATUS: False}
+        s3_uploader.copier.s3_copy_denied = True
+
+        assert not s3_uploader._copy_in_s3(self.file_info())
+        assert not s3_uploader.server_side_copy
+
+
+class TestPrepareS3DownloadFile:
+    """Unit tests for FileUploader.prepare_s3_download_file"""
+    MD5 = '9e107d9d372bb6826bd81d3542a419d6'
+
+    def file_info(self):
+        return FileRecord(**{FILE_NAME_DEFAULT: 'dir/sample.bam', SUBFOLDER_FILE_NAME: 'dir_sample.bam',
+                             FILE_SIZE_DEFAULT: 100, MD5_DEFAULT: self.MD5})
+
+    def test_md5_of_download_is_cached_for_validation(self, s3_uploader):
+        s3_uploader.md5_cache = Mock()
+        s3_uploader.s3_bucket.download_object_with_md5.return_value = (self.MD5, None)
+        file_info = self.file_info()
+
+        with patch('file_uploader.validate_data_file', return_value=True) as validate:
+            assert s3_uploader.prepare_s3_download_file(file_info, 1, 1)
+
+        file_path = file_info[FILE_PATH]
+        s3_uploader.s3_bucket.download_object_with_md5.assert_called_once_with('source/dir/sample.bam', file_path)
+        s3_uploader.md5_cache.put.assert_called_once_with(file_path, self.MD5)
+        validate.assert_called_once()
+
+    def test_download_failure(self, s3_uploader):
+        s3_uploader.md5_cache = Mock()
+        s3_uploader.s3_bucket.download_object_with_md5.return_value = (None, 'File source/dir/sample.bam does not exist in the specified S3 bucket path.')
+        file_info = self.file_info()
+
+        with patch('file_uploader.validate_data_file') as validate:
+            assert not s3_uploader.prepare_s3_download_file(file_info, 1, 1)
+
+        assert file_info[SUCCEEDED] is False
+        assert file_info[ERRORS] == ['File source/dir/sample.bam does not exist in the specified S3 bucket path.']
+        s3_uploader.md5_cache.put.assert_not_called()
+        validate.assert_not_called()
+
+    def test_validated_download_is_reused_by_retry(self, s3_uploader, tmp_path):
+        s3_uploader.md5_cache = Mock()
+        s3_uploader.s3_bucket.download_object_with_md5.return_value = (self.MD5, None)
+        file_info = self.file_info()
+
+        with patch('file_uploader.TEMP_DOWNLOAD_DIR', str(tmp_path)), \
+                patch('file_uploader.validate_data_file', return_value=True) as validate:
+            assert s3_uploader.prepare_s3_download_file(file_info, 1, 1)
+            with open(file_info[FILE_PATH], 'wb') as f:
+                f.write(b'x' * 100)
+            assert s3_uploader.prepare_s3_download_file(file_info, 1, 1)
+
+        s3_uploader.s3_bucket.download_object_with_md5.assert_called_once()
+        validate.assert_called_once()
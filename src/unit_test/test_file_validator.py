@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 from unittest.mock import Mock, MagicMock, patch
+import io
 import os
 import sys
+import hashlib
+import zipfile
 import pytest
 
 # Add src to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from file_validator import FileValidator
+from file_validator import FileValidator, get_file_md5, validate_zip_file, validate_data_file
+from common.md5_cache import Md5Cache
 from common.constants import (
     FILE_NAME_DEFAULT, FILE_SIZE_DEFAULT, MD5_DEFAULT, FILE_NAME_FIELD, 
     FILE_MD5_FIELD, PRE_MANIFEST, UPLOAD_TYPE, TYPE_FILE, FILE_DIR,
-    FROM_S3, ARCHIVE_MANIFEST, FILE_ID_FIELD, FILE_ID_DEFAULT
+    FROM_S3, ARCHIVE_MANIFEST, FILE_ID_FIELD, FILE_ID_DEFAULT, VALIDATION_THREADS, FILE_PATH, ARCHIVE_NAME, ERRORS
 )
 
 
@@ -386,3 +390,196 @@ class TestValidateFileNameEdgeCases:
         result = validator.validate_file_name()
         
         assert result, "File names with spaces should pass"
+
+
+class TestPrehashDataFiles:
+    """Test suite for hashing data files concurrently before validating"""
+
+    def test_prehash_data_files_fills_md5_cache(self, validator, tmp_path):
+        """Test that md5s are cached and reused by get_file_md5"""
+        contents = {f'file{i}.txt': os.urandom(1000 * i) for i in range(1, 6)}
+        for name, content in contents.items():
+            (tmp_path / name).write_bytes(content)
+        validator.file_dir = str(tmp_path)
+        validator.md5_cache = Md5Cache(str(tmp_path / 'cache'))
+        validator.configs[VALIDATION_THREADS] = 3
+        validator.files_info = [{FILE_NAME_DEFAULT: name, FILE_SIZE_DEFAULT: str(len(content)), MD5_DEFAULT: 'md5'}
+                                for name, content in contents.items()]
+
+        validator.prehash_data_files()
+
+        with patch('file_validator.calculate_file_md5') as calculate:
+            for name, content in contents.items():
+                md5sum = get_file_md5(str(tmp_path / name), validator.md5_cache, len(content), validator.log)
+                assert md5sum == hashlib.md5(content).hexdigest()
+            calculate.assert_not_called()
+
+    def test_prehash_data_files_skips_invalid_files(self, validator, tmp_path):
+        """Test that missing files and files with wrong size are left to validate_data_file"""
+        (tmp_path / 'a.txt').write_bytes(b'12345')
+        validator.file_dir = str(tmp_path)
+        validator.md5_cache = Md5Cache(str(tmp_path / 'cache'))
+        validator.configs[VALIDATION_THREADS] = 2
+        validator.files_info = [
+            {FILE_NAME_DEFAULT: 'a.txt', FILE_SIZE_DEFAULT: '6', MD5_DEFAULT: 'md5'},
+            {FILE_NAME_DEFAULT: 'missing.txt', FILE_SIZE_DEFAULT: '5', MD5_DEFAULT: 'md5'},
+        ]
+
+        validator.prehash_data_files()
+
+        assert validator.md5_cache.get(str(tmp_path / 'a.txt')) is None
+
+    def test_read_error_is_not_cached(self, validator, tmp_path):
+        """Test that md5 of a partially read file is neither cached nor reported as md5 mismatch"""
+        content = os.urandom(3 * 1024 * 1024)
+        (tmp_path / 'a.bam').write_bytes(content)
+        validator.file_dir = str(tmp_path)
+        validator.md5_cache = Md5Cache(str(tmp_path / 'cache'))
+        validator.configs[VALIDATION_THREADS] = 2
+        file_info = {FILE_NAME_DEFAULT: 'a.bam', FILE_SIZE_DEFAULT: str(len(content)), MD5_DEFAULT: hashlib.md5(content).hexdigest()}
+        validator.files_info = [file_info]
+
+        class FailingFile(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell():
+                    raise OSError('Input/output error')
+                return super().read(size)
+
+        with patch('common.md5_calculator.open', create=True, side_effect=lambda *args: FailingFile(content)):
+            validator.prehash_data_files()
+            assert validator.md5_cache.get(str(tmp_path / 'a.bam')) is None
+            assert not validate_data_file(file_info, len(content), str(tmp_path / 'a.bam'), validator.md5_cache, validator.log)
+
+        assert 'does not match' not in file_info[ERRORS][0]
+        assert validator.md5_cache.get(str(tmp_path / 'a.bam')) is None
+
+
+ZIP_CONTENTS = {'a.txt': b'a' * 3000, 'dir/b.txt': b'b' * 5000, 'dir/sub/c.txt': os.urandom(70000)}
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    """Fixture for a zip file with macOS metadata"""
+    path = tmp_path / 'archive.zip'
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, content in ZIP_CONTENTS.items():
+            zip_file.writestr(name, content)
+        zip_file.writestr('__MACOSX/dir/._b.txt', b'resource fork')
+        zip_file.writestr('dir/.DS_Store', b'finder')
+    return str(path)
+
+
+def archive_files(contents=ZIP_CONTENTS):
+    return {name: (len(content), hashlib.md5(content).hexdigest()) for name, content in contents.items()}
+
+
+class TestValidateZipFile:
+    """Test suite for validating contents of zip file"""
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    def test_validate_zip_file_valid(self, zip_path, threads, tmp_path, monkeypatch):
+        """Test that valid contents pass without extracting the zip file"""
+        monkeypatch.chdir(tmp_path)
+        log = Mock()
+
+        assert validate_zip_file(archive_files(), zip_path, log, threads)
+        log.error.assert_not_called()
+        assert os.listdir(tmp_path) == ['archive.zip'], "Zip file should not be extracted"
+
+    def test_validate_zip_file_wrong_md5_and_size(self, zip_path):
+        """Test that files with wrong md5 or size fail"""
+        rows = archive_files()
+        rows['a.txt'] = (3000, '0' * 32)
+        rows['dir/sub/c.txt'] = (1, rows['dir/sub/c.txt'][1])
+        log = Mock()
+
+        assert not validate_zip_file(rows, zip_path, log, 2)
+        errors = [call.args[0] for call in log.error.call_args_list]
+        assert len(errors) == 2
+        assert errors[0].startswith('Real file md5') and 'a.txt' in errors[0]
+        assert errors[1].startswith('Real file size 70000 of file dir/sub/c.txt')
+
+    def test_validate_zip_file_missing_file(self, zip_path):
+        """Test that files in archive manifest but not in zip file fail"""
+        rows = archive_files({**ZIP_CONTENTS, 'd.txt': b'd'})
+        log = Mock()
+
+        assert not validate_zip_file(rows, zip_path, log)
+        assert 'missing the following files: d.txt' in log.error.call_args.args[0]
+
+    def test_validated_zip_file_is_skipped(self, zip_path, tmp_path):
+        """Test that a zip file validated before is skipped until the archive manifest is changed"""
+        md5_cache = Md5Cache(str(tmp_path / 'cache'))
+        size = os.path.getsize(zip_path)
+        with open(zip_path, 'rb') as f:
+            zip_md5 = hashlib.md5(f.read()).hexdigest()
+
+        def validate(archive_index):
+            file_info = {FILE_NAME_DEFAULT: 'archive.zip', FILE_SIZE_DEFAULT: size, MD5_DEFAULT: zip_md5}
+            return validate_data_file(file_info, size, zip_path, md5_cache, Mock(), archive_index)
+
+        assert validate({'archive.zip': archive_files()})
+        with patch('file_validator.validate_zip_file') as validate_zip:
+            assert validate({'archive.zip': archive_files()})
+            validate_zip.assert_not_called()
+        changed = archive_files()
+        changed['a.txt'] = (3000, '0' * 32)
+        assert not validate({'archive.zip': changed})
+
+
+class TestReadArchiveManifest:
+    """Test suite for reading archive manifest"""
+
+    def test_read_archive_manifest_index(self, validator, tmp_path):
+        """Test that archive manifest is indexed by archive name and file path"""
+        manifest = tmp_path / 'archive_manifest.tsv'
+        manifest.write_text(f'{ARCHIVE_NAME}\t{FILE_PATH}\t{FILE_SIZE_DEFAULT}\tmd5\n'
+                            'a.zip\tx.txt\t10\tABC\n'
+                            'a.zip\tdir/y.txt\t20\tdef\n'
+                            'b.zip\tx.txt\t30\tghi\n', encoding='utf-8')
+        validator.archive_manifest = str(manifest)
+        validator.field_names = ['file_name']
+
+        archive_index, _ = validator.read_manifest(is_archive_manifest=True)
+
+        assert archive_index == {'a.zip': {'x.txt': (10, 'abc'), 'dir/y.txt': (20, 'def')},
+                                 'b.zip': {'x.txt': (30, 'ghi')}}
+
+
+class TestSourceIndex:
+    """Unit tests for checking files in source bucket against the listing of source prefix"""
+
+    def test_size_from_index_without_head(self, validator):
+        validator.from_prefix = 'data/'
+        validator.s3_bucket = Mock()
+        validator.s3_bucket.get_object_index.return_value = {'data/a.bam': (10, 'etag-a'), 'data/empty.bam': (0, 'etag-e')}
+
+        validator.load_source_index()
+
+        validator.s3_bucket.get_object_index.assert_called_once_with('data/')
+        assert validator.get_source_file_size('data/a.bam') == (10, None)
+        size, msg = validator.get_source_file_size('data/empty.bam')
+        assert size is None and 'File size is 0' in msg
+        validator.s3_bucket.get_object_size.assert_not_called()
+
+    def test_head_for_key_missed_by_listing(self, validator):
+        validator.from_prefix = 'data'
+        validator.s3_bucket = Mock()
+        validator.s3_bucket.get_object_index.return_value = {}
+        validator.s3_bucket.get_object_size.return_value = (20, None)
+
+        validator.load_source_index()
+
+        validator.s3_bucket.get_object_index.assert_called_once_with('data/')
+        assert validator.get_source_file_size('data/b.bam') == (20, None)
+        validator.s3_bucket.get_object_size.assert_called_once_with('data/b.bam')
+
+    def test_head_when_listing_failed(self, validator):
+        validator.from_prefix = ''
+        validator.s3_bucket = Mock()
+        validator.s3_bucket.get_object_index.return_value = None
+        validator.s3_bucket.get_object_size.return_value = (None, 'File b.bam does not exist in the specified S3 bucket path.')
+
+        validator.load_source_index()
+
+        assert validator.get_source_file_size('b.bam') == (None, 'File b.bam does not exist in the specified S3 bucket path.')
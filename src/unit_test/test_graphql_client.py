@@ -0,0 +1,42 @@
+"""Unit tests for batch payloads of common.graphql_client"""
+import os
+import sys
+import json
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.graphql_client import split_batches, create_batch_body, update_batch_body, UPDATE_BATCH_ERRORS_RESERVE
+from common.constants import MAX_CREATE_BATCH_PAYLOAD_SIZE, MAX_UPDATE_BATCH_PAYLOAD_SIZE
+
+
+class TestSplitBatches:
+    """Test suite for split_batches function"""
+
+    def test_small_file_list_is_one_batch(self):
+        file_array = [f"file_{i}.txt" for i in range(10)]
+        assert split_batches(file_array, "sub-id", "data file") == [(0, 10)]
+
+    def test_empty_file_list(self):
+        assert split_batches([], "sub-id", "data file") == []
+
+    def test_large_file_list_is_split_within_limits(self):
+        # long names so the create body exceeds its limit
+        file_array = [f"dir/{i:08d}/" + "x" * 200 + ".bam" for i in range(60_000)]
+        batches = split_batches(file_array, "sub-id", "data file")
+        assert len(batches) > 1
+        # batches cover all files in order
+        assert batches[0][0] == 0 and batches[-1][1] == len(file_array)
+        for (_, end), (start, _) in zip(batches, batches[1:]):
+            assert end == start
+        for start, end in batches:
+            files = file_array[start:end]
+            assert len(create_batch_body("sub-id", "data file", files).encode("utf-8")) <= MAX_CREATE_BATCH_PAYLOAD_SIZE
+            uploaded = [{"fileName": name, "succeeded": False, "errors": ["e" * (UPDATE_BATCH_ERRORS_RESERVE - 10)], "skipped": False}
+                        for name in files]
+            assert len(update_batch_body("0" * 36, uploaded).encode("utf-8")) <= MAX_UPDATE_BATCH_PAYLOAD_SIZE
+
+    def test_create_batch_body_lists_files(self):
+        body = create_batch_body("sub-id", "data file", ["a.txt", "b.txt"])
+        assert json.dumps(["a.txt", "b.txt"]) in body
+        assert 'submissionID: "sub-id"' in body
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Unit tests for common.manifest_reader.ManifestReader"""
+import csv
+import os
+import sys
+import pytest
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.manifest_reader import ManifestReader
+from common.utils import clean_up_key_value
+
+MANIFEST = (
+    ' file_name \tfile_size\tmd5sum\t \tfile_size\ttype\n'
+    ' a.txt \t 10\tABCDEF\tignored\t11\tfile\n'
+    '\n'
+    'dir/b.txt\t20\tabc\n'
+    'c.txt\t30\tDEF\textra\t31\tfile\tmore\n'
+)
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    path = tmp_path / 'manifest.tsv'
+    path.write_text(MANIFEST, encoding='utf-8')
+    return str(path)
+
+
+class TestManifestReader:
+    """Test suite for ManifestReader"""
+
+    def test_rows_match_cleaned_dict_reader_rows(self, manifest_path):
+        """Test that rows are the same as rows of csv.DictReader cleaned by clean_up_key_value"""
+        with open(manifest_path, encoding='utf-8') as f:
+            expected = [clean_up_key_value(row) for row in csv.DictReader(f, delimiter='\t')]
+
+        rows = list(ManifestReader(manifest_path))
+
+        assert [dict(row) for row in rows] == expected
+        assert [list(row.keys()) for row in rows] == [list(row.keys()) for row in expected]
+
+    def test_lowercase_columns(self, manifest_path):
+        """Test that values of lowercase columns are converted to lowercase"""
+        rows = list(ManifestReader(manifest_path, lowercase_columns=('md5sum', 'missing')))
+
+        assert [row['md5sum'] for row in rows] == ['abcdef', 'abc', 'def']
+
+    def test_row_is_read_only_mapping(self, manifest_path):
+        """Test that rows share the header and can't be changed"""
+        reader = ManifestReader(manifest_path)
+        rows = list(reader)
+
+        assert rows[0].header is rows[1].header is reader.header
+        assert rows[1].get('type') is None
+        assert 'file_size' in rows[0] and 'missing' not in rows[0]
+        with pytest.raises(KeyError):
+            rows[0]['missing']
+        with pytest.raises(TypeError):
+            rows[0]['type'] = 'x'
+        with pytest.raises(AttributeError):
+            rows[0].extra = 'x'
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Unit tests for common.md5_cache.Md5Cache"""
+import os
+import sys
+import pytest
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.md5_cache import Md5Cache
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'data.txt'
+    path.write_bytes(b'content')
+    return str(path)
+
+
+class TestMd5Cache:
+    """Test suite for Md5Cache"""
+
+    def test_get_put(self, tmp_path, data_file):
+        """Test that a saved md5 is returned for the unchanged file"""
+        cache = Md5Cache(str(tmp_path / 'cache'))
+        assert cache.get(data_file) is None
+        cache.put(data_file, 'md5')
+        assert cache.get(data_file) == 'md5'
+
+    def test_persisted_after_close(self, tmp_path, data_file):
+        """Test that saved md5s are available to the next run"""
+        cache = Md5Cache(str(tmp_path / 'cache'))
+        cache.put(data_file, 'md5')
+        cache.close()
+
+        assert Md5Cache(str(tmp_path / 'cache')).get(data_file) == 'md5'
+
+    def test_put_is_persisted_without_close(self, tmp_path, data_file):
+        """Test that a saved md5 survives a run killed before closing the cache"""
+        cache = Md5Cache(str(tmp_path / 'cache'))
+        cache.put(data_file, 'md5')
+
+        assert Md5Cache(str(tmp_path / 'cache')).get(data_file) == 'md5'
+
+    def test_changed_file_is_stale(self, tmp_path, data_file):
+        """Test that the entry of a changed file is not used"""
+        cache = Md5Cache(str(tmp_path / 'cache'))
+        cache.put(data_file, 'md5')
+        with open(data_file, 'ab') as f:
+            f.write(b' changed')
+
+        assert cache.get(data_file) is None
+
+    def test_evict_deleted_and_least_recently_used(self, tmp_path):
+        """Test that entries over the cap are evicted, deleted files first"""
+        cache = Md5Cache(str(tmp_path / 'cache'), max_entries=2)
+        paths = []
+        for i in range(4):
+            path = tmp_path / f'{i}.txt'
+            path.write_bytes(str(i).encode())
+            paths.append(str(path))
+            cache.put(str(path), f'md5-{i}')
+        cache.get(paths[0]) # most recently used
+        os.remove(paths[3])
+
+        cache.save()
+
+        assert cache.get(paths[0]) == 'md5-0'
+        assert cache.get(paths[1]) is None
+        assert cache.get(paths[2]) == 'md5-2'
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Unit tests for common.memory_budget.MemoryBudget"""
+import os
+import sys
+import threading
+import time
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.memory_budget import MemoryBudget
+
+
+class TestMemoryBudget:
+
+    def test_acquire_waits_for_release(self):
+        budget = MemoryBudget(10)
+        budget.acquire(6)
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: budget.acquire(6) or acquired.set())
+        thread.start()
+
+        assert not acquired.wait(0.1), "Bytes over the budget should wait"
+        budget.release(6)
+        assert acquired.wait(1)
+        thread.join()
+        assert budget.used_bytes == 6
+
+    def test_bigger_than_budget_when_nothing_is_held(self):
+        budget = MemoryBudget(10)
+
+        budget.acquire(25)
+
+        assert budget.used_bytes == 25
+        budget.release(25)
+        assert budget.used_bytes == 0
+
+    def test_used_bytes_never_exceed_budget(self):
+        budget = MemoryBudget(10)
+        peak = []
+        lock = threading.Lock()
+
+        def worker():
+            for _ in range(20):
+                budget.acquire(4)
+                with lock:
+                    peak.append(budget.used_bytes)
+                time.sleep(0.001)
+                budget.release(4)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert max(peak) <= 10
+        assert budget.used_bytes == 0
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
-"""Unit tests for process_manifest._is_valid_file_id_value."""
+"""Unit tests for process_manifest."""
 import os
 import sys
+from unittest.mock import Mock, patch
+
+import pandas as pd
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
-from common.constants import DCF_PREFIX, OMIT_DCF_PREFIX
-from process_manifest import _is_valid_file_id_value
+from common.constants import DCF_PREFIX, OMIT_DCF_PREFIX, FILE_NAME_DEFAULT, FILE_ID_DEFAULT, SUBFOLDER_FILE_NAME, \
+    PRE_MANIFEST, FILE_ID_FIELD, FILE_PATH, ERRORS, S3_BUCKET, FILE_PREFIX
+from process_manifest import _is_valid_file_id_value, _valid_file_id_values, add_file_id, insert_file_id_2_children, \
+    upload_final_files, download_metadata_in_s3, is_child_header
 
 # UUID that passes common.utils.is_valid_uuid (v5-style parsing)
 VALID_UUID = "c9bf9e57-1685-4c89-bafb-ff5af830be8a"
@@ -62,3 +67,241 @@ class TestIsValidFileIdValue:
         configs = {OMIT_DCF_PREFIX: False}
         assert _is_valid_file_id_value(DCF_PREFIX.rstrip("/"), configs) is False
         assert _is_valid_file_id_value(f"{DCF_PREFIX}", configs) is False
+
+
+class TestValidFileIdValues:
+    ID_VALUES = [
+        VALID_UUID, f"  {VALID_UUID}  ", VALID_UUID.upper(), f"{DCF_PREFIX}{VALID_UUID}", f" {DCF_PREFIX}{VALID_UUID} ",
+        f"{DCF_PREFIX}{VALID_UUID.upper()}", f"{DCF_PREFIX}not-a-uuid", DCF_PREFIX, "not-a-uuid", VALID_UUID.replace("-", ""),
+        "c9bf9e57-1685-6c89-bafb-ff5af830be8a", "c9bf9e57-1685-4c89-cafb-ff5af830be8a", f"{VALID_UUID}\n",
+        f"{{{VALID_UUID}}}", f"urn:uuid:{VALID_UUID}", "a0eebc99-9c0b-1ef8-bb6d-6bb9bd380a11",
+    ]
+
+    def test_same_as_is_valid_file_id_value(self):
+        for configs in ({}, {OMIT_DCF_PREFIX: False}, {OMIT_DCF_PREFIX: True}):
+            valid = _valid_file_id_values(pd.Series(self.ID_VALUES, dtype="str"), configs)
+            assert list(valid) == [_is_valid_file_id_value(value, configs) for value in self.ID_VALUES], configs
+
+
+class TestInsertFileId2Children:
+
+    def test_file_ids_inserted_and_invalid_rows_reported(self, tmp_path):
+        manifest = tmp_path / "manifest.tsv"
+        manifest.write_text("type\tfile_name\nfile\tdir/a.txt\n", encoding="utf-8")
+        child = tmp_path / "sample.tsv"
+        child.write_text(
+            "type\tfile.file_id\n"
+            "sample\tdir/a.txt\n"
+            "sample\t\n"
+            f"sample\t{DCF_PREFIX}{VALID_UUID}\n"
+            "sample\tmissing.txt\n",
+            encoding="utf-8",
+        )
+        file_infos = [{FILE_NAME_DEFAULT: "dir/a.txt", SUBFOLDER_FILE_NAME: "dir_a.txt", FILE_ID_DEFAULT: f"{DCF_PREFIX}{VALID_UUID}"}]
+        configs = {PRE_MANIFEST: str(manifest), FILE_ID_FIELD: "file_id"}
+        log = Mock()
+        final_files = []
+
+        insert_file_id_2_children(log, configs, [{"type": "file"}], file_infos, final_files, None)
+
+        assert final_files == []
+        log.error.assert_called_once_with(
+            'Child template sample.tsv row 5: "missing.txt" is not a valid file in the manifest or a valid "file_id".')
+
+    def test_final_child_file(self, tmp_path):
+        manifest = tmp_path / "manifest.tsv"
+        manifest.write_text("type\tfile_name\nfile\tdir/a.txt\n", encoding="utf-8")
+        child = tmp_path / "sample.tsv"
+        child.write_text(
+            "type\tfile.file_id\n"
+            "sample\tdir/a.txt\n"
+            "sample\t\n"
+            f"sample\t{DCF_PREFIX}{VALID_UUID}\n",
+            encoding="utf-8",
+        )
+        file_id = f"{DCF_PREFIX}a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11"
+        file_infos = [{FILE_NAME_DEFAULT: "dir/a.txt", SUBFOLDER_FILE_NAME: "dir_a.txt", FILE_ID_DEFAULT: file_id}]
+        configs = {PRE_MANIFEST: str(manifest), FILE_ID_FIELD: "file_id"}
+        final_files = []
+
+        insert_file_id_2_children(Mock(), configs, [{"type": "file"}], file_infos, final_files, None)
+
+        assert final_files == [str(tmp_path / "sample-final.tsv")]
+        assert (tmp_path / "sample-final.tsv").read_text(encoding="utf-8") == (
+            "type\tfile.file_id\n"
+            f"sample\t{file_id}\n"
+            "sample\t\n"
+            f"sample\t{DCF_PREFIX}{VALID_UUID}\n"
+        )
+
+
+    def test_chunks_give_same_final_file_and_row_numbers(self, tmp_path):
+        rows = ["type\tfile.file_id\tdescription"] + [f"sample\tdir/a.txt\tsample {i}, \"quoted\"" for i in range(5)]
+        file_infos = [{FILE_NAME_DEFAULT: "dir/a.txt", SUBFOLDER_FILE_NAME: "dir_a.txt", FILE_ID_DEFAULT: f"{DCF_PREFIX}{VALID_UUID}"}]
+        outputs = []
+        for chunk_rows in (1, 2, 100):
+            child_dir = tmp_path / str(chunk_rows)
+            child_dir.mkdir()
+            manifest = child_dir / "manifest.tsv"
+            manifest.write_text("type\tfile_name\nfile\tdir/a.txt\n", encoding="utf-8")
+            (child_dir / "sample.tsv").write_text("\n".join(rows + ["sample\tmissing.txt\t"]) + "\n", encoding="utf-8")
+            (child_dir / "file.tsv").write_text("\n".join(rows) + "\n", encoding="utf-8")
+            configs = {PRE_MANIFEST: str(manifest), FILE_ID_FIELD: "file_id"}
+            log = Mock()
+            final_files = []
+            with patch("process_manifest.CHILD_CHUNK_ROWS", chunk_rows):
+                insert_file_id_2_children(log, configs, [{"type": "file"}], file_infos, final_files, None)
+
+            assert final_files == [str(child_dir / "file-final.tsv")]
+            assert not (child_dir / "sample-final.tsv").exists(), "Final file of invalid child file should be removed"
+            log.error.assert_called_once_with(
+                'Child template sample.tsv row 7: "missing.txt" is not a valid file in the manifest or a valid "file_id".')
+            outputs.append((child_dir / "file-final.tsv").read_bytes())
+        assert outputs[0] == outputs[1] == outputs[2]
+
+
+class TestAddFileId:
+
+    def test_final_manifest(self, tmp_path):
+        manifest = tmp_path / "manifest.tsv"
+        manifest.write_text(
+            " file_name \tmd5sum\tfile_size\n"
+            "dir/a.txt\tABC\t1\n"
+            " b.txt \tdef\t2\n"
+            "dir/a.txt\tabc\t1\n",
+            encoding="utf-8",
+        )
+        file_infos = [
+            {FILE_NAME_DEFAULT: "dir/a.txt", SUBFOLDER_FILE_NAME: "dir_a.txt", FILE_ID_DEFAULT: f"{DCF_PREFIX}{VALID_UUID}"},
+            {FILE_NAME_DEFAULT: "b.txt", SUBFOLDER_FILE_NAME: "b.txt", FILE_ID_DEFAULT: f"{DCF_PREFIX}{VALID_UUID}"},
+        ]
+        final_manifest = tmp_path / "manifest-final.tsv"
+
+        assert add_file_id("file_id", "file_name", str(final_manifest), file_infos, str(manifest), True, "md5sum")
+
+        assert final_manifest.read_bytes().decode("utf-8") == (
+            f"file_name\tmd5sum\tfile_size\t{SUBFOLDER_FILE_NAME}\tfile_id\r\n"
+            f"a.txt\tabc\t1\tdir_a.txt\t{VALID_UUID}\r\n"
+            f"b.txt\tdef\t2\tb.txt\t{VALID_UUID}\r\n"
+            f"a.txt\tabc\t1\tdir_a.txt\t{VALID_UUID}\r\n"
+        )
+        assert file_infos[0][FILE_ID_DEFAULT] == VALID_UUID
+
+    def test_existing_columns_are_replaced_in_place(self, tmp_path):
+        manifest = tmp_path / "manifest.tsv"
+        manifest.write_text(
+            f"file_name\t{SUBFOLDER_FILE_NAME}\tfile_id\tmd5sum\tfile_size\n"
+            "dir/a.txt\told\told-id\tabc\t1\n"
+            "\n"
+            "b.txt\n",
+            encoding="utf-8",
+        )
+        file_infos = [
+            {FILE_NAME_DEFAULT: "b.txt", FILE_ID_DEFAULT: f"{DCF_PREFIX}{VALID_UUID}"},
+            {FILE_NAME_DEFAULT: "dir/a.txt", SUBFOLDER_FILE_NAME: "dir_a.txt", FILE_ID_DEFAULT: f"{DCF_PREFIX}{VALID_UUID}"},
+        ]
+        final_manifest = tmp_path / "manifest-final.tsv"
+
+        assert add_file_id("file_id", "file_name", str(final_manifest), file_infos, str(manifest), False, "md5sum")
+
+        assert final_manifest.read_bytes().decode("utf-8") == (
+            f"file_name\t{SUBFOLDER_FILE_NAME}\tfile_id\tmd5sum\tfile_size\r\n"
+            f"a.txt\tdir_a.txt\t{DCF_PREFIX}{VALID_UUID}\tabc\t1\r\n"
+            f"b.txt\t\t{DCF_PREFIX}{VALID_UUID}\t\t\r\n"
+        )
+
+
+class FakeMetadataCopier:
+    """Copier double, fails files named "broken" """
+    instances = []
+
+    def __init__(self, bucket_name, prefix, configs):
+        self.copied = []
+        FakeMetadataCopier.instances.append(self)
+
+    def copy_file(self, file_info, overwrite, dryrun):
+        if file_info[FILE_NAME_DEFAULT].startswith("broken"):
+            file_info[ERRORS] = [f'Uploading “{file_info[FILE_NAME_DEFAULT]}” failed - network error.']
+            return {"status": False}
+        self.copied.append(file_info[FILE_PATH])
+        return {"status": True}
+
+
+class TestUploadFinalFiles:
+
+    def test_result_of_each_file_in_order(self, tmp_path):
+        names = ["manifest-final.tsv"] + [f"child{i}-final.tsv" for i in range(10)] + ["broken-final.tsv"]
+        paths = []
+        for name in names:
+            (tmp_path / name).write_text("type\n", encoding="utf-8")
+            paths.append(str(tmp_path / name))
+        FakeMetadataCopier.instances = []
+
+        with patch("process_manifest.Copier", FakeMetadataCopier):
+            results = upload_final_files({S3_BUCKET: "bucket", FILE_PREFIX: "prefix"}, paths)
+
+        assert [result["fileName"] for result in results] == names
+        assert all(result["succeeded"] and result["errors"] == [] for result in results[:-1])
+        assert results[-1] == {"fileName": "broken-final.tsv", "succeeded": False,
+                               "errors": ["Uploading “broken-final.tsv” failed - network error."], "skipped": False}
+        assert sorted(path for copier in FakeMetadataCopier.instances for path in copier.copied) == sorted(paths[:-1])
+
+
+class FakeMetadataBucket:
+    """S3Bucket double of the manifest folder, records downloaded keys"""
+    headers = {
+        "sub/file/file.tsv": "type\tfile_name\n",
+        "sub/file/sample.tsv": "type\tfile.file_id\n",
+        "sub/file/study.tsv": "type\tstudy_name\n",
+        "sub/file/empty.txt": "",
+        "sub/file/denied.tsv": None,
+        "sub/file/sample-final.tsv": "type\tfile.file_id\n",
+        "sub/file/sample.csv": "type\tfile.file_id\n",
+    }
+    downloaded = []
+    sniffed = []
+
+    def set_s3_client(self, bucket, configs):
+        self.bucket_name = bucket
+
+    def get_contents_in_current_folder(self, prefix):
+        return list(self.headers)
+
+    def get_object_first_line(self, key):
+        FakeMetadataBucket.sniffed.append(key)
+        return self.headers[key]
+
+    def download_object(self, key, local_file_path):
+        FakeMetadataBucket.downloaded.append((key, local_file_path))
+        return True, None
+
+
+class TestChildHeader:
+
+    def test_is_child_header(self):
+        assert is_child_header("type\tfile.file_id\tdescription\n", "file.file_id")
+        assert is_child_header("type\tfile.file_id", "file.file_id")
+        assert not is_child_header("type\tfile.file_ids\n", "file.file_id")
+        assert not is_child_header("", "file.file_id")
+
+    def test_only_child_files_are_downloaded_from_s3(self):
+        FakeMetadataBucket.downloaded = []
+
+        with patch("process_manifest.S3Bucket") as s3_bucket_class, patch("process_manifest.TEMP_DOWNLOAD_DIR", "tmp/download"):
+            files = download_metadata_in_s3("s3://bucket/sub/file/file.tsv", FakeMetadataBucket(), "file.file_id")
+
+        # workers share the client of the given S3Bucket
+        s3_bucket_class.assert_not_called()
+        assert files == [os.path.join("tmp/download", "sample.tsv")]
+        assert FakeMetadataBucket.downloaded == [("sub/file/sample.tsv", os.path.join("tmp/download", "sample.tsv"))]
+
+    def test_final_and_other_files_are_not_sniffed(self):
+        FakeMetadataBucket.downloaded = []
+        FakeMetadataBucket.sniffed = []
+
+        with patch("process_manifest.TEMP_DOWNLOAD_DIR", "tmp/download"):
+            download_metadata_in_s3("s3://bucket/sub/file/file.tsv", FakeMetadataBucket(), "file.file_id")
+
+        assert "sub/file/sample-final.tsv" not in FakeMetadataBucket.sniffed, "Final files of previous runs are not child files"
+        assert "sub/file/sample.csv" not in FakeMetadataBucket.sniffed
+        assert [key for key, _ in FakeMetadataBucket.downloaded] == ["sub/file/sample.tsv"]
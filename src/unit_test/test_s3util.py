@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Unit tests for common.s3util.S3Bucket multipart uploading"""
+import io
+import os
+import base64
+import hashlib
+import sys
+import threading
+import datetime
+import pytest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.s3util import S3Bucket, PART_INFO_SUFFIX, write_part_info, get_multipart_etag
+from common.multipart_journal import MultipartJournal
+from common.memory_budget import MemoryBudget
+from common.constants import PART_THREADS
+
+PART_SIZE = 10
+
+
+class FakeS3Client:
+    """S3 client double recording uploaded parts"""
+    def __init__(self, fail_parts=None, fail_once_parts=None):
+        self.lock = threading.Lock()
+        self.fail_once_parts = set(fail_once_parts or ())
+        self.uploaded = {}
+        self.upload_calls = []
+        self.content_md5 = {}
+        self.fail_parts = fail_parts or set()
+        self.completed = None
+        self.aborted = False
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        self.upload_calls.append(PartNumber)
+        if PartNumber in self.fail_parts:
+            raise Exception(f'part {PartNumber} failed')
+        with self.lock:
+            if PartNumber in self.fail_once_parts:
+                self.fail_once_parts.remove(PartNumber)
+                raise Exception(f'part {PartNumber} failed')
+        with self.lock:
+            self.uploaded[PartNumber] = Body
+            self.content_md5[PartNumber] = kwargs.get('ContentMD5')
+        return {'ETag': f'"etag-{PartNumber}"'}
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        self.completed = MultipartUpload['Parts']
+        return {'ETag': '"etag-completed"'}
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+    def get_paginator(self, operation):
+        paginator = Mock()
+        parts = [{'PartNumber': number, 'ETag': f'"etag-{number}"', 'Size': len(body)}
+                 for number, body in sorted(self.uploaded.items())]
+        paginator.paginate.return_value = [{'Parts': parts}]
+        return paginator
+
+
+@pytest.fixture
+def bucket():
+    with patch('common.s3util.get_logger'):
+        s3_bucket = S3Bucket()
+    s3_bucket.log = Mock()
+    s3_bucket.bucket_name = 'bucket'
+    s3_bucket.configs = {PART_THREADS: 3}
+    s3_bucket.expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    s3_bucket.calculate_part_size = lambda size: PART_SIZE
+    return s3_bucket
+
+
+class TestUploadLargeFilePartly:
+
+    def test_parts_are_completed_in_order(self, bucket):
+        bucket.client = FakeS3Client()
+        content = bytes(range(256)) * 4
+        progress = Mock()
+
+        uploaded_size, response = bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), progress)
+
+        assert uploaded_size == len(content)
+        assert response['ETag'] == '"etag-completed"'
+        parts = bucket.client.completed
+        assert [part['PartNumber'] for part in parts] == list(range(1, len(parts) + 1))
+        assert b''.join(bucket.client.uploaded[part['PartNumber']] for part in parts) == content
+        assert sum(call.args[0] for call in progress.call_args_list) == len(content)
+
+    def test_failed_part_aborts_upload(self, bucket):
+        bucket.client = FakeS3Client(fail_parts={3})
+        content = b'x' * 100
+
+        with patch('common.s3util.time.sleep'), patch.object(S3Bucket, 'set_s3_client'):
+            with pytest.raises(Exception):
+                bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), Mock())
+
+        assert bucket.client.aborted
+        assert bucket.client.completed is None
+
+    def test_failed_part_is_retried_on_its_own(self, bucket):
+        client = FakeS3Client(fail_once_parts={3})
+        bucket.client = client
+        content = bytes(range(256)) * 4
+
+        with patch('common.s3util.time.sleep') as sleep, patch.object(S3Bucket, 'set_s3_client') as set_s3_client:
+            uploaded_size, response = bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), Mock())
+
+        assert uploaded_size == len(content)
+        assert client.upload_calls.count(3) == 2
+        assert all(client.upload_calls.count(n) == 1 for n in client.uploaded if n != 3), "Other parts should not be uploaded again"
+        assert bucket.client is client and not set_s3_client.called, "Shared client should not be replaced"
+        assert sleep.call_count == 1 and sleep.call_args.args[0] < 300
+        assert b''.join(client.uploaded[part['PartNumber']] for part in client.completed) == content
+
+    @pytest.mark.parametrize('fail_parts', [set(), {5}])
+    def test_parts_in_memory_are_within_budget(self, bucket, fail_parts):
+        bucket.client = FakeS3Client(fail_parts=fail_parts)
+        bucket.memory_budget = MemoryBudget(2 * PART_SIZE)
+        used = []
+        upload_part = bucket.client.upload_part
+        bucket.client.upload_part = lambda **kwargs: used.append(bucket.memory_budget.used_bytes) or upload_part(**kwargs)
+        content = bytes(range(256)) * 4
+
+        with patch('common.s3util.time.sleep'):
+            try:
+                bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), Mock())
+            except Exception:
+                assert fail_parts
+
+        assert used and max(used) <= 2 * PART_SIZE
+        assert bucket.memory_budget.used_bytes == 0, "Memory of uploaded, failed or cancelled parts should be released"
+
+    def test_interrupted_upload_is_resumed(self, bucket, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        bucket.client = FakeS3Client(fail_parts={3})
+        content = bytes(range(256)) * 4
+        journal = MultipartJournal('bucket', 'key', len(content), 1)
+
+        with patch('common.s3util.time.sleep'), patch.object(S3Bucket, 'set_s3_client'):
+            with pytest.raises(Exception):
+                bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), Mock(), journal=journal)
+
+        assert not bucket.client.aborted, "Multipart upload should be kept for resuming"
+        uploaded_before = set(bucket.client.uploaded)
+        bucket.client.fail_parts = set()
+        bucket.client.upload_calls = []
+
+        journal = MultipartJournal('bucket', 'key', len(content), 1)
+        uploaded_size, response = bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), Mock(), journal=journal)
+
+        assert uploaded_size == len(content)
+        assert not uploaded_before & set(bucket.client.upload_calls), "Uploaded parts should not be uploaded again"
+        parts = bucket.client.completed
+        assert b''.join(bucket.client.uploaded[part['PartNumber']] for part in parts) == content
+        assert not os.path.exists(journal.path), "Journal should be removed after completing upload"
+
+
+class TestContentMD5:
+
+    def test_parts_are_sent_with_content_md5(self, bucket):
+        bucket.client = FakeS3Client()
+        content = bytes(range(256)) * 4
+
+        bucket.upload_large_file_partly(io.BytesIO(content), 'key', len(content), Mock())
+
+        for number, body in bucket.client.uploaded.items():
+            assert bucket.client.content_md5[number] == base64.b64encode(hashlib.md5(body).digest()).decode()
+
+    def test_put_file_obj_sends_content_md5(self, bucket):
+        bucket.client = Mock()
+        bucket.client.put_object.return_value = {'ETag': '"etag-put"'}
+        content = b'metadata'
+        md5_base64 = base64.b64encode(hashlib.md5(content).digest()).decode()
+
+        with patch('common.s3util.create_progress_bar'):
+            response = bucket.put_file_obj(len(content), 'key', io.BytesIO(content), md5_base64, 'a.txt')
+
+        kwargs = bucket.client.put_object.call_args.kwargs
+        assert kwargs['ContentMD5'] == md5_base64
+        assert kwargs['ContentDisposition'] == 'attachment; filename="a.txt"'
+        assert response['ETag'] == '"etag-put"'
+
+
+class TestGetMultipartEtag:
+
+    def test_md5_of_part_md5s(self):
+        parts = [b'a' * 10, b'b' * 10, b'c']
+        etags = [{'PartNumber': number, 'ETag': f'"{hashlib.md5(part).hexdigest()}"'} for number, part in enumerate(parts, 1)]
+        expected = hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest() + '-3'
+
+        assert get_multipart_etag(list(reversed(etags))) == expected
+
+
+class TestGetObjectIndex:
+
+    def test_index_all_pages(self, bucket):
+        bucket.client = Mock()
+        bucket.client.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'prefix/a.bam', 'Size': 10, 'ETag': '"etag-a"'}]},
+            {'Contents': [{'Key': 'prefix/b.bam', 'Size': 20, 'ETag': '"etag-b"'}]},
+            {},
+        ]
+
+        index = bucket.get_object_index('prefix/')
+
+        assert index == {'prefix/a.bam': (10, 'etag-a'), 'prefix/b.bam': (20, 'etag-b')}
+
+    def test_listing_error_returns_none(self, bucket):
+        bucket.client = Mock()
+        bucket.client.get_paginator.return_value.paginate.side_effect = Exception('Access Denied')
+
+        assert bucket.get_object_index('prefix/') is None
+
+    def test_sub_prefixes_listed_concurrently(self, bucket):
+        pages = {
+            ('prefix/', '/'): [{'Contents': [{'Key': 'prefix/top.bam', 'Size': 5, 'ETag': '"etag-top"'}],
+                                'CommonPrefixes': [{'Prefix': 'prefix/d1/'}]},
+                               {'CommonPrefixes': [{'Prefix': 'prefix/d2/'}]}],
+            ('prefix/d1/', None): [{'Contents': [{'Key': 'prefix/d1/a.bam', 'Size': 10, 'ETag': '"etag-a"'}]}],
+            ('prefix/d2/', None): [{'Contents': [{'Key': 'prefix/d2/sub/b.bam', 'Size': 20, 'ETag': '"etag-b"'}]}],
+        }
+        bucket.client = Mock()
+        bucket.client.get_paginator.return_value.paginate.side_effect = \
+            lambda Bucket, Prefix, Delimiter=None: pages[(Prefix, Delimiter)]
+
+        index = bucket.get_object_index('prefix/')
+
+        assert index == {'prefix/top.bam': (5, 'etag-top'), 'prefix/d1/a.bam': (10, 'etag-a'),
+                         'prefix/d2/sub/b.bam': (20, 'etag-b')}
+
+
+class FakeDownloadClient:
+    """S3 client double serving ranges of one object"""
+    def __init__(self, content, fail_once_at=None, etag='etag-1'):
+        self.content = content
+        self.etag = etag
+        self.lock = threading.Lock()
+        self.ranges = []
+        self.if_match = []
+        self.fail_once_at = fail_once_at
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.content), 'ETag': f'"{self.etag}"'}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        first, last = (int(n) for n in Range.replace('bytes=', '').split('-'))
+        with self.lock:
+            self.ranges.append(first)
+            self.if_match.append(IfMatch)
+            if first == self.fail_once_at:
+                self.fail_once_at = None
+                raise ConnectionError('connection reset')
+        if IfMatch is not None and IfMatch != f'"{self.etag}"':
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.content[first:last + 1])}
+
+
+class TestDownloadObjectWithMd5:
+
+    @pytest.fixture(autouse=True)
+    def small_ranges(self):
+        with patch('common.s3util.DOWNLOAD_PART_SIZE', PART_SIZE), patch('common.s3util.create_progress_bar'):
+            yield
+
+    def test_ranges_are_written_in_order_and_hashed(self, bucket, tmp_path):
+        content = bytes(range(256)) * 2
+        bucket.client = FakeDownloadClient(content)
+        file_path = str(tmp_path / 'download' / 'a.bam')
+
+        md5, msg = bucket.download_object_with_md5('key', file_path)
+
+        assert msg is None
+        assert md5 == hashlib.md5(content).hexdigest()
+        with open(file_path, 'rb') as f:
+            assert f.read() == content
+        assert set(bucket.client.if_match) == {'"etag-1"'}, "Every range should be sent with IfMatch of the ETag"
+        assert not os.path.exists(file_path + PART_INFO_SUFFIX), "ETag sidecar should be removed after downloading"
+
+    def test_partial_file_is_resumed(self, bucket, tmp_path):
+        content = bytes(range(256))
+        bucket.client = FakeDownloadClient(content)
+        file_path = tmp_path / 'a.bam'
+        file_path.write_bytes(content[:100])
+        write_part_info(str(file_path) + PART_INFO_SUFFIX, 'etag-1')
+
+        md5, msg = bucket.download_object_with_md5('key', str(file_path))
+
+        assert md5 == hashlib.md5(content).hexdigest()
+        assert file_path.read_bytes() == content
+        assert min(bucket.client.ranges) == 100, "Bytes already downloaded should not be downloaded again"
+
+    @pytest.mark.parametrize('etag', [None, 'etag-0'])
+    @pytest.mark.parametrize('stale_size', [100, 256])
+    def test_stale_partial_file_is_downloaded_again(self, bucket, tmp_path, etag, stale_size):
+        content = bytes(range(256))
+        bucket.client = FakeDownloadClient(content)
+        file_path = tmp_path / 'a.bam'
+        file_path.write_bytes(bytes(reversed(range(256)))[:stale_size])
+        if etag:
+            write_part_info(str(file_path) + PART_INFO_SUFFIX, etag)
+
+        md5, msg = bucket.download_object_with_md5('key', str(file_path))
+
+        assert md5 == hashlib.md5(content).hexdigest()
+        assert file_path.read_bytes() == content
+        assert min(bucket.client.ranges) == 0
+
+    def test_object_changed_while_downloading(self, bucket, tmp_path):
+        content = bytes(range(256))
+        bucket.client = FakeDownloadClient(content)
+        file_path = tmp_path / 'a.bam'
+        get_object = bucket.client.get_object
+
+        def get_object_changed(**kwargs):
+            if kwargs['Range'].startswith(f'bytes={5 * PART_SIZE}-'):
+                bucket.client.etag = 'etag-2'
+            return get_object(**kwargs)
+        bucket.client.get_object = get_object_changed
+
+        md5, msg = bucket.download_object_with_md5('key', str(file_path))
+
+        assert md5 is None
+        assert 'changed' in msg
+        assert not file_path.exists(), "Partial file of a changed object should not be kept for resuming"
+        assert not os.path.exists(str(file_path) + PART_INFO_SUFFIX)
+
+    def test_failed_range_is_retried_from_last_byte(self, bucket, tmp_path):
+        content = bytes(range(256))
+        bucket.client = FakeDownloadClient(content, fail_once_at=5 * PART_SIZE)
+        file_path = tmp_path / 'a.bam'
+
+        md5, msg = bucket.download_object_with_md5('key', str(file_path))
+
+        assert md5 == hashlib.md5(content).hexdigest()
+        assert file_path.read_bytes() == content
+
+
+class TestGetObjectFirstLine:
+
+    def test_first_line_from_first_range(self, bucket):
+        bucket.client = FakeDownloadClient(b'type\tfile.file_id\nsample\tdir/a.txt\n' * 1000)
+
+        assert bucket.get_object_first_line('key') == 'type\tfile.file_id\n'
+        assert bucket.client.ranges == [0]
+
+    def test_long_line_doubles_range(self, bucket):
+        header = '\t'.join(f'column_{i}' for i in range(2000))
+        bucket.client = FakeDownloadClient(f'{header}\nvalue\n'.encode() * 100)
+        ranges = []
+        get_object_range = bucket.get_object_range
+        bucket.get_object_range = lambda key, first, last: ranges.append(last + 1) or get_object_range(key, first, last)
+
+        assert bucket.get_object_first_line('key') == f'{header}\n'
+        assert ranges == [8 * 1024, 16 * 1024, 32 * 1024]
+
+    def test_object_without_line_break(self, bucket):
+        bucket.client = FakeDownloadClient(b'type\tfile.file_id')
+
+        assert bucket.get_object_first_line('key') == 'type\tfile.file_id'
+
+    def test_empty_object(self, bucket):
+        bucket.client = Mock()
+        bucket.client.get_object.side_effect = ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+
+        assert bucket.get_object_first_line('key') == ''
+
+    def test_access_denied(self, bucket):
+        bucket.client = Mock()
+        bucket.client.get_object.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetObject')
+
+        assert bucket.get_object_first_line('key') is None
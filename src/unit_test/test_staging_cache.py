@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Unit tests for common.staging_cache.StagingCache"""
+import os
+import sys
+from unittest.mock import Mock
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.staging_cache import StagingCache
+
+
+def stage_file(cache, tmp_path, name, size, validated=True, pinned=False):
+    file_path = str(tmp_path / name)
+    cache.reserve(file_path, size)
+    with open(file_path, 'wb') as f:
+        f.write(b'x' * size)
+    if validated:
+        cache.set_validated(file_path)
+    if not pinned:
+        cache.release(file_path)
+    return file_path
+
+
+class TestStagingCache:
+
+    def test_validated_file_is_reused(self, tmp_path):
+        cache = StagingCache(100, Mock())
+        file_path = stage_file(cache, tmp_path, 'a.bam', 10)
+
+        assert cache.reuse(file_path, 10)
+        assert not cache.reuse(file_path, 11), "A file of different size should not be reused"
+
+    def test_file_not_validated_is_not_reused(self, tmp_path):
+        cache = StagingCache(100, Mock())
+        file_path = stage_file(cache, tmp_path, 'a.bam', 10, validated=False)
+
+        assert not cache.reuse(file_path, 10)
+
+    def test_changed_file_is_not_reused(self, tmp_path):
+        cache = StagingCache(100, Mock())
+        file_path = stage_file(cache, tmp_path, 'a.bam', 10)
+        with open(file_path, 'ab') as f:
+            f.write(b'y')
+
+        assert not cache.reuse(file_path, 10)
+        assert cache.staged_bytes == 0
+
+    def test_evict_least_recently_staged_unpinned_files(self, tmp_path):
+        cache = StagingCache(40, Mock())
+        paths = [stage_file(cache, tmp_path, f'{name}.bam', 10) for name in 'abc']
+        pinned = stage_file(cache, tmp_path, 'd.bam', 10, pinned=True)
+        # a is used again, b is the least recently used
+        assert cache.reuse(paths[0], 10)
+        cache.release(paths[0])
+
+        cache.reserve(str(tmp_path / 'e.bam'), 15)
+
+        assert not os.path.exists(paths[1])
+        assert not os.path.exists(paths[2])
+        assert os.path.exists(pinned), "Pinned file should not be evicted"
+        assert cache.reuse(paths[0], 10)
+        assert cache.staged_bytes == 35
+
+    def test_reserve_without_force_does_not_evict(self, tmp_path):
+        cache = StagingCache(30, Mock())
+        path = stage_file(cache, tmp_path, 'a.bam', 10)
+
+        assert cache.reserve(str(tmp_path / 'b.bam'), 20, force=False)
+        assert not cache.reserve(str(tmp_path / 'c.bam'), 1, force=False)
+        assert os.path.exists(path)
+        assert cache.staged_bytes == 30
+
+    def test_file_larger_than_budget_is_reserved_by_force(self, tmp_path):
+        cache = StagingCache(30, Mock())
+        path = stage_file(cache, tmp_path, 'a.bam', 10)
+
+        assert cache.reserve(str(tmp_path / 'b.bam'), 100)
+
+        assert not os.path.exists(path)
+        assert cache.staged_bytes == 100
+
+    def test_remove_deletes_file(self, tmp_path):
+        cache = StagingCache(30, Mock())
+        path = stage_file(cache, tmp_path, 'a.bam', 10)
+
+        cache.remove(path)
+
+        assert not os.path.exists(path)
+        assert cache.staged_bytes == 0
+        cache.remove(path)  # removing again is harmless
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Unit tests for uploading a file list in several batches by uploader.controller"""
+import os
+import sys
+import pytest
+from unittest.mock import Mock, patch
+
+# Add src to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import uploader
+from common.file_record import FileRecord
+from common.graphql_client import update_batch_body
+from common.constants import (
+    UPLOAD_TYPE, TYPE_FILE, SUBMISSION_ID, PRE_MANIFEST, FILE_NAME_DEFAULT, FILE_ID_DEFAULT, FILE_PREFIX,
+    S3_BUCKET, BATCH_ID, BATCH, BATCH_BUCKET, BATCH_CREATED, BATCH_UPDATED, BATCH_STATUS, TEMP_CREDENTIAL,
+    HEARTBEAT_INTERVAL_CONFIG, SUCCEEDED
+)
+
+FILE_NAMES = [f'file{i}.bam' for i in range(5)]
+
+
+class FakeAPIInvoker:
+    """APIInvoker double, each created batch has its own id, prefix and file ids"""
+    def __init__(self, configs):
+        self.created = []
+        self.updated = []
+        self.cred = {'accessKeyId': 'key'}
+
+    def get_data_file_config(self, submission_id):
+        return True, {'heartbeat_interval': 300}
+
+    def create_batch(self, file_array):
+        batch_num = len(self.created) + 1
+        self.created.append(list(file_array))
+        self.new_batch = {BATCH_ID: f'batch-{batch_num}', BATCH_BUCKET: 'bucket', FILE_PREFIX: f'prefix-{batch_num}',
+                          BATCH_CREATED: 'now', 'files': [{FILE_ID_DEFAULT: f'id-{name}'} for name in file_array]}
+        return True
+
+    def get_temp_credential(self):
+        return True
+
+    def update_batch(self, batch_id, uploaded_files, uploading='false'):
+        if uploaded_files is not None:
+            self.updated.append((batch_id, [item['fileName'] for item in uploaded_files]))
+        self.batch = {BATCH_STATUS: 'Uploaded', BATCH_UPDATED: 'now'}
+        return True
+
+
+class FakeFileUploader:
+    """FileUploader double, fails the files of the batch whose prefix is in fail_prefixes"""
+    fail_prefixes = set()
+    uploads = []
+
+    def __init__(self, configs, file_list, md5_cache, archive_files_info):
+        self.configs = configs
+        self.file_list = file_list
+
+    def upload(self):
+        FakeFileUploader.uploads.append((self.configs[FILE_PREFIX], [item[FILE_NAME_DEFAULT] for item in self.file_list]))
+        succeeded = self.configs[FILE_PREFIX] not in self.fail_prefixes
+        for item in self.file_list:
+            item[SUCCEEDED] = succeeded
+        return succeeded
+
+
+class FakeHeartBeater:
+    """UploadHeartBeater double recording started batches"""
+    started = []
+
+    def __init__(self, batch_id, graphql_client, heartbeat_interval=300):
+        self.batch_id = batch_id
+
+    def start(self):
+        FakeHeartBeater.started.append(self.batch_id)
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture
+def run_controller():
+    configs = {UPLOAD_TYPE: TYPE_FILE, SUBMISSION_ID: 'sub-id', PRE_MANIFEST: 'manifest.tsv', HEARTBEAT_INTERVAL_CONFIG: 300}
+    validator = Mock()
+    validator.validate.return_value = True
+    validator.invalid_count = 0
+    validator.has_file_id = False
+    validator.fileList = [FileRecord(**{FILE_NAME_DEFAULT: name}) for name in FILE_NAMES]
+    config = Mock()
+    config.check_version.return_value = (1, 'latest version')
+    config.data = configs
+    api_invokers = []
+    # each file reserves more than half of the update limit, so every two files make a batch
+    update_limit = len(update_batch_body('0' * 36, None).encode('utf-8')) + 1300
+
+    def run(fail_prefixes=()):
+        FakeFileUploader.fail_prefixes = set(fail_prefixes)
+        FakeFileUploader.uploads = []
+        FakeHeartBeater.started = []
+        reports = []
+        with patch('uploader.Config', return_value=config), \
+                patch('uploader.APIInvoker', side_effect=lambda c: api_invokers.append(FakeAPIInvoker(c)) or api_invokers[-1]), \
+                patch('uploader.FileValidator', return_value=validator), \
+                patch('uploader.FileUploader', FakeFileUploader), \
+                patch('uploader.UploadHeartBeater', FakeHeartBeater), \
+                patch('uploader.process_manifest_file') as process_manifest_file, \
+                patch('uploader.dump_dict_to_tsv', side_effect=lambda file_list, path, **kwargs: reports.append(path)), \
+                patch('uploader.log'), \
+                patch('common.graphql_client.MAX_UPDATE_BATCH_PAYLOAD_SIZE', update_limit):
+            result = uploader.controller()
+        return result, api_invokers[0], process_manifest_file, reports, validator
+    return run
+
+
+class TestController:
+
+    def test_each_batch_is_created_uploaded_and_reported(self, run_controller):
+        result, api_invoker, process_manifest_file, reports, validator = run_controller()
+
+        assert result == 0
+        assert api_invoker.created == [FILE_NAMES[0:2], FILE_NAMES[2:4], FILE_NAMES[4:5]]
+        assert FakeFileUploader.uploads == [('prefix-1', FILE_NAMES[0:2]), ('prefix-2', FILE_NAMES[2:4]), ('prefix-3', FILE_NAMES[4:5])]
+        assert FakeHeartBeater.started == ['batch-1', 'batch-2', 'batch-3']
+        assert api_invoker.updated == [('batch-1', FILE_NAMES[0:2]), ('batch-2', FILE_NAMES[2:4]), ('batch-3', FILE_NAMES[4:5])]
+        assert [path.rsplit('-', 2)[-2:] for path in reports] == [['batch', '1.tsv'], ['batch', '2.tsv'], ['batch', '3.tsv']]
+
+    def test_final_manifest_has_file_ids_of_all_batches(self, run_controller):
+        result, api_invoker, process_manifest_file, reports, validator = run_controller()
+
+        process_manifest_file.assert_called_once()
+        configs, has_file_id, file_list = process_manifest_file.call_args.args[1:4]
+        assert [item[FILE_ID_DEFAULT] for item in file_list] == [f'id-{name}' for name in FILE_NAMES]
+        # destination of the final manifest is the metadata batch created by process_manifest_file
+        assert not {S3_BUCKET, FILE_PREFIX, BATCH_ID, BATCH} & set(configs)
+        assert configs[TEMP_CREDENTIAL] == {'accessKeyId': 'key'}
+
+    def test_failed_batch_stops_uploading(self, run_controller):
+        result, api_invoker, process_manifest_file, reports, validator = run_controller(fail_prefixes={'prefix-2'})
+
+        assert result == 1
+        assert [prefix for prefix, _ in FakeFileUploader.uploads] == ['prefix-1', 'prefix-2']
+        assert [batch_id for batch_id, _ in api_invoker.updated] == ['batch-1', 'batch-2']
+        process_manifest_file.assert_not_called()
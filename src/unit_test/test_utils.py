@@ -7,7 +7,7 @@ import pytest
 # Add src to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from common.utils import clean_up_key_value
+from common.utils import clean_up_key_value, md5_hex_to_base64
 
 
 class TestCleanUpKeyValue:
@@ -195,3 +195,11 @@ class TestCleanUpKeyValue:
         assert result['key2'] == '', "Whitespace string value becomes empty after strip"
         assert result['key3'] == 'value', "Normal value should work"
 
+
+class TestMd5HexToBase64:
+    """Test suite for md5_hex_to_base64 function"""
+
+    def test_md5_hex_to_base64(self):
+        """Test that hex md5 is converted to Content-MD5 format"""
+        # md5 of empty content
+        assert md5_hex_to_base64('d41d8cd98f00b204e9800998ecf8427e') == '1B2M2Y8AsgTpgAmY7PhCfg=='
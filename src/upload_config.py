@@ -3,7 +3,9 @@ import os
 import yaml
 from common.constants import UPLOAD_TYPE, UPLOAD_TYPES, FILE_NAME_DEFAULT, FILE_SIZE_DEFAULT, MD5_DEFAULT, \
     API_URL, TOKEN, SUBMISSION_ID, FILE_DIR, FILE_MD5_FIELD, PRE_MANIFEST, FILE_NAME_FIELD, FILE_SIZE_FIELD, RETRIES, OVERWRITE, \
-    DRY_RUN, TYPE_FILE, FILE_ID_FIELD, OMIT_DCF_PREFIX, S3_START, FROM_S3, HEARTBEAT_INTERVAL_CONFIG, CLI_VERSION, ARCHIVE_MANIFEST
+    DRY_RUN, TYPE_FILE, FILE_ID_FIELD, OMIT_DCF_PREFIX, S3_START, FROM_S3, HEARTBEAT_INTERVAL_CONFIG, CLI_VERSION, ARCHIVE_MANIFEST, \
+    UPLOAD_THREADS, MAX_INFLIGHT_MB, PART_THREADS, SERVER_SIDE_COPY, VALIDATION_THREADS, STAGING_BUDGET_MB, \
+    PREFETCH_FILES
 from bento.common.utils import get_logger
 from common.graphql_client import APIInvoker
 from common.utils import clean_up_key_value, compare_version
@@ -24,11 +26,19 @@ class Config():
         parser.add_argument('-f', '--manifest', help='path to manifest file, conditional required when type = “data file"')
 
         parser.add_argument('-r', '--retries', type=int, help='file uploading retries, optional, default value is 3')
+        parser.add_argument('--upload-threads', type=int, help='number of files uploaded concurrently, optional, default value is 1')
+        parser.add_argument('--staging-budget-mb', type=int, help='maximum size in MB of files downloaded from s3 and kept for retrying, optional, default value is 102400')
+        parser.add_argument('--prefetch-files', type=int, help='number of files downloaded from s3 and validated ahead of uploading, optional, default value is 2')
+        parser.add_argument('--max-inflight-mb', type=int, help='maximum size in MB of file contents held in memory by all uploading workers, optional, default value is 2048')
+        parser.add_argument('--part-threads', type=int, help='number of parts of a large file uploaded concurrently, optional, default value is 4')
+        parser.add_argument('--validation-threads', type=int, help='number of data files hashed concurrently in validation, optional, default value is 1')
 
         #for better user experience, using configuration file to pass all args above
         parser.add_argument('-c', '--config', help='configuration file, can potentially contain all above parameters, optional')
         # Bypass archive(zip) validation, archive manifest is no longer required
         parser.add_argument('--bypass-archive-validation', action='store_true', default=False, help='Bypass archive(zip) validation, archive manifest is no longer required')
+        # Copy data files from s3 source bucket to destination on the server side instead of downloading and uploading them
+        parser.add_argument('--server-side-copy', action='store_true', default=False, help='Copy data files from s3 url in "data" to destination without downloading them, optional, default is false')
         
         args = parser.parse_args()
         self.data = {}
@@ -86,6 +96,13 @@ class Config():
         else:
             self.data[RETRIES] =int(retry)
 
+        self.data[UPLOAD_THREADS] = self._get_positive_int(UPLOAD_THREADS, 1) #default value is 1, upload files one by one
+        self.data[MAX_INFLIGHT_MB] = self._get_positive_int(MAX_INFLIGHT_MB, 2048)
+        self.data[PART_THREADS] = self._get_positive_int(PART_THREADS, 4)
+        self.data[VALIDATION_THREADS] = self._get_positive_int(VALIDATION_THREADS, 1) #default value is 1, hash files one by one
+        self.data[STAGING_BUDGET_MB] = self._get_positive_int(STAGING_BUDGET_MB, 102400)
+        self.data[PREFETCH_FILES] = self._get_positive_int(PREFETCH_FILES, 2)
+
         overwrite = self.data.get(OVERWRITE, False) #default value is False
         if isinstance(overwrite, str):
             overwrite = True if overwrite.lower() == "true" else False
@@ -96,6 +113,11 @@ class Config():
             dry_run = True if str(dry_run).lower() == "true" else False
             self.data[DRY_RUN] = dry_run
 
+        server_side_copy = self.data.get(SERVER_SIDE_COPY, False) #default value is False
+        if isinstance(server_side_copy, str):
+            server_side_copy = True if server_side_copy.lower() == "true" else False
+            self.data[SERVER_SIDE_COPY] = server_side_copy
+
         type = self.data.get(UPLOAD_TYPE)
         if type is None:
             self.log.critical(f'Please provide “type” (“metadata” or “data file”) in configuration file or command line argument.')
@@ -135,6 +157,20 @@ class Config():
   
         return True
     
+    def _get_positive_int(self, key, default):
+        value = self.data.get(key)
+        if value is None or value == "":
+            return default
+        if isinstance(value, str):
+            if not value.isdigit():
+                self.log.warning(f'Configuration warning in “{key}”: “{value}” is not a valid integer. It is set to {default}.')
+                return default
+            value = int(value)
+        if not isinstance(value, int) or value < 1:
+            self.log.warning(f'Configuration warning in “{key}”: “{value}” is not a positive integer. It is set to {default}.')
+            return default
+        return value
+
     def validate_file_config(self, data_file_config):
         #check header names in manifest file
         file_name_header= data_file_config.get(FILE_NAME_FIELD.replace("-", "_"))
@@ -6,8 +6,9 @@ import os
 from bento.common.utils import get_logger, LOG_PREFIX, get_time_stamp
 from common.constants import UPLOAD_TYPE, S3_BUCKET, FILE_NAME_DEFAULT, BATCH_STATUS, DRY_RUN, \
     BATCH_BUCKET, BATCH, BATCH_ID, FILE_PREFIX, TEMP_CREDENTIAL, SUCCEEDED, ERRORS, BATCH_CREATED, BATCH_UPDATED, \
-    FILE_PATH, SKIPPED, TYPE_FILE, CLI_VERSION, HEARTBEAT_INTERVAL_CONFIG, PRE_MANIFEST, FILE_ID_DEFAULT, SUBFOLDER_FILE_NAME
-from common.graphql_client import APIInvoker
+    FILE_PATH, SKIPPED, TYPE_FILE, CLI_VERSION, HEARTBEAT_INTERVAL_CONFIG, PRE_MANIFEST, FILE_ID_DEFAULT, SUBFOLDER_FILE_NAME, \
+    SUBMISSION_ID
+from common.graphql_client import APIInvoker, split_batches
 from common.utils import dump_dict_to_tsv, get_exception_msg
 from upload_config import Config
 from file_validator import FileValidator
@@ -70,94 +71,141 @@ def controller():
         log.info("File validations are completed in dry run mode.")
         return 0
     if validator.invalid_count == 0:
-        #step 3: create a batch
+        #step 3: split files into batches within the payload size limits of createBatch and updateBatch
         file_array = [ item[SUBFOLDER_FILE_NAME] if item.get(SUBFOLDER_FILE_NAME) else item.get(FILE_NAME_DEFAULT) for item in file_list]
-        newBatch = None
-        if apiInvoker.create_batch(file_array):
-            newBatch = apiInvoker.new_batch
-            if not newBatch.get(BATCH_BUCKET) or not newBatch[FILE_PREFIX] or not newBatch.get(BATCH_ID):
-                log.error("Failed to upload files: can't create new batch!")
-                log.info("Failed to upload files: can't create new batch! Please check log file in tmp folder for details.")
+        batch_ranges = split_batches(file_array, configs.get(SUBMISSION_ID), configs.get(UPLOAD_TYPE))
+        if len(batch_ranges) > 1:
+            log.info(f"{len(file_array)} files are split into {len(batch_ranges)} batches.")
+        all_uploaded = True
+        for batch_num, (start, end) in enumerate(batch_ranges, 1):
+            batch_files = file_list[start:end]
+            report_suffix = f"-batch-{batch_num}" if len(batch_ranges) > 1 else ""
+            result, interrupted = upload_batch(configs, apiInvoker, batch_files, file_array[start:end], validator, report_suffix)
+            if result is None:
+                # the batch is not created
+                validator.md5_cache.close()
                 return 1
-            configs[S3_BUCKET] = newBatch.get(BATCH_BUCKET)
-            configs[FILE_PREFIX] = newBatch[FILE_PREFIX]
-            configs[BATCH_ID] = newBatch.get(BATCH_ID)
-            configs[BATCH] = newBatch
-            log.info(f"New batch is created: {configs[BATCH_ID]} at {newBatch[BATCH_CREATED]}")
-        else:
+            all_uploaded = all_uploaded and result
+            if interrupted or not result:
+                # the final manifest needs file ids of all batches, later batches are not uploaded
+                if len(batch_ranges) > 1 and batch_num < len(batch_ranges):
+                    log.error(f"Failed to upload batch {batch_num} of {len(batch_ranges)}, the remaining batches are not uploaded.")
+                break
+        validator.md5_cache.close()
+        if all_uploaded and configs[UPLOAD_TYPE] == TYPE_FILE:
+            # process manifest file with file ids of all batches, configs don't have the destination of any data file batch,
+            # the final manifest is uploaded to the metadata batch created by process_manifest_file
+            process_manifest_file(log, configs.copy(), validator.has_file_id, file_list, validator.manifest_rows, s3_manifest_url)
+        return 0 if all_uploaded else 1
+    else:
+        log.error(f"Found total {validator.invalid_count} file(s) are invalid!")
+    validator.md5_cache.close()
+    
+    #dump file_list with uploading status and errors to tmp/reports dir
+    dump_report(file_list)
+
+"""
+create a batch for files, upload the files and update the batch.
+Destination of the batch is set to a copy of configs, only the temporary credential of the submission is kept in configs.
+:param batch_files: file records of the batch
+:param file_array: file names of the batch
+:param report_suffix: suffix of uploading report file name of the batch
+:return: (result, interrupted), result is None if the batch can't be created
+"""
+def upload_batch(configs, apiInvoker, batch_files, file_array, validator, report_suffix=""):
+    newBatch = None
+    result = False
+    interrupted = False
+    batch_configs = configs.copy()
+    if apiInvoker.create_batch(file_array):
+        newBatch = apiInvoker.new_batch
+        if not newBatch.get(BATCH_BUCKET) or not newBatch[FILE_PREFIX] or not newBatch.get(BATCH_ID):
             log.error("Failed to upload files: can't create new batch!")
             log.info("Failed to upload files: can't create new batch! Please check log file in tmp folder for details.")
-            return 1
+            return None, interrupted
+        batch_configs[S3_BUCKET] = newBatch.get(BATCH_BUCKET)
+        batch_configs[FILE_PREFIX] = newBatch[FILE_PREFIX]
+        batch_configs[BATCH_ID] = newBatch.get(BATCH_ID)
+        batch_configs[BATCH] = newBatch
+        log.info(f"New batch is created: {batch_configs[BATCH_ID]} at {newBatch[BATCH_CREATED]}")
+    else:
+        log.error("Failed to upload files: can't create new batch!")
+        log.info("Failed to upload files: can't create new batch! Please check log file in tmp folder for details.")
+        return None, interrupted
 
-        #step 4: get aws sts temp credential for uploading files to s3 bucket.
-        if not apiInvoker.get_temp_credential():
-            log.error("Failed to upload files: can't get temp credential!")
-            log.info("Failed to upload files: can't get temp credential! Please check log file in tmp folder for details.")
+    #step 4: get aws sts temp credential for uploading files to s3 bucket.
+    if not apiInvoker.get_temp_credential():
+        log.error("Failed to upload files: can't get temp credential!")
+        log.info("Failed to upload files: can't get temp credential! Please check log file in tmp folder for details.")
+        #set fileList for update batch
+        update_array = [{"fileName": item[FILE_NAME_DEFAULT], "succeeded": False, "errors": ["Failed to upload files: can't get temp credential!"]} for item in batch_files]
+        update_batch(apiInvoker, newBatch, update_array)
+    else:
+        temp_credential = apiInvoker.cred
+        # the credential is of the submission, it is also used to upload the final manifest
+        configs[TEMP_CREDENTIAL] = batch_configs[TEMP_CREDENTIAL] = temp_credential
+        #step 5: upload all files of the batch to designated s3 bucket
+        loader = FileUploader(batch_configs, batch_files, validator.md5_cache, validator.archive_files_info)
+        # create upload heart beater instance
+        upload_heart_beater = UploadHeartBeater(batch_configs[BATCH_ID], apiInvoker, batch_configs[HEARTBEAT_INTERVAL_CONFIG])
+        try:
+            # start heart beater right before uploading files
+            if upload_heart_beater:
+                upload_heart_beater.start()
+            result = loader.upload()
+            if not result:
+                log.error("Failed to upload files: can't upload files to bucket!")
+                log.info("Failed to upload files: can't upload files to bucket! Please check log file in tmp folder for details.")
+            else:
+                log.info("File uploading completed!")
+                if configs[UPLOAD_TYPE] == TYPE_FILE and not validator.has_file_id:
+                    # set file id of the batch to file_list
+                    for file_record, file_info in zip(batch_files, newBatch["files"]):
+                        file_record[FILE_ID_DEFAULT] = file_info.get(FILE_ID_DEFAULT)
+            # stop heartbeat after uploading completed
+            if upload_heart_beater:
+                upload_heart_beater.stop()
+                upload_heart_beater = None
+           
+        except KeyboardInterrupt:
+            # stop heartbeat if interrupted
+            if upload_heart_beater:
+                upload_heart_beater.stop()
+                upload_heart_beater = None
+            interrupted = True
+            result = False
+            error = 'File uploading is interrupted.'
+            log.info(error)
+            for item in batch_files:
+                if not item.get(SUCCEEDED, False):
+                    item[ERRORS] = item[ERRORS].append(error) if item.get(ERRORS) else [error]
+                    item[SUCCEEDED] = False
+        finally:
             #set fileList for update batch
-            file_array = [{"fileName": item[FILE_NAME_DEFAULT], "succeeded": False, "errors": ["Failed to upload files: can't get temp credential!"]} for item in file_list]
-        else:
-            temp_credential = apiInvoker.cred
-            configs[TEMP_CREDENTIAL] = temp_credential
-            #step 5: upload all files to designated s3 bucket
-            loader = FileUploader(configs, file_list, validator.md5_cache, validator.md5_cache_file, archive_files_info)
-            # create upload heart beater instance
-            upload_heart_beater = UploadHeartBeater(configs[BATCH_ID], apiInvoker, configs[HEARTBEAT_INTERVAL_CONFIG])
-            try:
-                # start heart beater right before uploading files
-                if upload_heart_beater:
-                    upload_heart_beater.start()
-                result = loader.upload()
-                if not result:
-                    log.error("Failed to upload files: can't upload files to bucket!")
-                    log.info("Failed to upload files: can't upload files to bucket! Please check log file in tmp folder for details.")
-                else:
-                    #write filelist to tsv file and save to result dir
-                    log.info("File uploading completed!")
-                    if configs[UPLOAD_TYPE] == TYPE_FILE:
-                        # process manifest file
-                        if not validator.has_file_id:
-                            # set file id to file_list
-                            for i, file_info in enumerate(newBatch["files"]):
-                                file_list[i][FILE_ID_DEFAULT] = file_info.get(FILE_ID_DEFAULT)
-                        process_manifest_file(log, configs.copy(), validator.has_file_id, file_list, validator.manifest_rows, s3_manifest_url)  
-                # stop heartbeat after uploading completed
-                if upload_heart_beater:
-                    upload_heart_beater.stop()
-                    upload_heart_beater = None
-               
-            except KeyboardInterrupt:
-                # stop heartbeat if interrupted
-                if upload_heart_beater:
-                    upload_heart_beater.stop()
-                    upload_heart_beater = None
-                error = 'File uploading is interrupted.'
-                log.info(error)
-                for item in file_list:
-                    if not item.get(SUCCEEDED, False):
-                        item[ERRORS] = item[ERRORS].append(error) if item.get(ERRORS) else [error]
-                        item[SUCCEEDED] = False
-            finally:
-                #set fileList for update batch
-                file_array = [{"fileName": item[SUBFOLDER_FILE_NAME] if item.get(SUBFOLDER_FILE_NAME) else item.get(FILE_NAME_DEFAULT), "succeeded": item.get(SUCCEEDED, False), "errors": item.get(ERRORS, []), "skipped": item.get(SKIPPED, False)} for item in file_list]
-                #step 6: update the batch
-                if apiInvoker.update_batch(newBatch[BATCH_ID], file_array):
-                    batch = apiInvoker.batch
-                    log.info(f"The batch is updated: {newBatch[BATCH_ID]} with new status: {batch[BATCH_STATUS]} at {batch[BATCH_UPDATED]} ")
-                else:
-                    log.error(f"Failed to update batch, {newBatch[BATCH_ID]}!")
-                    log.info(f"Failed to update batch, {newBatch[BATCH_ID]}! Please check log file in tmp folder for details.")
+            update_array = [{"fileName": item[SUBFOLDER_FILE_NAME] if item.get(SUBFOLDER_FILE_NAME) else item.get(FILE_NAME_DEFAULT), "succeeded": item.get(SUCCEEDED, False), "errors": item.get(ERRORS, []), "skipped": item.get(SKIPPED, False)} for item in batch_files]
+            #step 6: update the batch
+            update_batch(apiInvoker, newBatch, update_array)
+    #dump file list of the batch with uploading status and errors to tmp/reports dir
+    dump_report(batch_files, report_suffix)
+    return result, interrupted
+
+def update_batch(apiInvoker, newBatch, update_array):
+    if apiInvoker.update_batch(newBatch[BATCH_ID], update_array):
+        batch = apiInvoker.batch
+        log.info(f"The batch is updated: {newBatch[BATCH_ID]} with new status: {batch[BATCH_STATUS]} at {batch[BATCH_UPDATED]} ")
     else:
-        log.error(f"Found total {validator.invalid_count} file(s) are invalid!")
-    
-    #step 6: #dump file_list with uploading status and errors to tmp/reports dir
+        log.error(f"Failed to update batch, {newBatch[BATCH_ID]}!")
+        log.info(f"Failed to update batch, {newBatch[BATCH_ID]}! Please check log file in tmp folder for details.")
+
+def dump_report(file_list, report_suffix=""):
     try:
-        file_path = f"./tmp/upload-report-{get_time_stamp()}.tsv"
+        file_path = f"./tmp/upload-report-{get_time_stamp()}{report_suffix}.tsv"
         #filter out file path in the file list
-        file_list = [ {i:a[i] for i in a if i!=FILE_PATH} for a in file_list]
-        dump_dict_to_tsv(file_list, file_path)
+        dump_dict_to_tsv(file_list, file_path, exclude_keys=[FILE_PATH])
         log.info(f"Uploading report is created at {file_path}!")
     except Exception as e:
         log.exception(f"Failed to dump uploading report files: {get_exception_msg()}.")
         log.info(f"Failed to dump uploading report files: {get_exception_msg()}.")
+
 if __name__ == '__main__':
     controller()
\ No newline at end of file